@@ -4,35 +4,87 @@ from collections import OrderedDict
 import pandas as pd 
 import numpy as np 
 from abc import ABCMeta, abstractmethod
-import pypyodbc, sqlite3
 import logging
 import itertools
+## 單日交易資料 (僅在 iterate / index 時才建立)
+StockDay = namedtuple('stock', ('date', 'price', 'change'))
+
+
 class StockTradeDays:
     def __init__(self, price_array, start_date, date_array = None):
-        ## private price array
-        self.__price_array = price_array
-        ## private date array
+        ## private price array (float64)
+        self.__price_array = np.asarray(price_array, dtype=np.float64)
+        ## private date array (str, e.g. '20170103')
         self.__date_array = self._init_days(start_date, date_array)
         ## private stock change array
         self.__change_array = self.__init_change()
-        ## Ordered Dict 
-        self.stock_dict = self._init_stock_dict()
-    
+        ## datetime64 日期, 供日期區間切片
+        self.__dates = self.__init_dates()
+        ## stock_dict 第一次存取時才建立
+        self.__stock_dict = None
+
+    @classmethod
+    def _from_arrays(cls, price_array, date_array, change_array, dates):
+        """由既有陣列(view)建立, 不重新計算"""
+        trade_days = cls.__new__(cls)
+        trade_days.__price_array = price_array
+        trade_days.__date_array = date_array
+        trade_days.__change_array = change_array
+        trade_days.__dates = dates
+        trade_days.__stock_dict = None
+        return trade_days
+
+    @classmethod
+    def from_price_frame(cls, df, price_col='收盤價', code_col='證券代號',
+                         date_col='yyyymmdd', adjust=None):
+        """由多檔股票的 long format dataframe 一次建立
+        日期解析與漲跌幅都是整個 dataframe 一起計算, 再依股票切成 view
+        params
+        ======
+        adjust : adjustment.AdjustmentStore
+            給定則以除權息還原後的價格計算漲跌幅, 除權息日不會被當成下跌
+
+        return
+        ======
+        dict : {證券代號: StockTradeDays}
+        """
+        if adjust is not None:
+            df = adjust.adjust(df, columns=[price_col], code_col=code_col, date_col=date_col)
+        df = df.sort_values([code_col, date_col])
+        price = df[price_col].to_numpy(dtype=np.float64)
+        ## 日期/代號重複很多, 只轉換不重複的值
+        date_ids, date_values = pd.factorize(df[date_col])
+        date_values = np.asarray(date_values).astype(str)
+        text = pd.Series(date_values).str.replace('-', '', regex=False).str[:8]
+        date_values64 = pd.to_datetime(text, format='%Y%m%d', errors='coerce').to_numpy(
+            dtype='datetime64[D]')
+        date_array = date_values[date_ids]
+        dates = date_values64[date_ids]
+        code_ids, code_values = pd.factorize(df[code_col])
+        code_values = np.asarray(code_values).astype(str)
+        change = np.zeros(len(price), dtype=np.float64)
+        if len(price) > 1:
+            change[1:] = np.round(np.diff(price) / price[:-1], 3)
+        starts = np.flatnonzero(np.diff(code_ids, prepend=-1))
+        ## 每檔股票第一天沒有前一天, 漲跌幅為 0
+        change[starts] = 0
+        bounds = np.append(starts, len(price))
+        return {
+            str(code_values[code_ids[lo]]): cls._from_arrays(price[lo:hi], date_array[lo:hi],
+                                        change[lo:hi], dates[lo:hi])
+            for lo, hi in zip(bounds[:-1], bounds[1:])
+        }
+
     def __init_change(self):
-        """從price array生成change_array
+        """從price array生成change_array (向量化)
+        change[i] = round((p[i] - p[i-1]) / p[i-1], 3), 第一天為 0
         """
-        price_float_array = [float(price_str) for price_str in 
-                             self.__price_array]
-        # 通過平移將錯開的收盤價格序列透過zip打包,每個元素為相鄰的兩個收盤價
-        pp_array = [(price1,price2) for price1,price2 in 
-                   zip(price_float_array[:-1],price_float_array[1:])]
-        
-        change_array = list(
-            map(lambda e:round((e[1]-e[0])/e[0],3) ,pp_array)
-        )        
-        change_array.insert(0,0)
+        price = self.__price_array
+        change_array = np.zeros(len(price), dtype=np.float64)
+        if len(price) > 1:
+            change_array[1:] = np.round(np.diff(price) / price[:-1], 3)
         return change_array
-    
+
     def _init_days(self, start_date, date_array):
         """protect方法
         start_date : 初始日期
@@ -40,29 +92,68 @@ class StockTradeDays:
         """
         if date_array is None:
             ## 簡易（不正確?)由start_date & self.__price_array來確定日期序列
-            date_array = [str(start_date + ind) for ind, _ in 
-                         enumerate(self.__price_array)]
+            date_array = (start_date + np.arange(len(self.__price_array))).astype(str)
         else:
-            date_array = [str(date) for date in date_array]
+            date_array = np.asarray(date_array).astype(str)
         return date_array
+
+    def __init_dates(self):
+        """str 日期 --> datetime64[D], 無法解析的為 NaT"""
+        text = pd.Series(self.__date_array).str.replace('-', '', regex=False).str[:8]
+        dates = pd.to_datetime(text, format='%Y%m%d', errors='coerce')
+        return dates.to_numpy(dtype='datetime64[D]')
+
+    @property
+    def price_array(self):
+        return self.__price_array
+
+    @property
+    def change_array(self):
+        return self.__change_array
+
+    @property
+    def date_array(self):
+        return self.__date_array
+
+    @property
+    def dates(self):
+        """datetime64[D] 日期陣列"""
+        return self.__dates
+
     def print_private(self):
         print('date_array:{},\nprice_array:{},\nchange_array:{}'.format(
             self.__date_array,self.__price_array,self.__change_array))
+
     def _init_stock_dict(self):
         """使用namedtuple, OrderDict將結果合併
         """
-        stock_namedtuple = namedtuple('stock',
-                                      ('date','price','change'))
-        
         stock_dict = OrderedDict(
-            (date,stock_namedtuple(date, price, change)) 
-            for date, price, change in 
-            zip(self.__date_array, self.__price_array, 
-                self.__change_array)
+            (date, StockDay(date, price, change))
+            for date, price, change in
+            zip(self.__date_array.tolist(), self.__price_array.tolist(),
+                self.__change_array.tolist())
         )
                 
         return stock_dict
-    
+
+    @property
+    def stock_dict(self):
+        """相容舊介面, 第一次存取時由陣列建立 OrderedDict, 之後重複使用"""
+        if self.__stock_dict is None:
+            self.__stock_dict = self._init_stock_dict()
+        return self.__stock_dict
+
+    def slice_dates(self, start=None, end=None):
+        """取 start ~ end (含) 的子序列, 二分搜尋後回傳共用陣列的 view
+        start, end : (str or datetime64) e.g. '20170103'
+        """
+        dates = self.__dates
+        lo = 0 if start is None else np.searchsorted(
+            dates, pd.Timestamp(str(start)).to_datetime64().astype('datetime64[D]'), 'left')
+        hi = len(dates) if end is None else np.searchsorted(
+            dates, pd.Timestamp(str(end)).to_datetime64().astype('datetime64[D]'), 'right')
+        return self[lo:hi]
+
     def filter_stock(self, want_up=True, want_calc_sum=False):
         """篩選結果子集
         params
@@ -70,18 +161,14 @@ class StockTradeDays:
         want_up : 是否上漲
         want_calc_sum : 是否計算漲幅
         """
-        filter_func = (lambda day:day.change >0) if want_up else (
-            lambda day:day.change<0)
-        want_days = filter(filter_func, self.stock_dict.values())
-        
+        change = self.__change_array
+        mask = change > 0 if want_up else change < 0
+
         if not want_calc_sum:
-            return want_days
-        ## 計算漲幅
-        change_sum = 0.0 
-        for day in want_days:
-            change_sum += day.change
-            
-        return change_sum
+            return (self[int(ind)] for ind in np.flatnonzero(mask))
+        ## 計算漲幅 (cumsum 依序累加, 與逐日相加結果相同)
+        want_change = change[mask]
+        return float(np.cumsum(want_change)[-1]) if len(want_change) else 0.0
             
     def __str__(self):
         return str(self.stock_dict)
@@ -89,16 +176,19 @@ class StockTradeDays:
     __repr__  = __str__
     
     def __iter__(self):
-        for key in self.stock_dict:
-            yield self.stock_dict[key]
-        
-    
+        for day in zip(self.__date_array.tolist(), self.__price_array.tolist(),
+                       self.__change_array.tolist()):
+            yield StockDay(*day)
+
     def __getitem__(self,ind):
-        date_key = self.__date_array[ind]
-        return self.stock_dict[date_key]
+        if isinstance(ind, slice):
+            return self._from_arrays(self.__price_array[ind], self.__date_array[ind],
+                                     self.__change_array[ind], self.__dates[ind])
+        return StockDay(str(self.__date_array[ind]), float(self.__price_array[ind]),
+                        float(self.__change_array[ind]))
     
     def __len__(self):
-        return len(self.stock_dict)
+        return len(self.__price_array)
 
 
 class TradeStrategyBase(metaclass=ABCMeta):
@@ -112,6 +202,19 @@ class TradeStrategyBase(metaclass=ABCMeta):
     def sell_strategy(self, *args, **kwargs):
         pass        
 
+    def buy_signal(self, change_array):
+        """向量化回測用: 未持股時每天是否買入的 bool array
+        子類別實作後即可使用 VectorTradeLoopBack
+        """
+        raise NotImplementedError(
+            '{} does not support vectorized backtest'.format(type(self).__name__))
+
+    @property
+    def keep_stock_threshold(self):
+        """向量化回測用: 買入後持有天數"""
+        raise NotImplementedError(
+            '{} does not support vectorized backtest'.format(type(self).__name__))
+
 class TradeStrategy1(TradeStrategyBase):
     """
     交易策略1 : 
@@ -120,10 +223,16 @@ class TradeStrategy1(TradeStrategyBase):
     買入並持有s_keep_stock_threshold(20)天
     """
     s_keep_stock_threshold = 20
-    def __init__(self):
+    def __init__(self, keep_stock_threshold=None, buy_change_threshold=0.07):
+        """
+        keep_stock_threshold : 此物件的持股天數, None 則使用類別預設值
+        buy_change_threshold : 買入閥值
+        """
         self.keep_stock_day = 0 
+        if keep_stock_threshold is not None:
+            self.s_keep_stock_threshold = keep_stock_threshold
         ## 7%漲幅作為買入策略的閥值
-        self.__buy_change_threshold = 0.07
+        self.__buy_change_threshold = buy_change_threshold
         
     def buy_strategy(self, trade_ind, trade_day, trade_days):
         if self.keep_stock_day == 0 and \
@@ -137,11 +246,19 @@ class TradeStrategy1(TradeStrategyBase):
             
     def sell_strategy(self, trade_ind, trade_day, trade_days):
         if self.keep_stock_day >= \
-            TradeStrategy1.s_keep_stock_threshold:
+            self.s_keep_stock_threshold:
                 ## 若持有股票天數 > 閥值 s_keep_stock_threshold 則賣出
                 self.keep_stock_day = 0 
                 logging.info('sell at {}'.format(trade_day.date))
     
+    def buy_signal(self, change_array):
+        """上漲超過閥值即買入"""
+        return change_array > self.__buy_change_threshold
+
+    @property
+    def keep_stock_threshold(self):
+        return self.s_keep_stock_threshold
+
     @property
     def buy_change_threshold(self):
         return self.__buy_change_threshold
@@ -162,8 +279,16 @@ class TradeStrategy2(TradeStrategyBase):
     """
     s_keep_stock_threshold = 10 #買入後持有N天
     s_buy_change_threshold = -0.10 #下跌買入閥值
-    def __init__(self):
+    def __init__(self, keep_stock_threshold=None, buy_change_threshold=None):
+        """
+        參數只影響此物件, 未給定則使用類別預設值 (set_*_threshold 可修改)
+        多組參數可同時回測而不互相干擾
+        """
         self.keep_stock_day = 0
+        if keep_stock_threshold is not None:
+            self.s_keep_stock_threshold = keep_stock_threshold
+        if buy_change_threshold is not None:
+            self.s_buy_change_threshold = buy_change_threshold
     def buy_strategy(self, trade_ind, trade_day, trade_days):
         if self.keep_stock_day == 0 and trade_ind >= 1:
             """
@@ -176,7 +301,7 @@ class TradeStrategy2(TradeStrategyBase):
             down_rate = trade_day.change + \
                 trade_days[trade_ind - 1].change
             if today_down and yesterday_down and down_rate < \
-                TradeStrategy2.s_buy_change_threshold:
+                self.s_buy_change_threshold:
                     # 買入條件成立
                     self.keep_stock_day += 1
         elif self.keep_stock_day > 0 :
@@ -185,8 +310,20 @@ class TradeStrategy2(TradeStrategyBase):
     
     def sell_strategy(self, trade_ind, trade_day, trade_days):
         if self.keep_stock_day >= \
-            TradeStrategy2.s_keep_stock_threshold:
+            self.s_keep_stock_threshold:
                 self.keep_stock_day = 0
+    def buy_signal(self, change_array):
+        """連續兩天下跌且兩天合計跌幅 < s_buy_change_threshold 即買入"""
+        signal = np.zeros(len(change_array), dtype=bool)
+        today, yesterday = change_array[1:], change_array[:-1]
+        signal[1:] = (today < 0) & (yesterday < 0) & \
+            (today + yesterday < self.s_buy_change_threshold)
+        return signal
+
+    @property
+    def keep_stock_threshold(self):
+        return self.s_keep_stock_threshold
+
     @classmethod
     def set_keep_stock_threshold(cls, keep_stock_threshold):
         """設置持有時間 """
@@ -228,22 +365,109 @@ class TradeLoopBack:
                 self.trade_strategy.sell_strategy(ind, day,
                                                  self.trade_days)                
 
-def calc(keep_stock_threshold, buy_change_threshold):
-    """ 給持股天數,買入閥值=>回測策略2效果
+def vectorized_trades(change_array, buy_signal, keep_stock_threshold, keep_stock_day=0):
+    """以陣列計算 TradeLoopBack 逐日迴圈的結果
+    買入日 b 之後持有 b+1 ~ b+N-1 天 (N = max(持股天數, 1)), 賣出後隔天才能再買,
+    只需對每筆交易查一次下一個買點, 不必逐日呼叫策略
+    params
+    ======
+    change_array : 每日漲跌幅
+    buy_signal : 未持股時每天是否買入 (bool array)
+    keep_stock_threshold : 持股天數
+    keep_stock_day : 回測開始時已持股天數
+
+    return
+    ======
+    (profit_array, buy_indices, 結束時持股天數)
+    """
+    n = len(change_array)
+    threshold = keep_stock_threshold
+    hold = max(threshold, 1)
+    ## next_buy[i] : i 之後(含)第一個買入訊號的位置, 沒有則為 n
+    next_buy = np.where(buy_signal, np.arange(n), n)
+    next_buy = np.minimum.accumulate(next_buy[::-1])[::-1].tolist()
+    starts, ends, buys = [], [], []
+    pos = 0
+    if keep_stock_day > 0:
+        ## 開始時已持股: 持有到 keep_stock_day 達到持股天數
+        sell_ind = min(max(threshold - keep_stock_day - 1, 0), n - 1)
+        starts.append(0)
+        ends.append(sell_ind + 1)
+        pos = sell_ind + 1
+    while pos < n:
+        buy = next_buy[pos]
+        if buy >= n:
+            break
+        buys.append(buy)
+        starts.append(buy + 1)
+        ends.append(min(buy + hold, n))
+        pos = buy + hold
+    starts, ends = np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+    lengths = np.clip(ends - starts, 0, None)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    profit_array = change_array[np.arange(lengths.sum()) + offsets]
+
+    final_keep = 0
+    if buys and n - buys[-1] < threshold:
+        final_keep = n - buys[-1]
+    elif not buys and keep_stock_day > 0 and keep_stock_day + n < threshold:
+        final_keep = keep_stock_day + n
+    return profit_array, np.array(buys, dtype=np.int64), final_keep
+
+
+class VectorTradeLoopBack(TradeLoopBack):
+    """向量化回測: 策略需實作 buy_signal / keep_stock_threshold
+    結果 (profit_array, 策略結束時的 keep_stock_day) 與 TradeLoopBack 相同
+    """
+
+    def execute_trade(self):
+        """執行交易回測"""
+        change_array = self.trade_days.change_array
+        profit_array, buy_indices, keep_stock_day = vectorized_trades(
+            change_array, self.trade_strategy.buy_signal(change_array),
+            self.trade_strategy.keep_stock_threshold,
+            self.trade_strategy.keep_stock_day)
+        self.profit_array = profit_array
+        self.buy_indices = buy_indices
+        self.trade_strategy.keep_stock_day = keep_stock_day
+
+
+def cross_check(trade_days, strategy_factory):
+    """比對逐日回測與向量化回測結果是否完全一致
+    params
+    ======
+    trade_days : StockTradeDays
+    strategy_factory : callable() --> 新的策略物件
+
+    return
+    ======
+    bool
+    """
+    loop_strategy, vector_strategy = strategy_factory(), strategy_factory()
+    loop = TradeLoopBack(trade_days, loop_strategy)
+    loop.execute_trade()
+    vector = VectorTradeLoopBack(trade_days, vector_strategy)
+    vector.execute_trade()
+    return np.array_equal(np.array(loop.profit_array, dtype=np.float64),
+                          vector.profit_array) and \
+        loop_strategy.keep_stock_day == vector_strategy.keep_stock_day
+
+
+def calc(keep_stock_threshold, buy_change_threshold, trade_days):
+    """ 給持股天數,買入閥值=>回測策略2效果 (多組參數的掃描見 sweep.sweep)
     params
     ======    
     :keep_stock_threshold:  持股天數
     :buy_change_threshold: 下跌買入閥值
+    :trade_days: StockTradeDays
 
     return
     ======
     盈虧狀況, 輸入的持股天數, 輸入的下跌買入閥值
     """
-    trade_strategy2 = TradeStrategy2()
-    ## 推過class方法來修改持股天數
-    TradeStrategy2.set_keep_stock_threshold(keep_stock_threshold)
-    TradeStrategy2.set_buy_change_threshold(buy_change_threshold)
-    trade_loop_back = TradeLoopBack(trade_days, trade_strategy2)
+    ## 參數設定在物件上, 不修改類別屬性
+    trade_strategy2 = TradeStrategy2(keep_stock_threshold, buy_change_threshold)
+    trade_loop_back = VectorTradeLoopBack(trade_days, trade_strategy2)
     trade_loop_back.execute_trade()
     if len(trade_loop_back.profit_array) ==0 :
         profit = 0
@@ -253,40 +477,15 @@ def calc(keep_stock_threshold, buy_change_threshold):
 
 
 if __name__ == '__main__':
-    logging.basicConfig(filename='tradelog_2330.log',level=logging.DEBUG)
-
-    ## 假資料
-    # price_lst = ['23.2', '22.1', '24.5', '27.3', '25.6']
-    # date_lst = ['20170103', '20170104', '20170105', '20170106', '20170107']
-    ## 台股資料##
-    with open('../pw.txt', 'r') as f:
-        pw = f.read()
-    con = pypyodbc.connect(
-        "DRIVER={server};SERVER=dbm_public;UID=sa;PWD={pw};DATABASE=external".
-        format(server='sql server', pw=pw))
-    ## 測試2330-- ##
-    stock2330_df = pd.read_sql("""
-        select * from dbo.twstock_daily_price
-        where  證券代號='2330' 
-            and yyyymmdd > '20040211'
-        order by yyyymmdd""", con)    
-    price_series = stock2330_df['收盤價']
-    date_series = stock2330_df['yyyymmdd'].astype('str')
-    trade_days = StockTradeDays(price_series, start_date=None, date_array=date_series)
-
-    # trade_days = StockTradeDays(price_lst,start_date = None,date_array = date_lst)
-    strategy1 = TradeStrategy1()
-    strategy2 = TradeStrategy2()
-    # loopback2330 = TradeLoopBack(trade_days,strategy1)
-    # loopback2330.execute_trade()
-    
-    keep_stock_lst = range(2,30,2)
-    print('持股天數--參數組:{}'.format(keep_stock_lst))
-    buy_change_lst = [e/100 for e in range(-5,-16,-1)]
-    print('下跌閥值--參數組:{}'.format(buy_change_lst))
-
-    result = []
-    for keep_stock_th, buy_change_th in itertools.product(keep_stock_lst, buy_change_lst):
-        result.append(calc(keep_stock_th, buy_change_th))
-    print('共測試:{}組'.format(len(result)))
-    print(sorted(result)[::-1][:10])
+    ## 2330 的參數掃描改由 stocklab 執行, SQL Server 連線 / 密碼檔見 storage.SqlServerBackend
+    ## 等同 python ../src/stocklab.py --log-file tradelog_2330.log --log-level DEBUG sweep \
+    ##     --backend sqlserver --password-file ../pw.txt --code 2330 --start 20040212
+    import os
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+    import stocklab
+
+    sys.exit(stocklab.main([
+        '--log-file', 'tradelog_2330.log', '--log-level', 'DEBUG',
+        'sweep', '--backend', 'sqlserver', '--password-file', '../pw.txt',
+        '--code', '2330', '--start', '20040212'] + sys.argv[1:]))
@@ -0,0 +1,132 @@
+#! encoding = utf8
+"""平行參數掃描 (grid search)
+
+- 所有股票的漲跌幅陣列放在一塊 shared memory, worker 直接 attach,
+  每個 task 只傳 (策略, 參數), 不重複 pickle 價格資料
+- 每組參數以 VectorTradeLoopBack 相同的 vectorized_trades 計算
+- 結果依完成順序串流進 top-K heap; 排序鍵固定 (盈虧, 參數), 結果可重現
+"""
+import heapq
+import itertools
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from stock import StockTradeDays, TradeStrategy2, vectorized_trades
+
+## worker 端 attach 的共享陣列
+_SHARED = {}
+
+
+class SharedChangeArrays:
+    """把多檔股票的漲跌幅陣列接成一個 shared memory 區塊
+    params
+    ======
+    trade_days : dict {證券代號: StockTradeDays} 或單一 StockTradeDays
+    """
+
+    def __init__(self, trade_days):
+        if isinstance(trade_days, StockTradeDays):
+            trade_days = {'': trade_days}
+        self.codes = list(trade_days)
+        lengths = [len(trade_days[code]) for code in self.codes]
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        size = max(int(self.offsets[-1]), 1) * np.dtype(np.float64).itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        buf = np.ndarray((int(self.offsets[-1]),), dtype=np.float64, buffer=self.shm.buf)
+        for code, lo, hi in zip(self.codes, self.offsets[:-1], self.offsets[1:]):
+            buf[lo:hi] = trade_days[code].change_array
+        del buf
+
+    def spec(self):
+        """傳給 worker initializer 的參數 (只有名稱與 offsets)"""
+        return self.shm.name, self.offsets.tolist()
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _init_worker(name, offsets):
+    ## worker 與建立者共用同一個 resource tracker, unlink 由建立者負責
+    shm = shared_memory.SharedMemory(name=name)
+    buf = np.ndarray((offsets[-1],), dtype=np.float64, buffer=shm.buf)
+    _SHARED['shm'] = shm
+    _SHARED['arrays'] = [buf[lo:hi] for lo, hi in zip(offsets[:-1], offsets[1:])]
+
+
+def _evaluate(task):
+    """單組參數對所有股票回測
+    return
+    ======
+    (總盈虧, 持股天數, 買入閥值, 交易次數)
+    """
+    strategy_cls, keep_stock_threshold, buy_change_threshold = task
+    profit = 0.0
+    trades = 0
+    for change_array in _SHARED['arrays']:
+        strategy = strategy_cls(keep_stock_threshold=keep_stock_threshold,
+                                buy_change_threshold=buy_change_threshold)
+        profit_array, buy_indices, _ = vectorized_trades(
+            change_array, strategy.buy_signal(change_array), strategy.keep_stock_threshold)
+        if len(profit_array):
+            profit += np.cumsum(profit_array)[-1]
+        trades += len(buy_indices)
+    return float(profit), keep_stock_threshold, buy_change_threshold, trades
+
+
+def sweep(trade_days, keep_stock_list, buy_change_list, strategy_cls=TradeStrategy2,
+          processes=None, top_k=10, chunksize=4):
+    """平行掃描 (持股天數 x 買入閥值) 的所有組合
+    params
+    ======
+    trade_days : dict {證券代號: StockTradeDays} 或單一 StockTradeDays
+    keep_stock_list : 持股天數參數組
+    buy_change_list : 買入閥值參數組
+    strategy_cls : 需支援 __init__(keep_stock_threshold, buy_change_threshold)
+        與 buy_signal 的策略類別
+    processes : worker 數, None 為 CPU 數, 1 則在目前的 process 執行
+    top_k : 保留盈虧最高的前 k 組
+
+    return
+    ======
+    list of (總盈虧, 持股天數, 買入閥值, 交易次數), 依盈虧由高到低
+    """
+    tasks = [(strategy_cls, keep, buy)
+             for keep, buy in itertools.product(keep_stock_list, buy_change_list)]
+    heap = []
+
+    def push(result):
+        ## 盈虧相同時以參數排序, 不受完成順序影響
+        key = (result[0], -result[1], -result[2])
+        item = (key, result)
+        if len(heap) < top_k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    with SharedChangeArrays(trade_days) as shared:
+        if processes == 1:
+            _init_worker(*shared.spec())
+            try:
+                for task in tasks:
+                    push(_evaluate(task))
+            finally:
+                _SHARED.pop('arrays', None)
+                _SHARED.pop('shm').close()
+        else:
+            with multiprocessing.Pool(processes, initializer=_init_worker,
+                                      initargs=shared.spec()) as pool:
+                for result in pool.imap_unordered(_evaluate, tasks, chunksize):
+                    push(result)
+    logging.info('sweep {} combinations x {} stocks done'.format(
+        len(tasks), len(shared.codes)))
+    return [result for _, result in sorted(heap, reverse=True)]
@@ -0,0 +1,86 @@
+#! encoding = utf8
+"""比較 insertDataFrameToDb (逐列) 與 bulk_insert_df (批次 upsert) 寫入速度
+
+usage
+=====
+python benchmarks/bench_loader.py --rows 5000000 --legacy-rows 200000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from twse_crawler import create_db, insertDataFrameToDb, bulk_insert_df  # noqa: E402
+
+
+def make_price_frame(n_rows, n_stocks=1000, seed=0):
+    """產生 n_rows 筆假的 tse_price 資料 (每天 n_stocks 檔)"""
+    rng = np.random.default_rng(seed)
+    n_days = -(-n_rows // n_stocks)
+    dates = pd.bdate_range('2000-01-03', periods=n_days).strftime('%Y%m%d')
+    codes = np.array(['{:04d}'.format(1000 + i) for i in range(n_stocks)])
+    close = rng.uniform(10, 500, n_days * n_stocks).round(2)
+    df = pd.DataFrame({
+        'yyyymmdd': np.repeat(dates, n_stocks),
+        '證券代號': np.tile(codes, n_days),
+        '成交量': rng.uniform(0, 50000, close.size).round(3),
+        '成交筆數': rng.integers(0, 20000, close.size),
+        '開盤價': close,
+        '最高價': close * 1.02,
+        '最低價': close * 0.98,
+        '收盤價': close,
+        '本益比': np.where(rng.random(close.size) < 0.1, np.nan, 15.0),
+    })
+    return df.iloc[:n_rows]
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--legacy-rows', type=int, default=200000,
+                        help='逐列寫入太慢, 只取前 N 筆計算 rows/sec')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    args = parser.parse_args()
+
+    df = make_price_frame(args.rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        con = sqlite3.connect(os.path.join(tmp, 'legacy.db'))
+        create_db('tse_price', con)
+        legacy = df.iloc[:args.legacy_rows]
+        sec, _ = _timed(insertDataFrameToDb, legacy, con, 'tse_price')
+        con.close()
+        legacy_rate = len(legacy) / sec
+        print('insertDataFrameToDb: {:,} rows in {:.2f}s ({:,.0f} rows/sec)'.format(
+            len(legacy), sec, legacy_rate))
+
+        con = sqlite3.connect(os.path.join(tmp, 'bulk.db'))
+        create_db('tse_price', con)
+        sec, result = _timed(bulk_insert_df, df, con, 'tse_price',
+                             chunksize=args.chunksize)
+        bulk_rate = len(df) / sec
+        print('bulk_insert_df (insert): {:,} rows in {:.2f}s ({:,.0f} rows/sec) {}'.format(
+            len(df), sec, bulk_rate, result))
+
+        ## 再寫一次同樣資料: 全部應為 skipped
+        sec, result = _timed(bulk_insert_df, df, con, 'tse_price',
+                             chunksize=args.chunksize)
+        print('bulk_insert_df (re-load): {:,} rows in {:.2f}s ({:,.0f} rows/sec) {}'.format(
+            len(df), sec, len(df) / sec, result))
+        con.close()
+    print('speedup: {:.1f}x'.format(bulk_rate / legacy_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#! encoding = utf8
+"""parser micro-benchmark: 逐列/逐格處理 (舊) vs parsers 模組 (整批, 多天合併)
+
+usage
+=====
+python benchmarks/bench_parser.py --days 50
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import parsers  # noqa: E402
+import fixtures  # noqa: E402
+
+
+def legacy_parse_tse(text):
+    """原 get_tse_data 的解析方式"""
+    df = pd.read_csv(StringIO("\n".join([i.translate({ord(c): None for c in ' '})
+                                         for i in text.split('\n')
+                                         if len(i.split('",')) == 16 and i[0] != '='])),
+                     header=0, thousands=',', dtype={'證券代號': str})
+    df.set_index('證券代號', inplace=True)
+    df.columns = ['證券名稱', '成交量', '成交筆數', '成交金額', '開盤價', '最高價', '最低價', '收盤價',
+                  '漲跌(+/-)', '漲跌價差', '最後揭示買價', '最後揭示買量', '最後揭示賣價', '最後揭示賣量', '本益比']
+    df['成交量'] /= 1000
+    df = df.drop(['漲跌(+/-)', '證券名稱', '最後揭示買量', '最後揭示賣量'], axis=1)
+    df = df.replace('--', np.nan)
+    df = df.apply(pd.to_numeric)
+    return df
+
+
+def _clean_row(row):
+    for index, content in enumerate(row):
+        row[index] = re.sub(",", "", content.strip())
+        if '---' in content:
+            row[index] = np.nan
+    return row
+
+
+def legacy_parse_otc(result, yyyymmdd):
+    """原 get_otc_data 的解析方式 (clean_row + 9 個 list)"""
+    columns = {k: [] for k in parsers.OTC_COLUMNS}
+    for table in [result['mmData'], result['aaData']]:
+        for tr in table:
+            if len(tr) == 17:
+                row = _clean_row([yyyymmdd, tr[8], tr[10], tr[9], tr[4], tr[5], tr[6], tr[2]])
+                row.insert(0, tr[0])
+                columns['證券代號'].append(row[0])
+                columns['yyyymmdd'].append(row[1])
+                columns['成交量'].append(float(row[2]) / 1000)
+                columns['成交筆數'].append(float(row[3]))
+                columns['成交金額'].append(float(row[4]))
+                columns['開盤價'].append(float(row[5]))
+                columns['最高價'].append(float(row[6]))
+                columns['最低價'].append(float(row[7]))
+                columns['收盤價'].append(float(row[8]))
+    return pd.DataFrame(columns)
+
+
+def bench(name, func, payloads, rows_per_payload):
+    start = time.perf_counter()
+    for payload in payloads:
+        func(payload)
+    sec = time.perf_counter() - start
+    rows = rows_per_payload * len(payloads)
+    print('{:<24} {:>8,} rows {:>8.3f}s {:>12,.0f} rows/sec'.format(name, rows, sec, rows / sec))
+    return rows / sec
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=50)
+    args = parser.parse_args()
+
+    tse = [fixtures.tse_csv(seed=i) for i in range(args.days)]
+    otc = [fixtures.otc_json(seed=i) for i in range(args.days)]
+
+    ## 兩種實作結果需一致
+    pd.testing.assert_frame_equal(legacy_parse_tse(tse[0]), parsers.parse_tse_csv(tse[0]),
+                                  check_dtype=False)
+    pd.testing.assert_frame_equal(legacy_parse_otc(otc[0], '20180103'),
+                                  parsers.parse_otc_json(otc[0], (2018, 1, 3)),
+                                  check_dtype=False)
+
+    n_tse = len(parsers.parse_tse_csv(tse[0]))
+    old = bench('tse legacy', legacy_parse_tse, tse, n_tse)
+    new = bench('tse parsers', parsers.parse_tse_csv, tse, n_tse)
+    batch = bench('tse parsers (batch)',
+                  lambda _: parsers.parse_tse_batch((t, (2018, 1, 3)) for t in tse),
+                  [None], n_tse * len(tse))
+    print('tse speedup: {:.1f}x, batch {:.1f}x'.format(new / old, batch / old))
+    n_otc = len(otc[0]['aaData'])
+    old = bench('otc legacy', lambda r: legacy_parse_otc(r, '20180103'), otc, n_otc)
+    new = bench('otc parsers', lambda r: parsers.parse_otc_json(r, (2018, 1, 3)), otc, n_otc)
+    batch = bench('otc parsers (batch)',
+                  lambda _: parsers.parse_otc_batch((r, (2018, 1, 3)) for r in otc),
+                  [None], n_otc * len(otc))
+    print('otc speedup: {:.1f}x, batch {:.1f}x'.format(new / old, batch / old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#! encoding = utf8
+"""單一股票歷史查詢: 舊格式 (PRIMARY KEY (yyyymmdd, 證券代號), 文字日期) vs price_db.migrate 之後
+
+以舊的 tse_price DDL 建立 --days 個交易日 x --stocks 檔的資料庫 (預設約 20 年),
+量測
+- history : WHERE 證券代號 = ? AND yyyymmdd > ? ORDER BY yyyymmdd (abu_QT/stock.py 的讀法)
+- day     : WHERE yyyymmdd = ? (某一天全部股票)
+- PriceDB.history (migrate 之後)
+各查詢隨機挑 --queries 組參數, 報告 median / p95 (ms)
+
+usage
+=====
+python benchmarks/bench_query.py --stocks 1000 --days 5000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import price_db  # noqa: E402
+
+## 改版前 create_db 的 tse_price
+LEGACY_DDL = """
+    CREATE TABLE tse_price(
+        yyyymmdd date,
+        證券代號 TEXT,
+        成交量 REAL,
+        成交筆數 INTEGER,
+        開盤價 REAL,
+        最高價 REAL,
+        最低價 REAL,
+        收盤價 REAL,
+        本益比 REAL,
+        PRIMARY KEY (yyyymmdd,證券代號)
+    )
+"""
+
+
+def build_legacy_db(path, n_days, n_stocks, seed=0):
+    """舊格式資料庫, 日期存成 '2004-02-11' 文字, 依日期寫入 (同爬蟲的寫入順序)"""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', periods=n_days)
+    codes = np.array(['{:04d}'.format(1000 + i) for i in range(n_stocks)])
+    con = sqlite3.connect(path)
+    con.execute(LEGACY_DDL)
+    close = 50 * np.exp(np.cumsum(rng.normal(0, 0.02, (n_days, n_stocks)), axis=0))
+    for i, day in enumerate(dates.strftime('%Y-%m-%d')):
+        price = close[i].round(2)
+        con.executemany(
+            'INSERT INTO tse_price VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            zip([day] * n_stocks, codes, rng.uniform(0, 50000, n_stocks).round(3).tolist(),
+                rng.integers(0, 20000, n_stocks).tolist(), price.tolist(),
+                (price * 1.02).round(2).tolist(), (price * 0.98).round(2).tolist(),
+                price.tolist(), [15.0] * n_stocks))
+    con.commit()
+    return con, dates, codes
+
+
+def _percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return np.median(ms), np.percentile(ms, 95)
+
+
+def time_queries(con, sql, params):
+    """每組參數執行一次 (fetchall), 回傳 (median, p95, 平均筆數)"""
+    seconds, rows = [], 0
+    for args in params:
+        start = time.perf_counter()
+        rows += len(con.execute(sql, args).fetchall())
+        seconds.append(time.perf_counter() - start)
+    return _percentiles(seconds) + (rows / len(params),)
+
+
+def time_calls(func, params):
+    seconds, rows = [], 0
+    for args in params:
+        start = time.perf_counter()
+        rows += len(func(*args))
+        seconds.append(time.perf_counter() - start)
+    return _percentiles(seconds) + (rows / len(params),)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--stocks', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=5000, help='交易日數, 5000 約 20 年')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--db', default=None, help='資料庫路徑, 預設為暫存檔')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'prices.db')
+        start = time.perf_counter()
+        con, dates, codes = build_legacy_db(path, args.days, args.stocks)
+        print('built {:,} rows ({} days x {} stocks) in {:.1f}s, {:.0f} MB'.format(
+            args.days * args.stocks, args.days, args.stocks, time.perf_counter() - start,
+            os.path.getsize(path) / 2 ** 20))
+
+        picks = rng.choice(codes, args.queries)
+        ## 起始日在前半段: 每次取回 10 年以上
+        since = dates[rng.integers(0, args.days // 2, args.queries)]
+        days = dates[rng.integers(0, args.days, args.queries)]
+        sql_history = 'SELECT * FROM tse_price WHERE 證券代號 = ? AND yyyymmdd > ? ORDER BY yyyymmdd'
+        sql_day = 'SELECT * FROM tse_price WHERE yyyymmdd = ?'
+
+        results = []
+        fmt = '%Y-%m-%d'
+        results.append(('legacy', 'history') + time_queries(
+            con, sql_history, list(zip(picks, since.strftime(fmt)))))
+        results.append(('legacy', 'day') + time_queries(
+            con, sql_day, [(d,) for d in days.strftime(fmt)]))
+
+        report = price_db.migrate(con)['tse_price']
+        print('migrate: {:,} rows in {:.1f}s, {:.0f} MB'.format(
+            report['migrated'], report['seconds'], os.path.getsize(path) / 2 ** 20))
+
+        fmt = '%Y%m%d'
+        results.append(('migrated', 'history') + time_queries(
+            con, sql_history, [(c, int(d)) for c, d in zip(picks, since.strftime(fmt))]))
+        results.append(('migrated', 'day') + time_queries(
+            con, sql_day, [(int(d),) for d in days.strftime(fmt)]))
+        db = price_db.PriceDB(con, tables=['tse_price'])
+        results.append(('migrated', 'PriceDB.history') + time_calls(
+            lambda code, day: db.history(code, start=day, columns=['開盤價', '收盤價']),
+            list(zip(picks, since.strftime(fmt)))))
+        con.close()
+
+    df = pd.DataFrame(results, columns=['layout', 'query', 'median(ms)', 'p95(ms)', 'rows'])
+    print(df.to_string(index=False, float_format='{:.2f}'.format))
+    legacy = df.loc[(df['layout'] == 'legacy') & (df['query'] == 'history'), 'median(ms)'].iloc[0]
+    migrated = df.loc[(df['layout'] == 'migrated') & (df['query'] == 'history'),
+                      'median(ms)'].iloc[0]
+    print('single-stock history: {:.1f}x faster'.format(legacy / migrated))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#! encoding = utf8
+"""離線 benchmark 用的回應內容
+
+格式與 TWSE MI_INDEX csv / TPEx 上櫃收盤行情 json / MOPS 月營收與季報彙總表 html 相同,
+以固定 seed 產生, 每次內容一致; 有 RawCache 目錄時可改用實際錄下的回應 (recorded)
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+TSE_HEADER = ('"證券代號","證券名稱","成交股數","成交筆數","成交金額","開盤價","最高價",'
+              '"最低價","收盤價","漲跌(+/-)","漲跌價差","最後揭示買價","最後揭示買量",'
+              '"最後揭示賣價","最後揭示賣量","本益比"')
+
+
+def _fmt(value):
+    return '{:,}'.format(value)
+
+
+def tse_csv(date_tuple=(2018, 1, 3), n_stocks=1000, seed=0):
+    """一天的 MI_INDEX csv 文字 (已解碼)"""
+    rng = np.random.default_rng(seed)
+    year, month, day = date_tuple
+    lines = [
+        '"{}年{:02d}月{:02d}日 大盤統計資訊"'.format(year - 1911, month, day),
+        '"指數","收盤指數","漲跌(+/-)","漲跌點數","漲跌百分比(%)"',
+        '"發行量加權股價指數","10,801.57","+","158.88","1.49"',
+        '"{}年{:02d}月{:02d}日 每日收盤行情(全部)"'.format(year - 1911, month, day),
+        TSE_HEADER,
+    ]
+    for i in range(n_stocks):
+        close = round(float(rng.uniform(5, 600)), 2)
+        no_trade = rng.random() < 0.05
+        price = lambda p: '--' if no_trade else '{:.2f}'.format(p)
+        lines.append('"{}","股票 {}","{}","{}","{}","{}","{}","{}","{}","{}","{:.2f}",'
+                     '"{}","{}","{}","{}","{}"'.format(
+                         1101 + i, i,
+                         _fmt(int(rng.integers(0, 5e7))), _fmt(int(rng.integers(0, 2e4))),
+                         _fmt(int(rng.integers(0, 5e9))),
+                         price(close * 0.99), price(close * 1.02), price(close * 0.97), price(close),
+                         '+' if rng.random() < 0.5 else '-', float(rng.uniform(0, 5)),
+                         price(close * 0.999), _fmt(int(rng.integers(1, 500))),
+                         price(close * 1.001), _fmt(int(rng.integers(1, 500))),
+                         '0.00' if rng.random() < 0.2 else '{:.2f}'.format(rng.uniform(5, 60))))
+    lines.append('"備註:"')
+    lines.append('"漲跌(+/-)欄位符號說明:+/-/X表示漲/跌/不比價。"')
+    return '\r\n'.join(lines)
+
+
+def otc_json(date_tuple=(2018, 1, 3), n_stocks=800, seed=0):
+    """一天的 TPEx 上櫃收盤行情 json (dict)"""
+    rng = np.random.default_rng(seed)
+    year, month, day = date_tuple
+    rows = []
+    for i in range(n_stocks):
+        close = round(float(rng.uniform(5, 600)), 2)
+        no_trade = rng.random() < 0.05
+        price = lambda p: '---' if no_trade else '{:.2f}'.format(p)
+        rows.append([
+            str(3000 + i), '櫃買 {}'.format(i), price(close), '+0.50',
+            price(close * 0.99), price(close * 1.02), price(close * 0.97), price(close),
+            _fmt(int(rng.integers(0, 5e7))), _fmt(int(rng.integers(0, 5e9))),
+            _fmt(int(rng.integers(0, 2e4))), price(close * 0.999), price(close * 1.001),
+            _fmt(int(rng.integers(1e6, 1e9))), price(close * 1.1), price(close * 0.9), '0',
+        ])
+    return {
+        'reportDate': '{}/{:02d}/{:02d}'.format(year - 1911, month, day),
+        'iTotalRecords': len(rows),
+        'mmData': [],
+        'aaData': rows,
+    }
+
+
+def otc_json_text(*args, **kwargs):
+    return json.dumps(otc_json(*args, **kwargs), ensure_ascii=False)
+
+
+def _td(cells, tag='td'):
+    return '<tr>' + ''.join('<{0}>{1}</{0}>'.format(tag, c) for c in cells) + '</tr>'
+
+
+def mops_monthly_html(year=2018, month=1, n_companies=900, n_industries=30, seed=0):
+    """一個月的 t21sc03 月營收彙總表 html (已解碼), 每個產業一個 table"""
+    rng = np.random.default_rng(seed)
+    header = ['公司代號', '公司名稱', '當月營收', '上月營收', '去年當月營收', '上月比較 增減(%)',
+              '去年同月 增減(%)', '當月累計營收', '去年累計營收', '前期比較 增減(%)', '備註']
+    parts = ['<html><body><center>{}年{}月 營業收入統計表</center>'.format(year - 1911, month)]
+    per_table = -(-n_companies // n_industries)
+    for start in range(0, n_companies, per_table):
+        rows = [_td(['產業別：產業 {}'.format(start // per_table)], 'th'), _td(header, 'th')]
+        for i in range(start, min(start + per_table, n_companies)):
+            revenue, last, last_year = rng.integers(1e4, 1e8, 3)
+            rows.append(_td([1101 + i, '公司 {}'.format(i), _fmt(int(revenue)), _fmt(int(last)),
+                             _fmt(int(last_year)), '{:.2f}'.format(rng.normal(0, 20)),
+                             '{:.2f}'.format(rng.normal(0, 30)), _fmt(int(revenue * month)),
+                             _fmt(int(last_year * month)), '{:.2f}'.format(rng.normal(0, 30)),
+                             '-']))
+        rows.append(_td(['合計', '', _fmt(0), _fmt(0), _fmt(0), '', '', '', '', '', '']))
+        parts.append('<table>' + ''.join(rows) + '</table>')
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def mops_statement_html(n_companies=900, n_industries=6, n_items=20, seed=0):
+    """一季的 ajax_t163sb04 綜合損益彙總表 html, 各產業欄位數不同"""
+    rng = np.random.default_rng(seed)
+    parts = ['<html><body>']
+    per_table = -(-n_companies // n_industries)
+    for k, start in enumerate(range(0, n_companies, per_table)):
+        items = ['項目 {}'.format(j) for j in range(n_items - k)] + ['基本每股盈餘（元）']
+        rows = [_td(['公司代號', '公司名稱'] + items, 'th')]
+        for i in range(start, min(start + per_table, n_companies)):
+            values = rng.normal(0, 1e6, len(items) - 1)
+            rows.append(_td([1101 + i, '公司 {}'.format(i)] +
+                            [_fmt(int(v)) for v in values] + ['{:.2f}'.format(rng.normal(1, 2))]))
+        parts.append('<table class="hasBorder">' + ''.join(rows) + '</table>')
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def price_panel(n_days=2500, n_stocks=1000, seed=0):
+    """隨機漫步的多檔收盤價 (long format: 證券代號, yyyymmdd, 收盤價), 供回測使用"""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2008-01-02', periods=n_days).strftime('%Y%m%d')
+    codes = np.array(['{:04d}'.format(1000 + i) for i in range(n_stocks)])
+    ## 漲跌幅限制 10%, 收盤價四捨五入到分
+    change = np.clip(rng.normal(0, 0.025, (n_days, n_stocks)), -0.1, 0.1)
+    close = (rng.uniform(10, 500, n_stocks) * np.cumprod(1 + change, axis=0)).round(2)
+    return pd.DataFrame({
+        '證券代號': np.repeat(codes, n_days),
+        'yyyymmdd': np.tile(np.asarray(dates), n_stocks),
+        '收盤價': np.maximum(close.T.ravel(), 0.01),
+    })
+
+
+def recorded(root, endpoint, limit=None):
+    """RawCache 中實際錄下的回應 [(params, bytes)], 目錄不存在或沒有資料回傳 []"""
+    from raw_cache import RawCache
+
+    entries = []
+    for meta, content in RawCache(root).iter_entries(endpoint):
+        entries.append((meta['params'], content))
+        if limit is not None and len(entries) >= limit:
+            break
+    return entries
@@ -0,0 +1,595 @@
+#! encoding = utf8
+"""benchmark suite: 解析 / 寫入 / 回測 / 參數掃描 的吞吐量, 與儲存的 baseline 比較
+
+全部離線執行:
+- 解析 : fixtures 產生的 TWSE csv / TPEx json / MOPS html, 或 --cache 指定的
+         RawCache 目錄中實際錄下的回應
+- 寫入 / 回測 / 掃描 : fixtures.price_panel 等合成的全市場資料
+每個 benchmark 只計時主要動作 (資料準備不計), 重複 --repeat 次取最快的一次,
+換算成 rows/sec, days/sec, combos/sec; 有 legacy 對照的項目另外列出加速倍數
+baseline 存在 benchmarks/baseline.json, 變慢超過 --tolerance 標示為 REGRESSION;
+--scale / --cache 與 baseline 不同時不比較 (資料量不同, rate 不能直接相比),
+平行的項目另需 CPU 數相同, 只有 1 個 CPU 時略過
+
+usage
+=====
+python benchmarks/run.py                      # 全部執行並與 baseline 比較
+python benchmarks/run.py -k parse -k insert   # 名稱包含 parse 或 insert 的項目
+python benchmarks/run.py --scale 0.2          # 縮小資料量 (快速檢查)
+python benchmarks/run.py --cache raw_cache    # 解析改用錄下的回應
+python benchmarks/run.py --save-baseline      # 以本次結果更新 baseline
+python benchmarks/run.py --output result.json --fail-on-regression
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+sys.path.insert(0, os.path.join(HERE, '..', 'abu_QT'))
+import fixtures  # noqa: E402
+
+BASELINE_PATH = os.path.join(HERE, 'baseline.json')
+UNITS = {'rows': 'rows/sec', 'days': 'days/sec', 'combos': 'combos/sec'}
+
+## name --> {'setup', 'unit', 'legacy'}
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, unit, legacy=None, parallel=False):
+    """登記 benchmark
+    setup(ctx) 做資料準備, 回傳 (被計時的 callable, 每次處理的筆數)
+    legacy : 對照的舊實作 benchmark 名稱, 報表列出加速倍數
+    parallel : 量測多 process 的效果, 只有 1 個 CPU 時略過
+    """
+    def register(setup):
+        BENCHMARKS[name] = {'setup': setup, 'unit': unit, 'legacy': legacy,
+                            'parallel': parallel}
+        return setup
+    return register
+
+
+def _cpus():
+    ## 實際可用的 CPU 數 (container / taskset 限制後)
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class Skip(Exception):
+    """環境缺少依賴 (e.g. pypyodbc) 時略過"""
+
+
+class Context:
+    """各 benchmark 共用的 fixture, 第一次使用時才產生"""
+
+    def __init__(self, scale=1.0, cache=None, tmpdir=None):
+        self.scale = scale
+        self.cache = cache
+        self.tmpdir = tmpdir
+        self._data = {}
+
+    def n(self, value, minimum=1):
+        return max(int(value * self.scale), minimum)
+
+    def get(self, key, build):
+        if key not in self._data:
+            self._data[key] = build()
+        return self._data[key]
+
+    def tse_days(self):
+        """[(csv 文字, date_tuple)]"""
+        def build():
+            entries = fixtures.recorded(self.cache, 'tse_mi_index', self.n(50)) \
+                if self.cache else []
+            if entries:
+                return [(content.decode('big5', errors='replace'), _roc_tuple(params['qdate']))
+                        for params, content in entries]
+            return [(fixtures.tse_csv(seed=i), (2018, 1, 3)) for i in range(self.n(50))]
+        return self.get('tse', build)
+
+    def otc_days(self):
+        """[(json dict, date_tuple)]"""
+        def build():
+            entries = fixtures.recorded(self.cache, 'otc_daily_close', self.n(50)) \
+                if self.cache else []
+            if entries:
+                return [(json.loads(content), _roc_tuple(params['d']))
+                        for params, content in entries]
+            return [(fixtures.otc_json(seed=i), (2018, 1, 3)) for i in range(self.n(50))]
+        return self.get('otc', build)
+
+    def mops_monthly(self):
+        """[(html, year, month, typek)]"""
+        def build():
+            entries = fixtures.recorded(self.cache, 'mops_monthly_revenue', self.n(12)) \
+                if self.cache else []
+            if entries:
+                return [(content.decode('cp950', errors='replace'), params['year'],
+                         params['month'], params['typek']) for params, content in entries]
+            return [(fixtures.mops_monthly_html(month=i % 12 + 1, seed=i), 2018, i % 12 + 1, 'sii')
+                    for i in range(self.n(12))]
+        return self.get('mops_monthly', build)
+
+    def mops_statements(self):
+        """[html]"""
+        def build():
+            entries = fixtures.recorded(self.cache, 'mops_statement', self.n(8)) \
+                if self.cache else []
+            if entries:
+                return [content.decode('utf8', errors='replace') for _, content in entries]
+            return [fixtures.mops_statement_html(seed=i) for i in range(self.n(8))]
+        return self.get('mops_statement', build)
+
+    def price_frame(self):
+        from bench_loader import make_price_frame
+
+        return self.get('price_frame', lambda: make_price_frame(self.n(500000, 1000)))
+
+    def panel(self):
+        return self.get('panel', lambda: fixtures.price_panel(self.n(2500, 30), self.n(200, 2)))
+
+
+def _roc_tuple(text):
+    year, month, day = (int(x) for x in text.split('/'))
+    return (year + 1911 if year < 1900 else year, month, day)
+
+
+def _stock():
+    try:
+        import stock
+    except ImportError as e:
+        raise Skip('cannot import abu_QT/stock.py: {}'.format(e))
+    return stock
+
+
+def _sqlite(ctx, name):
+    from twse_crawler import create_db
+
+    path = os.path.join(ctx.tmpdir, name)
+    if os.path.exists(path):
+        os.remove(path)
+    con = sqlite3.connect(path)
+    create_db('tse_price', con)
+    return con
+
+
+## ---------------------------------------------------------------- 解析
+
+@benchmark('parse.tse_legacy', 'rows')
+def parse_tse_legacy(ctx):
+    from bench_parser import legacy_parse_tse
+
+    days = ctx.tse_days()
+    rows = sum(len(legacy_parse_tse(text)) for text, _ in days)
+    return lambda: [legacy_parse_tse(text) for text, _ in days], rows
+
+
+@benchmark('parse.tse', 'rows', legacy='parse.tse_legacy')
+def parse_tse(ctx):
+    from twse_crawler import parse_tse_text
+
+    days = ctx.tse_days()
+    rows = sum(len(parse_tse_text(text)) for text, _ in days)
+    return lambda: [parse_tse_text(text) for text, _ in days], rows
+
+
+@benchmark('parse.tse_batch', 'rows', legacy='parse.tse_legacy')
+def parse_tse_batch(ctx):
+    import parsers
+
+    days = ctx.tse_days()
+    rows = len(parsers.parse_tse_batch(days))
+    return lambda: parsers.parse_tse_batch(days), rows
+
+
+@benchmark('parse.otc_legacy', 'rows')
+def parse_otc_legacy(ctx):
+    from bench_parser import legacy_parse_otc
+
+    days = ctx.otc_days()
+    rows = sum(len(legacy_parse_otc(result, '{:04d}{:02d}{:02d}'.format(*day)))
+               for result, day in days)
+    return lambda: [legacy_parse_otc(result, '{:04d}{:02d}{:02d}'.format(*day))
+                    for result, day in days], rows
+
+
+@benchmark('parse.otc', 'rows', legacy='parse.otc_legacy')
+def parse_otc(ctx):
+    import parsers
+
+    days = ctx.otc_days()
+    rows = sum(len(parsers.parse_otc_json(result, day)) for result, day in days)
+    return lambda: [parsers.parse_otc_json(result, day) for result, day in days], rows
+
+
+@benchmark('parse.otc_batch', 'rows', legacy='parse.otc_legacy')
+def parse_otc_batch(ctx):
+    import parsers
+
+    days = ctx.otc_days()
+    rows = len(parsers.parse_otc_batch(days))
+    return lambda: parsers.parse_otc_batch(days), rows
+
+
+@benchmark('parse.mops_monthly_legacy', 'rows')
+def parse_mops_monthly_legacy(ctx):
+    ## 原 notebook monthly_report 的作法: pd.read_html 讀出全部 table 再合併
+    pages = ctx.mops_monthly()
+
+    def parse(text):
+        tables = [df for df in pd.read_html(io.StringIO(text)) if df.shape[1] in (10, 11)]
+        df = pd.concat(tables).iloc[:, :10]
+        revenue = pd.to_numeric(df.iloc[:, 2].astype(str).str.replace(',', ''), 'coerce')
+        return df[revenue.notna()]
+
+    rows = sum(len(parse(page[0])) for page in pages)
+    return lambda: [parse(page[0]) for page in pages], rows
+
+
+@benchmark('parse.mops_monthly', 'rows', legacy='parse.mops_monthly_legacy')
+def parse_mops_monthly(ctx):
+    from fundamentals import parse_monthly_html
+
+    pages = ctx.mops_monthly()
+    rows = sum(len(parse_monthly_html(*page)) for page in pages)
+    return lambda: [parse_monthly_html(*page) for page in pages], rows
+
+
+@benchmark('parse.mops_statement', 'rows')
+def parse_mops_statement(ctx):
+    from fundamentals import parse_statement_html, statement_to_long
+
+    pages = ctx.mops_statements()
+    rows = sum(len(statement_to_long(parse_statement_html(page), 2018, 1, '綜合損益彙總表'))
+               for page in pages)
+    return lambda: [statement_to_long(parse_statement_html(page), 2018, 1, '綜合損益彙總表')
+                    for page in pages], rows
+
+
+## ---------------------------------------------------------------- 寫入
+
+@benchmark('insert.legacy', 'rows')
+def insert_legacy(ctx):
+    from twse_crawler import insertDataFrameToDb
+
+    ## 逐列寫入太慢, 只取一小段
+    df = ctx.price_frame().iloc[:ctx.n(20000, 1000)]
+
+    def run():
+        con = _sqlite(ctx, 'legacy.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            insertDataFrameToDb(df, con, 'tse_price')
+        con.close()
+    return run, len(df)
+
+
+@benchmark('insert.bulk', 'rows', legacy='insert.legacy')
+def insert_bulk(ctx):
+    from twse_crawler import bulk_insert_df
+
+    df = ctx.price_frame()
+
+    def run():
+        con = _sqlite(ctx, 'bulk.db')
+        bulk_insert_df(df, con, 'tse_price')
+        con.close()
+    return run, len(df)
+
+
+@benchmark('insert.bulk_reload', 'rows', legacy='insert.legacy')
+def insert_bulk_reload(ctx):
+    from twse_crawler import bulk_insert_df
+
+    df = ctx.price_frame()
+    con = _sqlite(ctx, 'reload.db')
+    bulk_insert_df(df, con, 'tse_price')
+    ## 同樣資料再寫一次, 全部為 skipped
+    return lambda: bulk_insert_df(df, con, 'tse_price'), len(df)
+
+
+## ---------------------------------------------------------------- 回測
+
+@benchmark('backtest.init', 'days')
+def backtest_init(ctx):
+    stock = _stock()
+    groups = [(g['收盤價'].to_numpy(), g['yyyymmdd'].to_numpy())
+              for _, g in ctx.panel().groupby('證券代號', sort=True)]
+    return lambda: [stock.StockTradeDays(price, None, dates) for price, dates in groups], \
+        len(ctx.panel())
+
+
+@benchmark('backtest.from_price_frame', 'days', legacy='backtest.init')
+def backtest_from_price_frame(ctx):
+    stock = _stock()
+    panel = ctx.panel()
+    return lambda: stock.StockTradeDays.from_price_frame(panel), len(panel)
+
+
+def _trade_days(ctx):
+    stock = _stock()
+    return ctx.get('trade_days', lambda: stock.StockTradeDays.from_price_frame(ctx.panel()))
+
+
+def _loop_back(ctx, loop_cls, n_stocks):
+    stock = _stock()
+    trade_days = list(_trade_days(ctx).values())[:n_stocks]
+
+    def run():
+        for days in trade_days:
+            loop_cls(days, stock.TradeStrategy2(10, -0.04)).execute_trade()
+    return run, sum(len(days) for days in trade_days)
+
+
+@benchmark('backtest.loop', 'days')
+def backtest_loop(ctx):
+    ## 逐日迴圈只跑部分股票
+    return _loop_back(ctx, _stock().TradeLoopBack, ctx.n(20))
+
+
+@benchmark('backtest.vector', 'days', legacy='backtest.loop')
+def backtest_vector(ctx):
+    return _loop_back(ctx, _stock().VectorTradeLoopBack, len(_trade_days(ctx)))
+
+
+@benchmark('backtest.cross_check', 'days')
+def backtest_cross_check(ctx):
+    stock = _stock()
+    trade_days = list(_trade_days(ctx).values())[:ctx.n(20)]
+    factory = lambda: stock.TradeStrategy2(10, -0.04)
+
+    def run():
+        for days in trade_days:
+            if not stock.cross_check(days, factory):
+                raise AssertionError('TradeLoopBack / VectorTradeLoopBack mismatch')
+    return run, sum(len(days) for days in trade_days)
+
+
+## ---------------------------------------------------------------- 參數掃描
+
+KEEP_STOCK_LIST = range(2, 30, 2)
+BUY_CHANGE_LIST = [e / 100 for e in range(-5, -16, -1)]
+
+
+def _sweep_days(ctx):
+    return dict(list(_trade_days(ctx).items())[:ctx.n(50, 2)])
+
+
+@benchmark('sweep.legacy', 'combos')
+def sweep_legacy(ctx):
+    ## 原本的 itertools.product + calc(), 以逐日 TradeLoopBack 計算, 只跑前幾組
+    stock = _stock()
+    trade_days = _sweep_days(ctx)
+    combos = [(keep, buy) for keep in KEEP_STOCK_LIST for buy in BUY_CHANGE_LIST][:4]
+
+    def run():
+        for keep, buy in combos:
+            for days in trade_days.values():
+                stock.TradeLoopBack(days, stock.TradeStrategy2(keep, buy)).execute_trade()
+    return run, len(combos)
+
+
+@benchmark('sweep.inline', 'combos', legacy='sweep.legacy')
+def sweep_inline(ctx):
+    _stock()
+    from sweep import sweep
+
+    trade_days = _sweep_days(ctx)
+    return lambda: sweep(trade_days, KEEP_STOCK_LIST, BUY_CHANGE_LIST, processes=1), \
+        len(KEEP_STOCK_LIST) * len(BUY_CHANGE_LIST)
+
+
+@benchmark('sweep.pool', 'combos', legacy='sweep.legacy', parallel=True)
+def sweep_pool(ctx):
+    _stock()
+    from sweep import sweep
+
+    trade_days = _sweep_days(ctx)
+    return lambda: sweep(trade_days, KEEP_STOCK_LIST, BUY_CHANGE_LIST), \
+        len(KEEP_STOCK_LIST) * len(BUY_CHANGE_LIST)
+
+
+## ---------------------------------------------------------------- 執行 / 報表
+
+def run_benchmark(name, ctx, repeat):
+    """return dict : unit, items, best, median, rate; 略過時為 {'skipped': 原因}"""
+    spec = BENCHMARKS[name]
+    if spec['parallel'] and _cpus() < 2:
+        return {'skipped': 'parallel benchmark needs more than 1 cpu'}
+    try:
+        func, items = spec['setup'](ctx)
+    except Skip as e:
+        return {'skipped': str(e)}
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {
+        'unit': spec['unit'],
+        'items': int(items),
+        'best': best,
+        'median': float(np.median(times)),
+        'rate': items / best if best > 0 else float('inf'),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def run(names, scale=1.0, repeat=3, cache=None):
+    """執行指定的 benchmark
+    return
+    ======
+    dict : {'meta': 環境資訊, 'results': {name: result}}
+    """
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory() as tmp:
+        ctx = Context(scale, cache, tmp)
+        for name in names:
+            results[name] = run_benchmark(name, ctx, repeat)
+            result = results[name]
+            if 'skipped' in result:
+                print('{:<28} skipped ({})'.format(name, result['skipped']), file=sys.stderr)
+            else:
+                print('{:<28} {:>14,.0f} {}'.format(name, result['rate'], UNITS[result['unit']]),
+                      file=sys.stderr)
+    meta = {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.platform(),
+        'cpus': _cpus(),
+        'scale': scale,
+        'repeat': repeat,
+        'recorded': bool(cache),
+    }
+    return {'meta': meta, 'results': results}
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf8') as f:
+        return json.load(f)
+
+
+def incomparable(current, baseline, parallel=False):
+    """current 與 baseline 不能直接比較的原因, 可比較回傳 None
+    資料量 (scale) 或資料來源 (recorded) 不同時 rate 沒有意義; 平行的項目另需 CPU 數相同
+    """
+    keys = ('scale', 'recorded') + (('cpus',) if parallel else ())
+    meta, base_meta = current.get('meta', {}), baseline.get('meta', {})
+    for key in keys:
+        if meta.get(key) != base_meta.get(key):
+            return '{} {} vs baseline {}'.format(key, meta.get(key), base_meta.get(key))
+    return None
+
+
+def compare(current, baseline=None, tolerance=0.2):
+    """本次結果與 baseline 比較
+    params
+    ======
+    current, baseline : run() 的結果
+    tolerance : 比 baseline 慢超過此比例視為 regression
+
+    return
+    ======
+    dataframe (benchmark, unit, rate, baseline, change, vs legacy, status)
+        不能比較的項目 (見 incomparable) status 為 'not compared: 原因'
+    """
+    rows = []
+    base_results = (baseline or {}).get('results', {})
+    for name, result in current['results'].items():
+        if 'skipped' in result:
+            rows.append({'benchmark': name, 'status': 'skipped'})
+            continue
+        row = {'benchmark': name, 'unit': UNITS[result['unit']], 'rate': result['rate']}
+        base = base_results.get(name, {})
+        reason = incomparable(current, baseline, BENCHMARKS[name]['parallel']) \
+            if 'rate' in base else None
+        if reason:
+            row['status'] = 'not compared: {}'.format(reason)
+        elif 'rate' in base:
+            row['baseline'] = base['rate']
+            row['change'] = result['rate'] / base['rate'] - 1
+            row['status'] = 'REGRESSION' if row['change'] < -tolerance else 'ok'
+        else:
+            row['status'] = 'new'
+        legacy = BENCHMARKS[name]['legacy']
+        if legacy and 'rate' in current['results'].get(legacy, {}):
+            row['vs legacy'] = result['rate'] / current['results'][legacy]['rate']
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['benchmark', 'unit', 'rate', 'baseline', 'change',
+                                       'vs legacy', 'status'])
+
+
+def format_report(report, baseline=None):
+    lines = []
+    if baseline is not None:
+        meta = baseline['meta']
+        lines.append('baseline: {} (commit {}, scale {})'.format(
+            meta.get('created_at'), meta.get('commit') or '?', meta.get('scale')))
+    lines.append('{:<28}{:>12}{:>16}{:>16}{:>9}{:>11}  {}'.format(
+        'benchmark', 'unit', 'rate', 'baseline', 'change', 'vs legacy', 'status'))
+    fmt = lambda value, spec: '' if pd.isna(value) else spec.format(value)
+    for row in report.to_dict('records'):
+        lines.append('{:<28}{:>12}{:>16}{:>16}{:>9}{:>11}  {}'.format(
+            row['benchmark'], fmt(row['unit'], '{}'), fmt(row['rate'], '{:,.0f}'),
+            fmt(row['baseline'], '{:,.0f}'), fmt(row['change'], '{:+.1%}'),
+            fmt(row['vs legacy'], '{:.1f}x'), row['status']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', action='append', default=[],
+                        help='只執行名稱包含此字串的項目 (可重複)')
+    parser.add_argument('--list', action='store_true', help='列出所有項目')
+    parser.add_argument('--scale', type=float, default=1.0, help='資料量倍數')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cache', help='RawCache 目錄, 解析改用錄下的回應')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='以本次結果更新 baseline (只取代有執行的項目)')
+    parser.add_argument('--output', help='本次結果另存 json')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, spec in BENCHMARKS.items():
+            print('{:<28} {:<12} {}'.format(name, UNITS[spec['unit']], spec['legacy'] or ''))
+        return
+    names = [name for name in BENCHMARKS if not args.k or any(k in name for k in args.k)]
+    current = run(names, args.scale, args.repeat, args.cache)
+    baseline = load_baseline(args.baseline)
+    report = compare(current, baseline, args.tolerance)
+    print(format_report(report, baseline))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        ## 資料量不同的舊結果不能放在同一份 baseline; CPU 數不同時舊的平行項目也丟掉
+        merged = {'results': {}}
+        if baseline is not None and not incomparable(current, baseline):
+            merged = baseline
+            if incomparable(current, baseline, parallel=True):
+                for name in [name for name in merged['results']
+                             if name in BENCHMARKS and BENCHMARKS[name]['parallel']]:
+                    del merged['results'][name]
+        merged['meta'] = current['meta']
+        merged['results'].update((name, result) for name, result in current['results'].items()
+                                 if 'skipped' not in result)
+        with open(args.baseline, 'w', encoding='utf8') as f:
+            json.dump(merged, f, ensure_ascii=False, indent=2)
+        print('baseline saved to {}'.format(args.baseline))
+    if args.fail_on_regression and (report['status'] == 'REGRESSION').any():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+#! encoding = utf8
+"""除權息 / 增減資 還原股價
+
+- 事件 (adjust_event) : 除權息(恢復買賣)日, 前收盤, 參考價
+  來源: TWSE 除權除息計算結果表 (TWT49U), 或由股價跳空超過漲跌幅限制偵測 (減資/分割),
+  其他來源 (e.g. 上櫃) 整理成同樣欄位後以 AdjustmentStore.add_events 寫入
+- 因子 (adjust_factor) : factor = 參考價 / 前收盤, cum_factor 為該股由第一個事件起的累積乘積
+  (cumprod), 新事件只重算有新事件的股票
+- 還原 (向前還原, 最新價格不變) :
+      還原價(t) = 原始價(t) * cum_factor(最後一個事件) / cum_factor(t 當天或之前最後一個事件)
+  以 point_in_time.AsofIndex 對全部列一次二分搜尋算出, 不需要每次回測重算整個市場
+"""
+import datetime
+import json
+import logging
+import re
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import requests
+
+import raw_cache
+
+TWSE_EVENT_URL = 'http://www.twse.com.tw/exchangeReport/TWT49U'
+PRICE_COLUMNS = ('開盤價', '最高價', '最低價', '收盤價')
+EVENT_COLUMNS = ['證券代號', 'yyyymmdd', '前收盤', '參考價', '類型', '來源']
+## 漲跌幅限制: 2015/6/1 起 10%, 之前 7%
+PRICE_LIMIT = 0.1
+OLD_PRICE_LIMIT = 0.07
+PRICE_LIMIT_CHANGED = 20150601
+DEFAULT_START = (2004, 2)
+## 查無事件的月份 stat 為此訊息 (不是 OK)
+NO_DATA_MARKERS = ('沒有符合條件的資料',)
+
+_ROC_DATE = re.compile(r'(\d+)\D+(\d+)\D+(\d+)')
+
+
+def _roc_to_yyyymmdd(text):
+    """'107年07月02日' / '107/07/02' --> 20180702"""
+    match = _ROC_DATE.search(str(text))
+    if match is None:
+        return None
+    year, month, day = (int(x) for x in match.groups())
+    year = year + 1911 if year < 1900 else year
+    return year * 10000 + month * 100 + day
+
+
+def has_twse_events(content, final=False):
+    """TWT49U 回應是否完整, 可寫入快取
+    json 且 stat 為 OK 並有資料; 查無資料的回應只在月份已定案 (final) 時接受,
+    擋爬頁面 / 錯誤訊息 / 空白回應一律不寫入
+    """
+    try:
+        result = json.loads(content)
+    except ValueError:
+        return False
+    if not isinstance(result, dict):
+        return False
+    stat = str(result.get('stat'))
+    if stat == 'OK' and result.get('data'):
+        return True
+    return final and (stat == 'OK' or any(marker in stat for marker in NO_DATA_MARKERS))
+
+
+def fetch_twse_events_raw(year, month, session=None, cache=None):
+    """下載一個月的 TWT49U 除權除息計算結果 json
+    params
+    ======
+    year, month : (int)
+        西元年, 月
+    session : FetchEngine or requests.Session
+    cache : RawCache
+        未指定則使用 session.cache (若有)
+    """
+    session = requests if session is None else session
+    cache = getattr(session, 'cache', None) if cache is None else cache
+    first = datetime.date(year, month, 1)
+    last = (first + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+    params = {'response': 'json', 'strDate': first.strftime('%Y%m%d'),
+              'endDate': last.strftime('%Y%m%d')}
+
+    def download():
+        content = session.get(TWSE_EVENT_URL, params=params).content
+        ## 擋爬時回傳 html 頁面: 當作下載失敗 (FetchSummary.errors), 不當作沒有事件
+        if not content.lstrip().startswith(b'{'):
+            raise requests.HTTPError('unexpected TWT49U response for {}-{:02d}: {!r}'.format(
+                year, month, content[:80]))
+        return content
+
+    if cache is None:
+        content = download()
+    else:
+        immutable, ttl = raw_cache.monthly_policy(year, month)
+        content = cache.fetch('twse_twt49u', {'year': year, 'month': month},
+                              download, immutable, ttl,
+                              lambda content: has_twse_events(content, immutable))
+    return content.decode('utf8', errors='replace')
+
+
+def parse_twse_events(text):
+    """解析 TWT49U json
+    return
+    ======
+    dataframe (EVENT_COLUMNS), 無資料回傳 None
+    """
+    result = json.loads(text) if isinstance(text, (str, bytes)) else text
+    if result.get('stat') != 'OK' or not result.get('data'):
+        return None
+    fields = result['fields']
+    df = pd.DataFrame([row[:len(fields)] for row in result['data']], columns=fields)
+    number = lambda col: pd.to_numeric(df[col].astype(str).str.replace(',', '', regex=False),
+                                       errors='coerce')
+    events = pd.DataFrame({
+        '證券代號': df['股票代號'].astype(str).str.strip(),
+        'yyyymmdd': df['資料日期'].map(_roc_to_yyyymmdd),
+        '前收盤': number('除權息前收盤價'),
+        '參考價': number('除權息參考價'),
+        '類型': df['權/息'].astype(str).str.strip(),
+        '來源': 'twse',
+    })
+    events = events.dropna(subset=['yyyymmdd', '前收盤', '參考價'])
+    events = events[(events['前收盤'] > 0) & (events['參考價'] > 0)]
+    events['yyyymmdd'] = events['yyyymmdd'].astype(np.int64)
+    return events.reset_index(drop=True)
+
+
+def get_twse_events(months, engine=None, summary=None):
+    """並行抓取多個月份的除權息事件
+    params
+    ======
+    months : list of (year, month)
+    summary : FetchSummary
+        key 為 (year, month)
+    """
+    from fetch_engine import FetchEngine
+
+    engine = FetchEngine(max_workers=2, rate=0.5) if engine is None else engine
+
+    def fetch(engine, key):
+        return fetch_twse_events_raw(*key, session=engine)
+
+    def parse(text, key):
+        return parse_twse_events(text)
+
+    frames = [df for _, df in engine.iter_fetch(months, fetch, parse, summary)]
+    if not frames:
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def detect_events(prices, limit=None, tolerance=0.005):
+    """由股價偵測超過漲跌幅限制的跳空 (減資 / 分割 / 大額股票股利等)
+    一般現金股利的跌幅在漲跌幅內無法由股價判斷, 需以 TWT49U 等事件來源寫入
+    params
+    ======
+    prices : dataframe
+        證券代號, yyyymmdd, 收盤價 (有 開盤價 則以開盤價估計參考價)
+    limit : (float)
+        漲跌幅限制, None 則依日期使用 7% / 10%
+
+    return
+    ======
+    dataframe (EVENT_COLUMNS), 來源為 detected
+    """
+    from price_store import yyyymmdd_series
+
+    df = prices.assign(yyyymmdd=yyyymmdd_series(prices['yyyymmdd']).astype(np.int64),
+                       證券代號=prices['證券代號'].astype(str))
+    df = df.sort_values(['證券代號', 'yyyymmdd'])
+    close = df['收盤價'].to_numpy(dtype=np.float64)
+    codes = df['證券代號'].to_numpy()
+    dates = df['yyyymmdd'].to_numpy()
+    if len(df) < 2:
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+    prev_close = np.r_[np.nan, close[:-1]]
+    prev_close[np.r_[True, codes[1:] != codes[:-1]]] = np.nan
+    if '開盤價' in df.columns:
+        reference = df['開盤價'].to_numpy(dtype=np.float64)
+        reference = np.where(np.isfinite(reference) & (reference > 0), reference, close)
+    else:
+        reference = close
+    if limit is None:
+        limit = np.where(dates >= PRICE_LIMIT_CHANGED, PRICE_LIMIT, OLD_PRICE_LIMIT)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        change = close / prev_close - 1
+        jump = np.abs(change) > limit + tolerance
+    jump &= np.isfinite(prev_close) & (prev_close > 0) & np.isfinite(reference)
+    events = pd.DataFrame({
+        '證券代號': codes[jump],
+        'yyyymmdd': dates[jump],
+        '前收盤': prev_close[jump],
+        '參考價': reference[jump],
+        '類型': np.where(change[jump] > 0, '減資', '權'),
+        '來源': 'detected',
+    })
+    return events.reset_index(drop=True)
+
+
+def compute_factors(events):
+    """事件 --> 因子 (證券代號, yyyymmdd, factor, cum_factor), 每檔股票依日期 cumprod"""
+    df = events[['證券代號', 'yyyymmdd', '前收盤', '參考價']].copy()
+    df['yyyymmdd'] = df['yyyymmdd'].astype(np.int64)
+    df = df.sort_values(['證券代號', 'yyyymmdd']).reset_index(drop=True)
+    df['factor'] = df['參考價'] / df['前收盤']
+    df['cum_factor'] = df.groupby('證券代號', sort=False)['factor'].cumprod()
+    return df[['證券代號', 'yyyymmdd', 'factor', 'cum_factor']]
+
+
+class AdjustmentStore:
+    """adjust_event / adjust_factor 資料表與還原計算
+    params
+    ======
+    con : sqlite3 connection
+    """
+
+    def __init__(self, con):
+        from twse_crawler import create_db
+
+        self.con = con
+        for tablename in ('adjust_event', 'adjust_factor'):
+            create_db(tablename, con)
+        self._factors = None
+
+    def add_events(self, events, overwrite=True):
+        """寫入事件並重算有新事件股票的累積因子
+        params
+        ======
+        events : dataframe (EVENT_COLUMNS)
+        overwrite : (bool)
+            False 則已存在的 (證券代號, yyyymmdd) 不覆寫 (偵測結果不蓋掉公告資料)
+
+        return
+        ======
+        dict : bulk_insert_df 的寫入統計, codes (重算的股票數)
+        """
+        from twse_crawler import bulk_insert_df
+
+        if events is None or len(events) == 0:
+            return {'inserted': 0, 'updated': 0, 'skipped': 0, 'codes': 0}
+        events = events.assign(證券代號=events['證券代號'].astype(str),
+                               yyyymmdd=events['yyyymmdd'].astype(np.int64))
+        loaded = bulk_insert_df(events, self.con, 'adjust_event', upsert=overwrite)
+        codes = sorted(set(events['證券代號']))
+        ## 只重算有事件的股票, 事件數很少, 整檔 cumprod 即可
+        stored = self._read('adjust_event', codes)
+        factors = compute_factors(stored)
+        bulk_insert_df(factors, self.con, 'adjust_factor')
+        self._factors = None
+        logging.info('adjust events {}, {} codes refreshed'.format(loaded, len(codes)))
+        return dict(loaded, codes=len(codes))
+
+    def _read(self, tablename, codes=None):
+        if codes is None:
+            df = pd.read_sql_query('SELECT * FROM {}'.format(tablename), self.con)
+        else:
+            ## sqlite 參數數量有上限, 分批查詢
+            frames = [pd.read_sql_query(
+                'SELECT * FROM {} WHERE 證券代號 IN ({})'.format(
+                    tablename, ','.join('?' * len(codes[i:i + 500]))),
+                self.con, params=codes[i:i + 500]) for i in range(0, len(codes), 500)]
+            df = pd.concat(frames, ignore_index=True)
+        df['證券代號'] = df['證券代號'].astype(str)
+        df['yyyymmdd'] = df['yyyymmdd'].astype(np.int64)
+        return df
+
+    def factors(self):
+        """全部因子 (證券代號, yyyymmdd 排序), 讀一次後留在記憶體直到有新事件"""
+        if self._factors is None:
+            df = self._read('adjust_factor')
+            self._factors = df.sort_values(['證券代號', 'yyyymmdd']).reset_index(drop=True)
+        return self._factors
+
+    def ratio(self, codes, dates):
+        """每一列 (代號, 日期) 的還原乘數
+        params
+        ======
+        codes : array of str
+        dates : array of int yyyymmdd
+
+        return
+        ======
+        ndarray, 沒有事件的股票/最後一個事件之後為 1
+        """
+        from point_in_time import AsofIndex
+
+        factors = self.factors()
+        if not len(factors):
+            return np.ones(len(codes))
+        index = AsofIndex(np.asarray(codes).astype(str), dates)
+        cum = factors['cum_factor'].to_numpy(dtype=np.float64)
+        rows = index.lookup(factors['證券代號'].to_numpy(), factors['yyyymmdd'].to_numpy())
+        current = np.where(rows >= 0, cum[np.maximum(rows, 0)], 1.0)
+        last = factors.groupby('證券代號', sort=False)['cum_factor'].last()
+        total = last.reindex(index.categories).to_numpy(dtype=np.float64)[index.ids]
+        return np.where(np.isnan(total), 1.0, total) / current
+
+    def adjust(self, df, columns=PRICE_COLUMNS, code_col='證券代號', date_col='yyyymmdd'):
+        """long format 股價 --> 還原股價 (只調整 columns 中存在的欄位, 其餘欄位不變)"""
+        from price_store import yyyymmdd_series
+
+        ratio = self.ratio(df[code_col].astype(str).to_numpy(),
+                           yyyymmdd_series(df[date_col]).to_numpy(dtype=np.int64))
+        adjusted = {col: df[col].to_numpy(dtype=np.float64) * ratio
+                    for col in columns if col in df.columns}
+        return df.assign(**adjusted)
+
+    def adjusted_prices(self, code, start=None, end=None, columns=PRICE_COLUMNS,
+                        tables=('tse_price', 'otc_price')):
+        """單一股票的還原 OHLC
+        return
+        ======
+        dict {'yyyymmdd': int array, 欄位: float array}
+        """
+        from trading_calendar import to_yyyymmdd
+
+        where, args = ['證券代號 = ?'], [str(code)]
+        if start is not None:
+            where.append('yyyymmdd >= ?')
+            args.append(to_yyyymmdd(start))
+        if end is not None:
+            where.append('yyyymmdd <= ?')
+            args.append(to_yyyymmdd(end))
+        frames = []
+        for table in tables:
+            existing = [row[1] for row in self.con.execute('PRAGMA table_info({})'.format(table))]
+            if not existing:
+                continue
+            cols = ', '.join('"{}"'.format(c) for c in columns if c in existing)
+            sql = 'SELECT 證券代號, yyyymmdd{} FROM {} WHERE {}'.format(
+                ', ' + cols if cols else '', table, ' AND '.join(where))
+            frames.append(pd.read_sql_query(sql, self.con, params=args))
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+            columns=['證券代號', 'yyyymmdd'])
+        df['yyyymmdd'] = df['yyyymmdd'].astype(np.int64)
+        df = self.adjust(df.sort_values('yyyymmdd'), columns)
+        out = {'yyyymmdd': df['yyyymmdd'].to_numpy()}
+        out.update((col, df[col].to_numpy(dtype=np.float64)) for col in columns if col in df)
+        return out
+
+
+def _months(start, end):
+    year, month = start
+    while (year, month) <= end:
+        yield year, month
+        year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+
+
+def sync_adjustments(con, engine=None, start=None, today=None, detect=True,
+                     tables=('tse_price', 'otc_price')):
+    """增量更新除權息事件與因子
+    - TWT49U 由資料表最後一個 twse 事件的月份 (或 DEFAULT_START) 抓到本月
+    - detect=True 時同一段期間的股價跳空也寫入 (不覆寫公告的事件)
+    params
+    ======
+    start : (year, month)
+        指定起始月份
+
+    return
+    ======
+    dict : {'twse': 寫入統計, 'detected': 寫入統計, 'errors': 下載失敗的月份}
+    """
+    from fetch_engine import FetchSummary
+
+    store = AdjustmentStore(con)
+    today = datetime.date.today() if today is None else today
+    if start is None:
+        last = con.execute("SELECT MAX(yyyymmdd) FROM adjust_event WHERE 來源 = 'twse'").fetchone()[0]
+        start = DEFAULT_START if last is None else (int(last) // 10000, int(last) // 100 % 100)
+    months = list(_months(start, (today.year, today.month)))
+    summary = FetchSummary()
+    report = {'twse': store.add_events(get_twse_events(months, engine, summary))}
+    if detect:
+        since = start[0] * 10000 + start[1] * 100 + 1
+        frames = []
+        for table in tables:
+            try:
+                frames.append(pd.read_sql_query(
+                    'SELECT 證券代號, yyyymmdd, 開盤價, 收盤價 FROM {} WHERE yyyymmdd >= ?'.format(
+                        table), con, params=[since]))
+            except (sqlite3.OperationalError, pd.errors.DatabaseError):
+                continue
+        prices = pd.concat(frames, ignore_index=True) if frames else None
+        detected = detect_events(prices) if prices is not None and len(prices) else None
+        report['detected'] = store.add_events(detected, overwrite=False)
+    report['errors'] = [list(key) for key in summary.errors]
+    logging.info('sync adjustments: {}'.format(report))
+    return report
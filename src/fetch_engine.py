@@ -0,0 +1,242 @@
+#! encoding = utf8
+"""並行下載引擎
+
+- 共用 requests.Session (connection reuse)
+- ThreadPoolExecutor 限制同時連線數
+- 每個 host 各自一個 token bucket 限速
+- 失敗重試 (exponential backoff)
+- 結果依完成順序串流給 parser, 假日/錯誤記錄在 FetchSummary
+"""
+import logging
+import threading
+import time
+import itertools
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """token bucket 限速器
+    params
+    ======
+    rate : (float)
+        每秒補充的 token 數 (平均每秒請求數)
+    capacity : (int)
+        最多可累積的 token 數 (允許的瞬間 burst)
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取得一個 token, 不足時 sleep 到補滿為止"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class FetchSummary:
+    """一次下載的結果統計 (取代逐日 print)"""
+
+    def __init__(self):
+        self.trading_days = []
+        self.holidays = []
+        self.errors = {}
+        self.retries = 0
+        self.elapsed = 0.0
+
+    def merge(self, other):
+        """合併另一次下載的統計"""
+        self.trading_days.extend(other.trading_days)
+        self.holidays.extend(other.holidays)
+        self.errors.update(other.errors)
+        self.retries += other.retries
+        self.elapsed += other.elapsed
+
+    def as_dict(self):
+        return {
+            'trading_days': sorted(self.trading_days),
+            'holidays': sorted(self.holidays),
+            'errors': dict(sorted(self.errors.items())),
+            'retries': self.retries,
+            'elapsed': round(self.elapsed, 3),
+        }
+
+    def __str__(self):
+        return 'trading days:{} holidays:{} errors:{} retries:{} ({:.1f}s)'.format(
+            len(self.trading_days), len(self.holidays), len(self.errors),
+            self.retries, self.elapsed)
+
+    __repr__ = __str__
+
+
+class FetchEngine:
+    """並行下載
+    params
+    ======
+    max_workers : (int)
+        同時下載的數量
+    rate : (float)
+        每個 host 每秒最多幾個請求
+    burst : (int)
+        token bucket 容量
+    retries : (int)
+        失敗重試次數
+    backoff : (float)
+        第 n 次重試前等待 backoff * 2**n 秒
+    timeout : (float)
+        單一請求 timeout 秒數
+    session : requests.Session
+        可自行傳入 (e.g. 設定 proxy), 預設建立一個共用 session
+    cache : RawCache
+        原始回應快取, 爬蟲的 fetch_*_raw 會優先讀取
+    """
+
+    def __init__(self, max_workers=4, rate=2.0, burst=1, retries=3, backoff=1.0,
+                 timeout=30, session=None, cache=None):
+        self.max_workers = max_workers
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=max_workers,
+                                  pool_maxsize=max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self.cache = cache
+        self._buckets = {}
+        self._lock = threading.Lock()
+        ## iter_fetch 的 worker thread 所屬的 FetchSummary (重試次數記在各自的 summary)
+        self._local = threading.local()
+
+    def _bucket(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+            return self._buckets[host]
+
+    def request(self, method, url, **kwargs):
+        """限速 + 重試的 HTTP 請求, 重試用盡仍失敗則 raise"""
+        kwargs.setdefault('timeout', self.timeout)
+        bucket = self._bucket(url)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                with metrics.timer('fetch.request'):
+                    response = self.session.request(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    metrics.inc('fetch.bytes', len(response.content))
+                    return response
+                error = requests.HTTPError(
+                    '{} for url {}'.format(response.status_code, url),
+                    response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt >= self.retries:
+                raise error
+            wait = self.backoff * 2 ** attempt
+            attempt += 1
+            metrics.inc('fetch.retries')
+            summary = getattr(self._local, 'summary', None)
+            if summary is not None:
+                with self._lock:
+                    summary.retries += 1
+            logging.warning('retry {} {} in {:.1f}s: {}'.format(attempt, url, wait, error))
+            time.sleep(wait)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def iter_fetch(self, keys, fetch, parse, summary=None, max_pending=None):
+        """並行下載 keys, 依完成順序 yield (key, parse 結果)
+        params
+        ======
+        keys : iterable
+            e.g. 日期序列
+        fetch : callable(engine, key)
+            下載原始資料
+        parse : callable(raw, key)
+            解析原始資料, 回傳 None 代表無資料 (假日)
+        summary : FetchSummary
+            假日與錯誤記錄於此, 不會 yield
+        max_pending : (int)
+            同時送出但尚未取回的 key 數上限, None 代表一次全部送出;
+            串流大量日期時設定, 下載好但還沒處理的原始資料不會越積越多
+        """
+        if summary is None:
+            summary = FetchSummary()
+        start = time.perf_counter()
+        keys = iter(keys)
+
+        def work(key):
+            self._local.summary = summary
+            try:
+                return fetch(self, key)
+            finally:
+                self._local.summary = None
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = {}
+        try:
+            def submit():
+                n = None if max_pending is None else max(max_pending - len(futures), 0)
+                for key in itertools.islice(keys, n):
+                    futures[executor.submit(work, key)] = key
+
+            submit()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = futures.pop(future)
+                    try:
+                        raw = future.result()
+                        with metrics.timer('fetch.parse'):
+                            data = parse(raw, key)
+                    except Exception as e:
+                        logging.error('fetch {} failed: {!r}'.format(key, e))
+                        summary.errors[key] = repr(e)
+                        metrics.inc('fetch.errors')
+                        continue
+                    if data is None:
+                        summary.holidays.append(key)
+                        metrics.inc('fetch.holidays')
+                        continue
+                    summary.trading_days.append(key)
+                    metrics.inc('fetch.trading_days')
+                    yield key, data
+                submit()
+        finally:
+            ## 呼叫端提早結束 (break / close / 例外) 時, 還沒開始的下載直接取消
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            summary.elapsed += time.perf_counter() - start
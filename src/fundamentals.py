@@ -0,0 +1,478 @@
+#! encoding = utf8
+"""公開資訊觀測站 (MOPS) 月營收 / 季報
+
+- 月營收 : t21sc03 每月營業收入統計彙總表 --> monthly_revenue
+- 季報 : ajax_t163sb04/05/06 綜合損益 / 資產負債 / 營益分析彙總表
+         --> financial_statement (長表, 各產業欄位不同)
+(年, 月/季, 上市/上櫃) 透過 FetchEngine 並行下載, 原始 html 存在 RawCache,
+以 lxml 直接取出 <tr> 的文字, 不經過 pd.read_html
+
+公布期限 (basic_knowledge.md):
+- 月營收 : 次月 10 日前
+- 季報 : Q1 5/15, Q2 8/14, Q3 11/14, 年報 隔年 3/31 (金控/保險較晚)
+增量模式只抓資料表沒有的期別, 以及仍在公布期間內(可能還有公司補申報)的期別
+"""
+import datetime
+import logging
+import re
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import requests
+
+import raw_cache
+
+MONTHLY_URL = 'http://mops.twse.com.tw/nas/t21/{typek}/t21sc03_{year}_{month}_0.html'
+STATEMENT_URLS = {
+    '綜合損益彙總表': 'http://mops.twse.com.tw/mops/web/ajax_t163sb04',
+    '資產負債彙總表': 'http://mops.twse.com.tw/mops/web/ajax_t163sb05',
+    '營益分析彙總表': 'http://mops.twse.com.tw/mops/web/ajax_t163sb06',
+}
+TYPEK = {
+    'sii': '上市',
+    'otc': '上櫃',
+}
+MONTHLY_COLUMNS = ['公司代號', '公司名稱', '當月營收', '上月營收', '去年當月營收',
+                   '上月比較增減(%)', '去年同月增減(%)', '當月累計營收', '去年累計營收',
+                   '前期比較增減(%)']
+## IFRS 彙總表從 2013 年開始
+DEFAULT_MONTH_START = (2013, 1)
+DEFAULT_SEASON_START = (2013, 1)
+## 被 MOPS 擋下時回傳的頁面, 不能寫進快取
+THROTTLE_MARKERS = ('查詢過於頻繁', 'Overrun', 'FOR SECURITY REASONS')
+## 該期別確實沒有資料的頁面, 可以寫進快取
+NO_DATA_MARKERS = ('查無資料', '查無所需資料')
+NA_VALUES = ('', '--', '---', '不適用', 'N/A')
+
+_CODE = re.compile(r'^[0-9A-Z]{4,6}$')
+
+
+def _roc_year(year):
+    return year - 1911 if year > 1900 else year
+
+
+def _ad_year(year):
+    return year + 1911 if year < 1900 else year
+
+
+def season_end(year, season):
+    """季末日 --> 整數 yyyymmdd, e.g. (2018, 1) --> 20180331"""
+    year = _ad_year(year)
+    return year * 10000 + {1: 331, 2: 630, 3: 930, 4: 1231}[int(season)]
+
+
+def month_key(year, month):
+    """月營收的 yyyymmdd (沿用 notebook: 資料月份的 10 日)"""
+    return _ad_year(year) * 10000 + int(month) * 100 + 10
+
+
+def month_periods(start, end):
+    """(year, month) ~ (year, month) 的所有月份 (含)"""
+    year, month = start
+    periods = []
+    while (year, month) <= tuple(end):
+        periods.append((year, month))
+        year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+    return periods
+
+
+def season_periods(start, end):
+    """(year, season) ~ (year, season) 的所有季 (含)"""
+    year, season = start
+    periods = []
+    while (year, season) <= tuple(end):
+        periods.append((year, season))
+        year, season = (year, season + 1) if season < 4 else (year + 1, 1)
+    return periods
+
+
+def _months_before(period, n):
+    index = period[0] * 12 + period[1] - 1 - n
+    return index // 12, index % 12 + 1
+
+
+def _check_throttle(content):
+    head = ''.join(content[:4096].decode(encoding, errors='ignore')
+                   for encoding in ('utf8', 'cp950'))
+    if any(marker in head for marker in THROTTLE_MARKERS):
+        raise requests.HTTPError('throttled by MOPS')
+    return content
+
+
+def _complete(text, parse):
+    """回應是否完整: 解析得到資料列, 或明確寫著查無資料
+    空白 / 維護 / 沒有資料列的頁面不寫進快取 (定案的期別一旦寫入就不會再下載)
+    """
+    return any(marker in text for marker in NO_DATA_MARKERS) or parse(text) is not None
+
+
+def fetch_monthly_raw(year, month, typek='sii', session=None, cache=None):
+    """下載月營收彙總表 html
+    params
+    ======
+    year : (int)
+        民國年 / 西元年
+    month : (int)
+        1,2,...,12
+    typek : (str)
+        sii -- 上市, otc -- 上櫃
+    session : FetchEngine or requests.Session
+    cache : RawCache
+        未指定則使用 session.cache (若有)
+    """
+    session = requests if session is None else session
+    cache = getattr(session, 'cache', None) if cache is None else cache
+    url = MONTHLY_URL.format(typek=typek, year=_roc_year(year), month=int(month))
+
+    def download():
+        return _check_throttle(session.get(url).content)
+
+    def validate(content):
+        return _complete(content.decode('cp950', errors='replace'),
+                         lambda text: parse_monthly_html(text, year, month, typek))
+
+    if cache is None:
+        content = download()
+    else:
+        immutable, ttl = raw_cache.monthly_policy(_ad_year(year), int(month))
+        content = cache.fetch('mops_monthly_revenue',
+                              {'typek': typek, 'year': _ad_year(year), 'month': int(month)},
+                              download, immutable, ttl, validate)
+    return content.decode('cp950', errors='replace')
+
+
+def fetch_statement_raw(year, season, report='綜合損益彙總表', typek='sii', session=None,
+                        cache=None):
+    """下載季報彙總表 html
+    params
+    ======
+    year : (int)
+        民國年 / 西元年
+    season : (int)
+        1,2,3,4
+    report : (str)
+        綜合損益彙總表 / 資產負債彙總表 / 營益分析彙總表
+    """
+    if report not in STATEMENT_URLS:
+        raise ValueError('report must be one of {}'.format(list(STATEMENT_URLS)))
+    session = requests if session is None else session
+    cache = getattr(session, 'cache', None) if cache is None else cache
+    data = {
+        'encodeURIComponent': 1,
+        'step': 1,
+        'firstin': 1,
+        'off': 1,
+        'TYPEK': typek,
+        'year': str(_roc_year(year)),
+        'season': str(season),
+    }
+
+    def download():
+        return _check_throttle(session.post(STATEMENT_URLS[report], data=data).content)
+
+    def validate(content):
+        return _complete(content.decode('utf8', errors='replace'), parse_statement_html)
+
+    if cache is None:
+        content = download()
+    else:
+        immutable, ttl = raw_cache.seasonal_policy(_ad_year(year), season)
+        content = cache.fetch('mops_statement',
+                              {'report': report, 'typek': typek, 'year': _ad_year(year),
+                               'season': int(season)},
+                              download, immutable, ttl, validate)
+    return content.decode('utf8', errors='replace')
+
+
+def _html_rows(text):
+    """所有 <tr> --> (是否為表頭, 各格文字)"""
+    import lxml.html
+
+    if not text.strip():
+        return []
+    doc = lxml.html.fromstring(text)
+    rows = []
+    for tr in doc.iter('tr'):
+        cells = [cell for cell in tr if cell.tag in ('td', 'th')]
+        if cells:
+            rows.append((cells[0].tag == 'th',
+                         [' '.join(cell.text_content().split()) for cell in cells]))
+    return rows
+
+
+def _to_numeric(df, columns):
+    ## 整欄去除千分位後轉數值, 不適用/-- 等為 NaN
+    for col in columns:
+        text = df[col].astype(str).str.replace(',', '', regex=False).str.strip()
+        df[col] = pd.to_numeric(text.where(~text.isin(NA_VALUES)), errors='coerce')
+
+
+def parse_monthly_html(text, year, month, typek='sii'):
+    """解析月營收彙總表
+    return
+    ======
+    dataframe (欄位同 monthly_revenue), 無資料回傳 None
+    """
+    rows = [cells[:10] for is_head, cells in _html_rows(text)
+            if not is_head and len(cells) in (10, 11) and _CODE.match(cells[0])]
+    if not rows:
+        return None
+    df = pd.DataFrame(rows, columns=MONTHLY_COLUMNS)
+    _to_numeric(df, MONTHLY_COLUMNS[2:])
+    df = df[df['當月營收'].notna()].drop_duplicates('公司代號', keep='last')
+    df.insert(1, 'yyyymmdd', month_key(year, month))
+    df['上市櫃'] = TYPEK[typek]
+    return df.reset_index(drop=True)
+
+
+def parse_statement_html(text):
+    """解析季報彙總表 (各產業一個 table, 欄位不同)
+    return
+    ======
+    dataframe (公司代號, 公司名稱, 各項目), 欄位取聯集, 無資料回傳 None
+    """
+    frames = []
+    header = None
+    records = []
+
+    def flush():
+        if header and records:
+            frames.append(pd.DataFrame(records, columns=header))
+
+    for is_head, cells in _html_rows(text):
+        if is_head:
+            if cells and cells[0] == '公司代號':
+                if cells != header:
+                    flush()
+                    header, records = cells, []
+            continue
+        if header and len(cells) == len(header) and _CODE.match(cells[0]):
+            records.append(cells)
+    flush()
+    if not frames:
+        return None
+    df = pd.concat(frames, ignore_index=True, sort=False)
+    _to_numeric(df, [col for col in df.columns if col not in ('公司代號', '公司名稱')])
+    return df.drop_duplicates('公司代號', keep='last').reset_index(drop=True)
+
+
+def statement_to_long(df, year, season, report, typek='sii'):
+    """季報 --> financial_statement 長表格式"""
+    long = df.drop(columns=['公司名稱'], errors='ignore').melt(
+        id_vars='公司代號', var_name='項目', value_name='值').dropna(subset=['值'])
+    long.insert(1, 'yyyymmdd', season_end(year, season))
+    long.insert(2, '報表', report)
+    long['上市櫃'] = TYPEK[typek]
+    return long.reset_index(drop=True)
+
+
+def monthly_report(year, month, typeK='sii'):
+    """公司每月營收 (單一月份)
+    year : (int)
+        民國年 / 西元年
+    month : (int)
+        1,2,...,12
+    typeK : (str)
+        sii -- 上市, otc -- 上櫃
+    ====
+    return : df, 無資料回傳 None
+    """
+    return parse_monthly_html(fetch_monthly_raw(year, month, typeK), year, month, typeK)
+
+
+def financial_statement(year, season, type='綜合損益彙總表', typeK='sii'):
+    """季財報 (單一季, 寬表)
+    year : (int)
+        民國年/西元年
+    season : (str or int)
+        1,2,3,4
+    type : (str)
+        綜合損益彙總表 or 資產負債彙總表 or 營益分析彙總表
+    typeK : (str)
+        sii -- 上市, otc -- 上櫃
+    """
+    return parse_statement_html(fetch_statement_raw(year, season, type, typeK))
+
+
+def get_monthly_reports(periods, typeks=('sii', 'otc'), engine=None, summary=None):
+    """並行抓取多個月份的月營收
+    params
+    ======
+    periods : list of (year, month)
+    typeks : 'sii' / 'otc'
+    engine : FetchEngine
+    summary : FetchSummary
+        key 為 (year, month, typek)
+
+    return
+    ======
+    dataframe (欄位同 monthly_revenue)
+    """
+    from fetch_engine import FetchEngine
+
+    engine = FetchEngine() if engine is None else engine
+    keys = [(year, month, typek) for year, month in periods for typek in typeks]
+
+    def fetch(engine, key):
+        year, month, typek = key
+        return fetch_monthly_raw(year, month, typek, session=engine)
+
+    def parse(text, key):
+        return parse_monthly_html(text, *key)
+
+    frames = [df for _, df in engine.iter_fetch(keys, fetch, parse, summary)]
+    if not frames:
+        return pd.DataFrame(columns=['公司代號', 'yyyymmdd'] + MONTHLY_COLUMNS[1:] + ['上市櫃'])
+    df = pd.concat(frames, ignore_index=True)
+    return df.sort_values(['yyyymmdd', '公司代號'], ascending=[False, True]).reset_index(drop=True)
+
+
+def get_statements(periods, reports=tuple(STATEMENT_URLS), typeks=('sii', 'otc'), engine=None,
+                   summary=None):
+    """並行抓取多季的季報
+    params
+    ======
+    periods : list of (year, season)
+    reports : 綜合損益彙總表 / 資產負債彙總表 / 營益分析彙總表
+    summary : FetchSummary
+        key 為 (year, season, report, typek)
+
+    return
+    ======
+    dataframe (financial_statement 長表格式)
+    """
+    from fetch_engine import FetchEngine
+
+    engine = FetchEngine() if engine is None else engine
+    keys = [(year, season, report, typek) for year, season in periods
+            for report in reports for typek in typeks]
+
+    def fetch(engine, key):
+        year, season, report, typek = key
+        return fetch_statement_raw(year, season, report, typek, session=engine)
+
+    def parse(text, key):
+        df = parse_statement_html(text)
+        return None if df is None else statement_to_long(df, *key)
+
+    frames = [df for _, df in engine.iter_fetch(keys, fetch, parse, summary)]
+    if not frames:
+        return pd.DataFrame(columns=['公司代號', 'yyyymmdd', '報表', '項目', '值', '上市櫃'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def getMonthlyReport(numbers, typeK='sii', engine=None):
+    """取得最近 numbers 個月的月報"""
+    assert typeK in ('sii', 'otc'), 'typeK須為\'otc\' or \'sii\' '
+    end = last_published_month()
+    periods = month_periods(_months_before(end, numbers - 1), end)
+    return get_monthly_reports(periods, typeks=(typeK,), engine=engine)
+
+
+def last_published_month(today=None):
+    """已進入公布期間的最新月份 (上個月, 10 日前陸續公布)"""
+    today = datetime.date.today() if today is None else today
+    return (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+
+
+def last_published_season(today=None):
+    """已進入公布期間(季度已結束)的最新一季"""
+    today = datetime.date.today() if today is None else today
+    season = (today.month - 1) // 3
+    return (today.year, season) if season > 0 else (today.year - 1, 4)
+
+
+def _stored(con, tablename, where='', params=()):
+    try:
+        cursor = con.execute('SELECT DISTINCT yyyymmdd, 上市櫃 FROM {} {}'.format(tablename, where),
+                             params)
+    except sqlite3.OperationalError:
+        ## 資料表尚未建立
+        return set()
+    return set((int(day), market) for day, market in cursor)
+
+
+def pending_months(con, typek, start=DEFAULT_MONTH_START, today=None):
+    """待抓的月份: 資料表沒有, 或仍在公布期間(可能還有補申報)"""
+    stored = _stored(con, 'monthly_revenue')
+    periods = month_periods(start, last_published_month(today))
+    return [(year, month) for year, month in periods
+            if (month_key(year, month), TYPEK[typek]) not in stored
+            or not raw_cache.monthly_policy(year, month, today)[0]]
+
+
+def pending_seasons(con, typek, report, start=DEFAULT_SEASON_START, today=None):
+    """待抓的季: 資料表沒有, 或未過公布期限(含金控/保險的寬限)"""
+    if report not in STATEMENT_URLS:
+        raise ValueError('report must be one of {}'.format(list(STATEMENT_URLS)))
+    stored = _stored(con, 'financial_statement', 'WHERE 報表 = ?', (report,))
+    periods = season_periods(start, last_published_season(today))
+    return [(year, season) for year, season in periods
+            if (season_end(year, season), TYPEK[typek]) not in stored
+            or not raw_cache.seasonal_policy(year, season, today)[0]]
+
+
+def sync_fundamentals(con, engine=None, typeks=('sii', 'otc'), reports=tuple(STATEMENT_URLS),
+                      monthly_start=DEFAULT_MONTH_START, season_start=DEFAULT_SEASON_START,
+                      today=None):
+    """增量更新 monthly_revenue / financial_statement
+    只抓 pending_months / pending_seasons, 下載失敗(被擋)的期別下次再抓
+
+    return
+    ======
+    dict : {'monthly_revenue': {...}, 'financial_statement': {...}}
+        各表的 pending 期數, 寫入統計與錯誤
+    """
+    from fetch_engine import FetchEngine, FetchSummary
+    from twse_crawler import bulk_insert_df, create_db
+
+    engine = FetchEngine(max_workers=2, rate=0.5) if engine is None else engine
+    for tablename in ('monthly_revenue', 'financial_statement'):
+        create_db(tablename, con)
+    report = {}
+
+    summary = FetchSummary()
+    keys = 0
+    frames = []
+    for typek in typeks:
+        months = pending_months(con, typek, monthly_start, today)
+        keys += len(months)
+        frames.append(get_monthly_reports(months, (typek,), engine, summary))
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    loaded = bulk_insert_df(df, con, 'monthly_revenue') if len(df) else {}
+    report['monthly_revenue'] = dict(loaded, pending=keys, summary=summary.as_dict())
+
+    summary = FetchSummary()
+    keys = 0
+    frames = []
+    for typek in typeks:
+        for name in reports:
+            seasons = pending_seasons(con, typek, name, season_start, today)
+            keys += len(seasons)
+            frames.append(get_statements(seasons, (name,), (typek,), engine, summary))
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    loaded = bulk_insert_df(df, con, 'financial_statement') if len(df) else {}
+    report['financial_statement'] = dict(loaded, pending=keys, summary=summary.as_dict())
+    logging.info('sync fundamentals: {}'.format(report))
+    return report
+
+
+def statement_panel(con, report, items=None, start=None, end=None):
+    """financial_statement 長表 --> 寬表 (index 公司代號, yyyymmdd; columns 項目)"""
+    from trading_calendar import to_yyyymmdd
+
+    sql = 'SELECT 公司代號, yyyymmdd, 項目, 值 FROM financial_statement WHERE 報表 = ?'
+    args = [report]
+    if items is not None:
+        sql += ' AND 項目 IN ({})'.format(','.join('?' * len(items)))
+        args += list(items)
+    if start is not None:
+        sql += ' AND yyyymmdd >= ?'
+        args.append(to_yyyymmdd(start))
+    if end is not None:
+        sql += ' AND yyyymmdd <= ?'
+        args.append(to_yyyymmdd(end))
+    df = pd.read_sql_query(sql, con, params=args)
+    return df.pivot_table(index=['公司代號', 'yyyymmdd'], columns='項目', values='值',
+                          aggfunc='last').astype(np.float64)
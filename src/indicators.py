@@ -0,0 +1,293 @@
+#! encoding = utf8
+"""全市場滾動指標 (增量計算)
+
+每檔股票保留一段 ring buffer 與各視窗的累計和, 新的一天只做:
+    sum += 新值 - 視窗外的舊值
+所以每檔每天 O(1), 所有股票一次以 numpy 向量運算完成
+- ma_n       : n 日收盤均價
+- vol_ma_n   : n 日成交量均量
+- ret_n      : n 日報酬率 c / c[t-n] - 1
+- std_n      : n 日 (c / c.shift()) 的標準差 (notebook 的波動率再乘 200)
+- drawdown   : 開始追蹤以來的最大跌幅 (cummax - c).max() / c.max()
+停牌(無收盤價)的股票當天不前進; 狀態存成 .npz, 每晚只處理新的交易日
+"""
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+MA_WINDOWS = (5, 20, 60)
+VOLUME_WINDOWS = (5, 20)
+RETURN_WINDOWS = (20, 60, 250)
+STD_WINDOWS = (20, 60)
+
+
+class _RollingSums:
+    """多檔股票共用的 ring buffer, 同時維護多個視窗的 sum / sum of squares"""
+
+    def __init__(self, windows, n_codes=0, squares=False):
+        self.windows = tuple(sorted(windows))
+        self.size = self.windows[-1] + 1
+        self.squares = squares
+        self.buffer = np.zeros((self.size, n_codes))
+        self.sums = np.zeros((len(self.windows), n_codes))
+        self.sqsums = np.zeros((len(self.windows), n_codes)) if squares else None
+
+    def resize(self, n_codes):
+        extra = n_codes - self.buffer.shape[1]
+        if extra <= 0:
+            return
+        pad = lambda a: None if a is None else np.hstack([a, np.zeros((a.shape[0], extra))])
+        self.buffer, self.sums, self.sqsums = pad(self.buffer), pad(self.sums), pad(self.sqsums)
+
+    def push(self, cols, values, count):
+        """
+        cols : 有新值的股票位置
+        values : 新值
+        count : 這些股票 push 前已累積的筆數
+        """
+        for i, window in enumerate(self.windows):
+            old = np.where(count >= window, self.buffer[(count - window) % self.size, cols], 0.0)
+            self.sums[i, cols] += values - old
+            if self.squares:
+                self.sqsums[i, cols] += values * values - old * old
+        self.buffer[count % self.size, cols] = values
+
+    def lag(self, cols, count, n):
+        """n 筆以前的值 (count 為 push 後的筆數)"""
+        return np.where(count > n, self.buffer[(count - 1 - n) % self.size, cols], np.nan)
+
+    def state(self, prefix):
+        state = {prefix + 'buffer': self.buffer, prefix + 'sums': self.sums}
+        if self.squares:
+            state[prefix + 'sqsums'] = self.sqsums
+        return state
+
+    def load(self, state, prefix):
+        self.buffer = state[prefix + 'buffer']
+        self.sums = state[prefix + 'sums']
+        if self.squares:
+            self.sqsums = state[prefix + 'sqsums']
+
+
+class RollingIndicators:
+    """全市場滾動指標的串流狀態
+    params
+    ======
+    ma_windows, volume_windows, return_windows, std_windows : tuple of int
+        各指標的視窗天數
+    """
+
+    def __init__(self, ma_windows=MA_WINDOWS, volume_windows=VOLUME_WINDOWS,
+                 return_windows=RETURN_WINDOWS, std_windows=STD_WINDOWS):
+        self.spec = {
+            'ma': list(ma_windows),
+            'vol_ma': list(volume_windows),
+            'ret': list(return_windows),
+            'std': list(std_windows),
+        }
+        self.codes = []
+        self._code_index = {}
+        self.last_date = 0
+        ## 收盤價同時供 ma 與 ret 使用
+        self._close = _RollingSums(set(ma_windows) | set(return_windows))
+        self._volume = _RollingSums(volume_windows)
+        self._ratio = _RollingSums(std_windows, squares=True)
+        self._count = np.zeros(0, dtype=np.int64)
+        self._ratio_count = np.zeros(0, dtype=np.int64)
+        self._last_close = np.zeros(0)
+        self._peak = np.zeros(0)
+        self._max_drop = np.zeros(0)
+
+    @property
+    def columns(self):
+        return ['{}_{}'.format(name, n) for name, windows in self.spec.items()
+                for n in windows] + ['drawdown']
+
+    def _add_codes(self, codes):
+        for code in codes:
+            if code not in self._code_index:
+                self._code_index[code] = len(self.codes)
+                self.codes.append(code)
+        n = len(self.codes)
+        extra = n - len(self._count)
+        if extra <= 0:
+            return
+        for rolling in (self._close, self._volume, self._ratio):
+            rolling.resize(n)
+        self._count = np.append(self._count, np.zeros(extra, dtype=np.int64))
+        self._ratio_count = np.append(self._ratio_count, np.zeros(extra, dtype=np.int64))
+        self._last_close = np.append(self._last_close, np.zeros(extra))
+        self._peak = np.append(self._peak, np.zeros(extra))
+        self._max_drop = np.append(self._max_drop, np.zeros(extra))
+
+    def _mean(self, rolling, window, cols, count):
+        i = rolling.windows.index(window)
+        return np.where(count >= window, rolling.sums[i, cols] / window, np.nan)
+
+    def _std(self, window, cols, count):
+        i = self._ratio.windows.index(window)
+        s, ss = self._ratio.sums[i, cols], self._ratio.sqsums[i, cols]
+        var = np.maximum(ss - s * s / window, 0) / (window - 1)
+        return np.where(count >= window, np.sqrt(var), np.nan)
+
+    def push(self, yyyymmdd, codes, close, volume):
+        """加入一個交易日
+        params
+        ======
+        yyyymmdd : (int)
+            需晚於 last_date
+        codes : list of str
+        close, volume : array
+            收盤價 / 成交量, 收盤價 NaN 或 <=0 視為停牌
+
+        return
+        ======
+        dataframe (證券代號, yyyymmdd, 各指標), 只含當天有收盤價的股票
+        """
+        if yyyymmdd <= self.last_date:
+            raise ValueError('{} is not after last date {}'.format(yyyymmdd, self.last_date))
+        codes = [str(code) for code in codes]
+        close = np.asarray(close, dtype=np.float64)
+        volume = np.nan_to_num(np.asarray(volume, dtype=np.float64))
+        valid = np.isfinite(close) & (close > 0)
+        codes = [code for code, ok in zip(codes, valid) if ok]
+        close, volume = close[valid], volume[valid]
+        self._add_codes(codes)
+        cols = np.fromiter((self._code_index[code] for code in codes), dtype=np.int64,
+                           count=len(codes))
+
+        count = self._count[cols]
+        self._close.push(cols, close, count)
+        self._volume.push(cols, volume, count)
+        ## 日報酬比值從第二筆開始
+        has_prev = count > 0
+        ratio_cols = cols[has_prev]
+        ratio_count = self._ratio_count[ratio_cols]
+        self._ratio.push(ratio_cols, close[has_prev] / self._last_close[ratio_cols], ratio_count)
+        self._ratio_count[ratio_cols] = ratio_count + 1
+        count = count + 1
+        self._count[cols] = count
+        self._last_close[cols] = close
+        self._peak[cols] = np.maximum(self._peak[cols], close)
+        self._max_drop[cols] = np.maximum(self._max_drop[cols], self._peak[cols] - close)
+        self.last_date = int(yyyymmdd)
+
+        out = {'證券代號': codes, 'yyyymmdd': np.full(len(codes), self.last_date)}
+        for n in self.spec['ma']:
+            out['ma_{}'.format(n)] = self._mean(self._close, n, cols, count)
+        for n in self.spec['vol_ma']:
+            out['vol_ma_{}'.format(n)] = self._mean(self._volume, n, cols, count)
+        for n in self.spec['ret']:
+            out['ret_{}'.format(n)] = close / self._close.lag(cols, count, n) - 1
+        ratio_count = self._ratio_count[cols]
+        for n in self.spec['std']:
+            out['std_{}'.format(n)] = self._std(n, cols, ratio_count)
+        out['drawdown'] = self._max_drop[cols] / self._peak[cols]
+        return pd.DataFrame(out)
+
+    def update(self, df):
+        """加入 tse_price / otc_price 格式的資料, 只處理 last_date 之後的日期
+        return
+        ======
+        新交易日的指標 dataframe
+        """
+        from price_store import yyyymmdd_series
+
+        if df is None or len(df) == 0:
+            return pd.DataFrame(columns=['證券代號', 'yyyymmdd'] + self.columns)
+        days = yyyymmdd_series(df['yyyymmdd'])
+        df = df.assign(yyyymmdd=days)[days > self.last_date].sort_values('yyyymmdd')
+        frames = []
+        for day, part in df.groupby('yyyymmdd', sort=True):
+            frames.append(self.push(day, part['證券代號'].astype(str).tolist(),
+                                    part['收盤價'].to_numpy(dtype=np.float64),
+                                    part['成交量'].to_numpy(dtype=np.float64)))
+        if not frames:
+            return pd.DataFrame(columns=['證券代號', 'yyyymmdd'] + self.columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def snapshot(self):
+        """每檔股票最新一天的指標 (index 證券代號), 由 state 直接算出不需重跑"""
+        cols = np.arange(len(self.codes))
+        count, ratio_count = self._count, self._ratio_count
+        out = {}
+        for n in self.spec['ma']:
+            out['ma_{}'.format(n)] = self._mean(self._close, n, cols, count)
+        for n in self.spec['vol_ma']:
+            out['vol_ma_{}'.format(n)] = self._mean(self._volume, n, cols, count)
+        for n in self.spec['ret']:
+            out['ret_{}'.format(n)] = self._last_close / self._close.lag(cols, count, n) - 1
+        for n in self.spec['std']:
+            out['std_{}'.format(n)] = self._std(n, cols, ratio_count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['drawdown'] = self._max_drop / self._peak
+        return pd.DataFrame(out, index=pd.Index(self.codes, name='證券代號'))
+
+    def save(self, path):
+        """狀態存成 .npz (先寫暫存檔再取代)"""
+        state = {
+            'meta': np.array(json.dumps({'spec': self.spec, 'last_date': self.last_date})),
+            'codes': np.array(self.codes, dtype=str),
+            'count': self._count,
+            'ratio_count': self._ratio_count,
+            'last_close': self._last_close,
+            'peak': self._peak,
+            'max_drop': self._max_drop,
+        }
+        state.update(self._close.state('close_'))
+        state.update(self._volume.state('volume_'))
+        state.update(self._ratio.state('ratio_'))
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, **state)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            state = {key: data[key] for key in data.files}
+        meta = json.loads(str(state['meta']))
+        spec = meta['spec']
+        obj = cls(spec['ma'], spec['vol_ma'], spec['ret'], spec['std'])
+        obj.last_date = meta['last_date']
+        obj.codes = [str(code) for code in state['codes']]
+        obj._code_index = {code: i for i, code in enumerate(obj.codes)}
+        obj._count = state['count']
+        obj._ratio_count = state['ratio_count']
+        obj._last_close = state['last_close']
+        obj._peak = state['peak']
+        obj._max_drop = state['max_drop']
+        obj._close.load(state, 'close_')
+        obj._volume.load(state, 'volume_')
+        obj._ratio.load(state, 'ratio_')
+        return obj
+
+
+def update_from_sqlite(con, path='indicators.npz', tables=('tse_price', 'otc_price'),
+                       **windows):
+    """讀取上次狀態, 只計算資料庫中 last_date 之後的交易日, 再存回狀態
+    params
+    ======
+    con : sqlite3 connection
+    path : (str)
+        狀態檔, 不存在則從頭計算
+    windows : 第一次建立時的視窗設定, 見 RollingIndicators
+
+    return
+    ======
+    (RollingIndicators, 新交易日的指標 dataframe)
+    """
+    if os.path.exists(path):
+        state = RollingIndicators.load(path)
+    else:
+        state = RollingIndicators(**windows)
+    sql = ' UNION ALL '.join(
+        'SELECT 證券代號, yyyymmdd, 收盤價, 成交量 FROM {} WHERE yyyymmdd > ?'.format(table)
+        for table in tables)
+    df = pd.read_sql_query(sql, con, params=[state.last_date] * len(tables))
+    new = state.update(df)
+    state.save(path)
+    logging.info('indicators updated to {} ({} rows)'.format(state.last_date, len(new)))
+    return state, new
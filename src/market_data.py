@@ -0,0 +1,202 @@
+#! encoding = utf8
+"""上市 + 上櫃合併的每日股價
+
+兩個市場的來源格式不同 (上市 csv 以民國年字串查詢, 上櫃 json 以 date_tuple 查詢;
+上櫃有 成交金額, 上市有 本益比), 這裡統一成 market + price_store.PRICE_SCHEMA:
+- (market, day) 交給同一個 FetchEngine, 兩個 host 各自限速, 同一天的兩個市場同時下載,
+  一次抓完全市場, 不用先後跑兩個爬蟲再用 pandas 合併
+- 每個市場各自 RollingDedup
+- 寫入 sqlite 的 market_price 表 (SqliteSink) 與 parquet 資料集 (ParquetSink, 依 market 分區)
+
+    from market_data import get_market_data
+    df = get_market_data(('20180101', '20180131'), con=con, store='price_store')
+    ## 讀取: price_db.PriceDB(con, tables=['market_price']) 或 price_store.load_prices
+"""
+import datetime
+import logging
+from collections import Counter
+
+import pandas as pd
+
+import metrics
+
+MARKETS = ('tse', 'otc')
+MARKET_TABLE = 'market_price'
+
+
+def _date_range(date_range):
+    """(start, end) 或單一日期 --> (start, end) datetime.date"""
+    from trading_calendar import to_date
+
+    if isinstance(date_range, (tuple, list)):
+        start, end = date_range
+        end = datetime.date.today() if end is None else end
+        return to_date(start), to_date(end)
+    day = to_date(date_range)
+    return day, day
+
+
+def iter_market_days(days, markets=MARKETS, engine=None, summary=None, urls=None,
+                     max_pending=None):
+    """並行下載多個市場, 依完成順序 yield ((market, day), 當天 dataframe)
+    params
+    ======
+    days : iterable of datetime.date
+    markets : list of str
+        'tse' / 'otc'
+    summary : FetchSummary
+        key 為 (market, day)
+    urls : dict
+        {market: url}, 測試時指向其他伺服器
+    max_pending : (int)
+        同時在途的 (market, day) 數, 預設 engine.max_workers * 2
+
+    return
+    ======
+    dataframe 欄位為 market + price_store.PRICE_COLUMNS
+    """
+    from fetch_engine import FetchEngine
+    import twse_crawler
+
+    funcs = {
+        'tse': (twse_crawler.fetch_tse_day, twse_crawler.parse_tse_day),
+        'otc': (twse_crawler.fetch_otc_day, twse_crawler.parse_otc_day),
+    }
+    for market in markets:
+        assert market in funcs, 'market must be one of {}'.format(tuple(funcs))
+    engine = FetchEngine() if engine is None else engine
+    max_pending = engine.max_workers * 2 if max_pending is None else max_pending
+    urls = urls or {}
+
+    def fetch(engine, key):
+        market, day = key
+        return funcs[market][0](engine, day, urls.get(market))
+
+    def parse(raw, key):
+        market, day = key
+        df = funcs[market][1](raw, day)
+        if df is None:
+            return None
+        df.insert(0, 'market', market)
+        return df
+
+    ## 同一天的各市場相鄰送出
+    keys = ((market, day) for day in days for market in markets)
+    return engine.iter_fetch(keys, fetch, parse, summary, max_pending)
+
+
+def _learn_calendar(calendar, summary, markets):
+    """(market, day) 的 summary 拆成各市場記回 calendar
+    (任一市場有資料 --> 交易日; 每個市場都沒有資料才是休市, 見 TradingCalendar.mark_closed)
+    """
+    from fetch_engine import FetchSummary
+
+    for market in markets:
+        market_summary = FetchSummary()
+        market_summary.trading_days = [day for m, day in summary.trading_days if m == market]
+        market_summary.holidays = [day for m, day in summary.holidays if m == market]
+        calendar.learn_from_summary(market_summary, market)
+
+
+def _check_collision(seen, market, day, df):
+    """market_price 以 (證券代號, yyyymmdd) 為 key, 同一天兩個市場有相同代號時
+    後寫入的會覆寫先寫入的 (market 也被改掉), 直接拒絕
+    """
+    codes = set(df['證券代號'])
+    for other, other_codes in seen.items():
+        both = codes & other_codes
+        if both:
+            raise ValueError('{} {} and {} share codes {}'.format(
+                day, other, market, sorted(both)[:10]))
+    seen[market] = codes
+
+
+def iter_market_prices(date_range, markets=MARKETS, engine=None, summary=None, calendar=None,
+                       urls=None, window=10, max_pending=None):
+    """date_range 內 calendar 判斷可能開盤的日子, 依日期順序 yield (market, day, 去重後的 dataframe)
+    params
+    ======
+    date_range : (start, end) 或單一日期
+        日期範圍 (含), 任何 to_date 支援的格式; end 為 None 代表今天
+    window : (int)
+        RollingDedup 的天數, 0 代表不去重
+    其餘見 iter_market_days
+
+    同一天兩個市場出現相同的證券代號時 raise ValueError (見 _check_collision)
+    """
+    from fetch_engine import FetchSummary
+    from streaming import RollingDedup, in_order
+    from trading_calendar import TradingCalendar
+
+    calendar = TradingCalendar() if calendar is None else calendar
+    start, end = _date_range(date_range)
+    days = sorted(calendar.candidate_days(start, end))
+    dedup = {market: RollingDedup(window) for market in markets} if window else None
+    run_summary = FetchSummary()
+    keys = [(market, day) for day in days for market in markets]
+    pairs = iter_market_days(days, markets, engine, run_summary, urls, max_pending)
+    ## {market: 當天的證券代號}, 同一天的各市場依序送出
+    seen_day, seen = None, {}
+    for (market, day), df in in_order(pairs, keys, run_summary):
+        if day != seen_day:
+            seen_day, seen = day, {}
+        _check_collision(seen, market, day, df)
+        if dedup is not None:
+            df = dedup[market](df)
+        if len(df):
+            yield market, day, df
+    _learn_calendar(calendar, run_summary, markets)
+    if summary is not None:
+        summary.merge(run_summary)
+
+
+def get_market_data(date_range, markets=MARKETS, engine=None, summary=None, calendar=None,
+                    con=None, store=None, urls=None, window=10, max_pending=None, keep=True):
+    """抓取多個市場的每日股價, 合併成同一張表
+    params
+    ======
+    date_range : (start, end) 或單一日期
+    markets : list of str
+        'tse' / 'otc'
+    con : sqlite3 connection
+        有給則寫入 market_price 表
+    store : ParquetPriceStore or (str) 資料集目錄
+        有給則寫入 parquet 資料集
+    keep : (bool)
+        False 則不把結果留在記憶體 (多年的資料只寫入 con / store), 回傳 None
+    其餘見 iter_market_prices
+
+    return
+    ======
+    dataframe (market + price_store.PRICE_COLUMNS), 依 (yyyymmdd, market, 證券代號) 排序
+    """
+    from fetch_engine import FetchSummary
+    from price_store import PRICE_COLUMNS
+    from streaming import ParquetSink, SqliteSink
+
+    summary = FetchSummary() if summary is None else summary
+    sinks = []
+    if con is not None:
+        sinks.append(SqliteSink(con, MARKET_TABLE))
+    if store is not None:
+        sinks.append(ParquetSink(store))
+    frames, rows = [], Counter()
+    with metrics.timer('market.load'):
+        for market, _, df in iter_market_prices(date_range, markets, engine, summary, calendar,
+                                                urls, window, max_pending):
+            for sink in sinks:
+                sink.write(df)
+            if keep:
+                frames.append(df)
+            rows[market] += len(df)
+        for sink in sinks:
+            sink.close()
+    metrics.inc('market.load.rows', sum(rows.values()))
+    logging.info('market data {}: rows {} {}'.format(date_range, dict(rows), summary))
+    if not keep:
+        return None
+    columns = ['market'] + PRICE_COLUMNS
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames, ignore_index=True)[columns]
+    return df.sort_values(['yyyymmdd', 'market', '證券代號']).reset_index(drop=True)
@@ -0,0 +1,188 @@
+#! encoding = utf8
+"""爬蟲 / 寫入的量測
+
+各階段以名稱記錄 timer (次數, 總秒數, 最短, 最長) 與 counter, e.g.
+- fetch.request / fetch.bytes / fetch.retries / fetch.holidays / fetch.errors
+- parse.tse_csv / parse.tse_csv.rows / parse.otc_json / ...
+- insert.tse_price / insert.tse_price.rows / insert.inserted / insert.skipped ...
+timer 名稱 X 若有對應的 counter X.rows, summary 會算出 rows/sec
+可匯出成 JSON 或 Prometheus text format; profile() 可對單一日期跑 cProfile
+
+    import metrics
+    with metrics.timer('fetch.request'):
+        ...
+    metrics.inc('fetch.bytes', len(content))
+    print(metrics.METRICS.summary())
+    metrics.METRICS.write('metrics.prom')
+"""
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import pstats
+import re
+import threading
+import time
+
+
+class Metrics:
+    """thread-safe 的 timer / counter 集合"""
+
+    def __init__(self, prefix='stocklab'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timers = {}
+            self.started_at = time.time()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            stat = self.timers.get(name)
+            if stat is None:
+                self.timers[name] = [1, seconds, seconds, seconds]
+            else:
+                stat[0] += 1
+                stat[1] += seconds
+                stat[2] = min(stat[2], seconds)
+                stat[3] = max(stat[3], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """dict : counters, timers (count/total/min/max/mean), rates (rows/sec)"""
+        with self._lock:
+            counters = dict(self.counters)
+            timers = {name: {'count': c, 'total': t, 'min': lo, 'max': hi, 'mean': t / c}
+                      for name, (c, t, lo, hi) in self.timers.items()}
+        rates = {name + '.rows_per_sec': counters[name + '.rows'] / stat['total']
+                 for name, stat in timers.items()
+                 if name + '.rows' in counters and stat['total'] > 0}
+        return {
+            'started_at': self.started_at,
+            'elapsed': time.time() - self.started_at,
+            'counters': counters,
+            'timers': timers,
+            'rates': rates,
+        }
+
+    def _metric_name(self, name):
+        return '{}_{}'.format(self.prefix, re.sub(r'[^a-zA-Z0-9_]', '_', name))
+
+    def to_prometheus(self):
+        """Prometheus text exposition format"""
+        snap = self.snapshot()
+        lines = []
+        for name, value in sorted(snap['counters'].items()):
+            metric = self._metric_name(name) + '_total'
+            lines += ['# TYPE {} counter'.format(metric), '{} {}'.format(metric, value)]
+        for name, stat in sorted(snap['timers'].items()):
+            metric = self._metric_name(name) + '_seconds'
+            lines += ['# TYPE {} summary'.format(metric),
+                      '{}_count {}'.format(metric, stat['count']),
+                      '{}_sum {:.6f}'.format(metric, stat['total']),
+                      '# TYPE {}_max gauge'.format(metric),
+                      '{}_max {:.6f}'.format(metric, stat['max'])]
+        for name, value in sorted(snap['rates'].items()):
+            metric = self._metric_name(name)
+            lines += ['# TYPE {} gauge'.format(metric), '{} {:.3f}'.format(metric, value)]
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+
+    def write(self, path):
+        """依副檔名輸出: .prom / .txt --> Prometheus, 其他 --> JSON"""
+        text = self.to_prometheus() if path.endswith(('.prom', '.txt')) else self.to_json()
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(text)
+        logging.info('metrics written to {}'.format(path))
+
+    def summary(self):
+        """執行結束時印出的摘要"""
+        snap = self.snapshot()
+        lines = ['elapsed {:.1f}s'.format(snap['elapsed'])]
+        if snap['timers']:
+            lines.append('{:<32}{:>8}{:>11}{:>10}{:>10}'.format(
+                'stage', 'count', 'total(s)', 'mean(ms)', 'max(ms)'))
+            for name, stat in sorted(snap['timers'].items()):
+                lines.append('{:<32}{:>8}{:>11.3f}{:>10.1f}{:>10.1f}'.format(
+                    name, stat['count'], stat['total'], stat['mean'] * 1000, stat['max'] * 1000))
+        for name, value in sorted(snap['counters'].items()):
+            lines.append('{:<32}{:>8}'.format(name, value))
+        for name, value in sorted(snap['rates'].items()):
+            lines.append('{:<32}{:>8.0f}'.format(name, value))
+        return '\n'.join(lines)
+
+
+## 預設的全域量測, 爬蟲 / parser / loader 都記錄在這裡
+METRICS = Metrics()
+
+
+def inc(name, value=1):
+    METRICS.inc(name, value)
+
+
+def observe(name, seconds):
+    METRICS.observe(name, seconds)
+
+
+def timer(name):
+    return METRICS.timer(name)
+
+
+@contextlib.contextmanager
+def profile(path=None, sort='cumulative', limit=30):
+    """cProfile 一段程式
+    path : (str)
+        輸出 .prof 檔 (可用 snakeviz 等工具查看), None 則把前 limit 名寫進 log
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path is not None:
+            profiler.dump_stats(path)
+            logging.info('profile written to {}'.format(path))
+        else:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(limit)
+            logging.info(out.getvalue())
+
+
+def profile_date(day, market='tse', path=None, con=None):
+    """對單一日期完整跑一次 下載 -> 解析 (-> 寫入) 並 cProfile
+    params
+    ======
+    day : 日期, 任何 to_date 支援的格式
+    market : 'tse' or 'otc'
+    path : (str)
+        .prof 輸出檔, None 則寫進 log
+    con : sqlite3 connection
+        有給才寫入資料表
+    """
+    from sync import MARKETS, days_data_func
+    from trading_calendar import to_date
+    from twse_crawler import bulk_insert_df
+
+    with profile(path):
+        df = days_data_func(market)([to_date(day)])
+        if con is not None and len(df):
+            bulk_insert_df(df, con, MARKETS[market])
+    return df
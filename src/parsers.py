@@ -0,0 +1,195 @@
+#! encoding = utf8
+"""原始回應 --> 型別化的 dataframe
+
+整批處理, 不做逐列/逐格的 python 迴圈:
+- TWSE MI_INDEX csv : 一個 compiled regex 取出 16 欄的資料列, 交給 read_csv
+  處理千分位與 '--' 等缺值
+- TPEx json : 取出需要的欄位串成 '|' 分隔文字, 同樣交給 read_csv
+重跑歷史資料時用 parse_*_batch 把多天合併成一次 read_csv, 省掉每天的固定成本
+"""
+import re
+from io import StringIO
+from operator import itemgetter
+
+import pandas as pd
+
+import metrics
+
+## 缺值符號
+NA_TOKENS = ['--', '---', '----', '']
+
+## 剛好 16 個欄位的行: 前 15 欄各為 "..." (欄內不含 '"'), 之後不再出現 '",'
+## (以 '=' 開頭的行自然不符合)
+TSE_ROW_PATTERN = re.compile(r'^(?:"[^"\n]*",){15}(?![^\n]*",)[^\n]*$', re.M)
+
+TSE_RAW_COLUMNS = ['證券代號', '證券名稱', '成交量', '成交筆數', '成交金額', '開盤價', '最高價',
+                   '最低價', '收盤價', '漲跌(+/-)', '漲跌價差', '最後揭示買價', '最後揭示買量',
+                   '最後揭示賣價', '最後揭示賣量', '本益比']
+TSE_DROP_COLUMNS = ['漲跌(+/-)', '證券名稱', '最後揭示買量', '最後揭示賣量']
+
+## TPEx aaData 欄位位置
+OTC_FIELDS = {
+    '證券代號': 0,
+    '收盤價': 2,
+    '開盤價': 4,
+    '最高價': 5,
+    '最低價': 6,
+    '成交量': 8,
+    '成交金額': 9,
+    '成交筆數': 10,
+}
+OTC_COLUMNS = ['證券代號', 'yyyymmdd', '成交量', '成交筆數', '成交金額', '開盤價', '最高價',
+               '最低價', '收盤價']
+
+
+def _yyyymmdd(date_tuple):
+    return '{0}{1:02d}{2:02d}'.format(*date_tuple)
+
+
+def _coerce_numeric(df, columns):
+    ## 仍為文字的欄位(異常符號)整欄轉數值
+    for col in columns:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+
+
+def _tse_rows(text):
+    """取出資料列(不含表頭), 無資料回傳空 list"""
+    rows = TSE_ROW_PATTERN.findall(text.replace('\r', ''))
+    return rows[1:]
+
+
+def has_tse_rows(text):
+    """MI_INDEX csv 是否有資料列 (寫入快取前的檢查, 不轉換型別)"""
+    return bool(_tse_rows(text))
+
+
+def _read_tse_rows(rows, with_date=False):
+    names = (['yyyymmdd'] if with_date else []) + TSE_RAW_COLUMNS
+    usecols = [col for col in names if col not in TSE_DROP_COLUMNS]
+    df = pd.read_csv(StringIO('\n'.join(rows).replace(' ', '')),
+                     header=None, names=names, usecols=usecols,
+                     thousands=',', na_values=NA_TOKENS, keep_default_na=False,
+                     dtype={'證券代號': str, 'yyyymmdd': str})
+    _coerce_numeric(df, usecols[1 + with_date:])
+    df['成交量'] /= 1000
+    return df
+
+
+def parse_tse_csv(text):
+    """解析 TWSE MI_INDEX csv
+    params
+    ======
+    text : (str)
+        已用 big5 解碼的回應內容
+
+    return
+    ======
+    dataframe (index 證券代號), 無資料(假日)回傳 None
+    """
+    with metrics.timer('parse.tse_csv'):
+        rows = _tse_rows(text)
+        if not rows:
+            return None
+        df = _read_tse_rows(rows).set_index('證券代號')
+    assert df.index.is_unique
+    metrics.inc('parse.tse_csv.rows', len(df))
+    return df
+
+
+def parse_tse_batch(items):
+    """多天的 MI_INDEX csv 一次解析 (重跑歷史資料時使用)
+    params
+    ======
+    items : iterable of (text, date_tuple)
+
+    return
+    ======
+    dataframe (含 證券代號, yyyymmdd 欄位), 全部無資料回傳 None
+    """
+    with metrics.timer('parse.tse_batch'):
+        lines = []
+        for text, date_tuple in items:
+            prefix = '"{}",'.format(_yyyymmdd(date_tuple))
+            lines.extend(prefix + row for row in _tse_rows(text))
+        if not lines:
+            return None
+        df = _read_tse_rows(lines, with_date=True)
+    metrics.inc('parse.tse_batch.rows', len(df))
+    return df
+
+
+def _otc_rows(result, date_tuple):
+    date_str = '{0}/{1:02d}/{2:02d}'.format(
+        date_tuple[0] - 1911, date_tuple[1], date_tuple[2])
+    if result.get('reportDate') != date_str:
+        return []
+    return [tr for table in (result.get('mmData') or [], result.get('aaData') or [])
+            for tr in table if len(tr) == 17]
+
+
+def has_otc_rows(result, date_tuple):
+    """TPEx json 是否有 date_tuple 當天的資料列 (寫入快取前的檢查)"""
+    return isinstance(result, dict) and bool(_otc_rows(result, date_tuple))
+
+
+def _read_otc_rows(lines):
+    names = ['yyyymmdd'] + list(OTC_FIELDS)
+    df = pd.read_csv(StringIO('\n'.join(lines)), sep='|', header=None, names=names,
+                     thousands=',', na_values=NA_TOKENS, keep_default_na=False,
+                     skipinitialspace=True, dtype={'證券代號': str, 'yyyymmdd': str})
+    _coerce_numeric(df, names[2:])
+    df['證券代號'] = df['證券代號'].str.strip()
+    df['成交量'] /= 1000
+    for col in ('成交筆數', '成交金額'):
+        df[col] = df[col].astype('Int64')
+    return df[OTC_COLUMNS]
+
+
+def _otc_lines(rows, date_tuple):
+    ## itemgetter 取欄位 + join 都在 C 層完成, 再交給 read_csv 處理千分位/缺值
+    prefix = _yyyymmdd(date_tuple) + '|'
+    return map((prefix).__add__, map('|'.join, map(itemgetter(*OTC_FIELDS.values()), rows)))
+
+
+def parse_otc_json(result, date_tuple):
+    """解析 TPEx 上櫃收盤行情 json
+    params
+    ======
+    result : (dict)
+        回應的 json
+    date_tuple : (tuple)
+        (2018,1,29)
+
+    return
+    ======
+    dataframe (欄位同 OTC_COLUMNS), 無資料(假日)回傳 None
+    """
+    with metrics.timer('parse.otc_json'):
+        rows = _otc_rows(result, date_tuple)
+        if not rows:
+            return None
+        df = _read_otc_rows(_otc_lines(rows, date_tuple))
+    metrics.inc('parse.otc_json.rows', len(df))
+    return df
+
+
+def parse_otc_batch(items):
+    """多天的 TPEx json 一次解析
+    params
+    ======
+    items : iterable of (result, date_tuple)
+
+    return
+    ======
+    dataframe (欄位同 OTC_COLUMNS), 全部無資料回傳 None
+    """
+    with metrics.timer('parse.otc_batch'):
+        lines = []
+        for result, date_tuple in items:
+            lines.extend(_otc_lines(_otc_rows(result, date_tuple), date_tuple))
+        if not lines:
+            return None
+        df = _read_otc_rows(lines)
+    metrics.inc('parse.otc_batch.rows', len(df))
+    return df
@@ -0,0 +1,275 @@
+#! encoding = utf8
+"""基本面資料依公布日對齊到每日股價 (point-in-time / as-of join)
+
+每筆基本面資料只在公布期限的隔天之後才能使用, 避免 look-ahead:
+- 月營收 : 次月 10 日前公布 --> 次月 11 日起可用
+- 季報 : Q1 5/15, Q2 8/14, Q3 11/14, Q4(年報) 隔年 3/31 --> 期限隔天起可用
+  (金控/保險期限較晚, 需要時以 season_deadlines 覆寫)
+對齊方式: (股票, 可用日) 排序成一個整數鍵陣列, 每日股價以 searchsorted
+找到同一檔股票最近一筆已公布的資料, 全市場一次二分搜尋完成
+結果存成 parquet 特徵表, 資料表沒有變動時直接讀快取
+(以 twse_crawler.table_version 判斷, 來源表需經 bulk_insert_df 寫入)
+"""
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+REVENUE_DEADLINE_DAY = 10
+SEASON_DEADLINES = {
+    1: (0, 5, 15),
+    2: (0, 8, 14),
+    3: (0, 11, 14),
+    4: (1, 3, 31),
+}
+REVENUE_COLUMNS = ['當月營收', '去年同月增減(%)', '當月累計營收', '前期比較增減(%)']
+STATEMENT_ITEMS = {
+    '綜合損益彙總表': ['基本每股盈餘（元）'],
+    '營益分析彙總表': ['毛利率(%)(營業毛利)/(營業收入)', '營業利益率(%)(營業利益)/(營業收入)'],
+}
+## 鍵 = 股票編號 * KEY_BASE + yyyymmdd
+KEY_BASE = 10 ** 8
+
+
+def _next_day(yyyymmdd):
+    days = pd.to_datetime(pd.Series(yyyymmdd).astype(str), format='%Y%m%d') + pd.Timedelta(days=1)
+    return (days.dt.year * 10000 + days.dt.month * 100 + days.dt.day).to_numpy(np.int64)
+
+
+def revenue_available_date(yyyymmdd):
+    """月營收 yyyymmdd (資料月份) --> 可使用的第一天 (次月 11 日)"""
+    yyyymmdd = np.asarray(yyyymmdd, dtype=np.int64)
+    year, month = yyyymmdd // 10000, yyyymmdd // 100 % 100
+    year, month = np.where(month == 12, year + 1, year), month % 12 + 1
+    return year * 10000 + month * 100 + REVENUE_DEADLINE_DAY + 1
+
+
+def statement_available_date(yyyymmdd, season_deadlines=SEASON_DEADLINES):
+    """季報 yyyymmdd (季末日) --> 可使用的第一天 (公布期限隔天)"""
+    yyyymmdd = np.asarray(yyyymmdd, dtype=np.int64)
+    year, season = yyyymmdd // 10000, (yyyymmdd // 100 % 100 + 2) // 3
+    deadline = np.zeros_like(yyyymmdd)
+    for s, (year_offset, month, day) in season_deadlines.items():
+        mask = season == s
+        deadline[mask] = (year[mask] + year_offset) * 10000 + month * 100 + day
+    return _next_day(deadline)
+
+
+class AsofIndex:
+    """左表 (代號, 日期) 的整數鍵, 同一個網格做多次 join 時只建一次
+    params
+    ======
+    codes : array of str
+    dates : array of int yyyymmdd
+    """
+
+    def __init__(self, codes, dates):
+        ids, uniques = pd.factorize(np.asarray(codes, dtype=object))
+        self.categories = pd.Index(uniques)
+        self.ids = ids.astype(np.int64)
+        self.keys = self.ids * KEY_BASE + np.asarray(dates, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, right_codes, right_dates):
+        """對每個左表的 (代號, 日期) 找出 right 中同代號且 right_date <= 日期 的最後一筆
+        相同 (代號, 日期) 的多筆 right 以原本順序較後者為準
+
+        return
+        ======
+        right 的列位置 (ndarray), 找不到為 -1
+        """
+        right_ids = self.categories.get_indexer(np.asarray(right_codes, dtype=object))
+        right_keys = right_ids.astype(np.int64) * KEY_BASE + np.asarray(right_dates, dtype=np.int64)
+        order = np.argsort(right_keys, kind='stable')
+        pos = np.searchsorted(right_keys[order], self.keys, side='right') - 1
+        found = pos >= 0
+        found[found] = right_ids[order[pos[found]]] == self.ids[found]
+        return np.where(found, order[np.maximum(pos, 0)], -1)
+
+
+def asof_indexer(left_codes, left_dates, right_codes, right_dates):
+    """AsofIndex(left_codes, left_dates).lookup(right_codes, right_dates)"""
+    return AsofIndex(left_codes, left_dates).lookup(right_codes, right_dates)
+
+
+def asof_columns(index, right, columns, right_by='公司代號', right_on='available'):
+    """依 AsofIndex 從 right 取出對齊後的欄位
+    return
+    ======
+    dict {欄位: ndarray}, 長度同 index, 找不到為 NaN
+    """
+    rows = index.lookup(right[right_by].to_numpy(), right[right_on].to_numpy())
+    found = rows >= 0
+    out = {}
+    for col in columns:
+        values = right[col].to_numpy()
+        if values.dtype.kind in 'iub':
+            values = values.astype(np.float64)
+        if not len(values):
+            out[col] = np.full(len(rows), np.nan)
+        elif values.dtype.kind == 'f':
+            out[col] = np.where(found, values[np.maximum(rows, 0)], np.nan)
+        else:
+            taken = values[np.maximum(rows, 0)].astype(object)
+            taken[~found] = None
+            out[col] = taken
+    return out
+
+
+def asof_merge(left, right, columns, left_by='證券代號', right_by='公司代號',
+               left_on='yyyymmdd', right_on='available', index=None):
+    """把 right 的 columns 依可用日對齊到 left 的每一列 (不改變 left 的順序)
+    index : AsofIndex
+        left 的索引, 未指定則重新建立
+    """
+    if index is None:
+        index = AsofIndex(left[left_by].to_numpy(), left[left_on].to_numpy())
+    new = asof_columns(index, right, columns, right_by, right_on)
+    return pd.concat([left, pd.DataFrame(new, index=left.index)], axis=1)
+
+
+def _read_prices(con, tables, price_columns, start, end):
+    from trading_calendar import to_yyyymmdd
+
+    where, args = [], []
+    if start is not None:
+        where.append('yyyymmdd >= ?')
+        args.append(to_yyyymmdd(start))
+    if end is not None:
+        where.append('yyyymmdd <= ?')
+        args.append(to_yyyymmdd(end))
+    where = ' WHERE ' + ' AND '.join(where) if where else ''
+    frames = []
+    for table in tables:
+        existing = [row[1] for row in con.execute('PRAGMA table_info({})'.format(table))]
+        cols = ', '.join('"{}"'.format(c) if c in existing else 'NULL AS "{}"'.format(c)
+                         for c in price_columns)
+        sql = 'SELECT 證券代號, yyyymmdd{} FROM {}{}'.format(
+            ', ' + cols if cols else '', table, where)
+        frames.append(pd.read_sql_query(sql, con, params=args))
+    df = pd.concat(frames, ignore_index=True)
+    df['yyyymmdd'] = df['yyyymmdd'].astype(np.int64)
+    df['證券代號'] = df['證券代號'].astype(str)
+    return df.sort_values(['證券代號', 'yyyymmdd']).reset_index(drop=True)
+
+
+def _read_revenue(con, columns):
+    cols = ', '.join('"{}"'.format(c) for c in columns)
+    df = pd.read_sql_query('SELECT 公司代號, yyyymmdd, {} FROM monthly_revenue'.format(cols), con)
+    df['yyyymmdd'] = df['yyyymmdd'].astype(np.int64)
+    df['available'] = revenue_available_date(df['yyyymmdd'].to_numpy())
+    return df.sort_values(['公司代號', 'yyyymmdd']).reset_index(drop=True)
+
+
+def _read_statement(con, report, items, season_deadlines):
+    from fundamentals import statement_panel
+
+    df = statement_panel(con, report, items).reset_index()
+    for item in items:
+        if item not in df.columns:
+            df[item] = np.nan
+    df['yyyymmdd'] = df['yyyymmdd'].astype(np.int64)
+    df['available'] = statement_available_date(df['yyyymmdd'].to_numpy(), season_deadlines)
+    return df.sort_values(['公司代號', 'yyyymmdd']).reset_index(drop=True)
+
+
+def build_feature_panel(con, start=None, end=None, tables=('tse_price',),
+                        price_columns=('收盤價', '成交筆數', '本益比'),
+                        revenue_columns=REVENUE_COLUMNS, statement_items=STATEMENT_ITEMS,
+                        season_deadlines=SEASON_DEADLINES, prices=None):
+    """每日股價 + 當天已公布的月營收/季報
+    params
+    ======
+    con : sqlite3 connection
+    start, end : 股價日期範圍 (含)
+    tables : 作為日期網格的股價表
+    price_columns : 股價表欄位
+    revenue_columns : monthly_revenue 欄位
+    statement_items : {報表: [項目]}
+    prices : dataframe
+        直接給定日期網格 (e.g. ParquetPriceStore.load_prices 的結果),
+        需含 證券代號, yyyymmdd; 指定時忽略 tables / price_columns / start / end
+
+    return
+    ======
+    dataframe (證券代號, yyyymmdd, 股價欄位, 月營收欄位, 季報項目,
+               月營收期別, <報表>期別), 依 (證券代號, yyyymmdd) 排序
+    """
+    if prices is None:
+        panel = _read_prices(con, tables, list(price_columns), start, end)
+    else:
+        panel = prices.assign(yyyymmdd=prices['yyyymmdd'].astype(np.int64),
+                              證券代號=prices['證券代號'].astype(str))
+        panel = panel.sort_values(['證券代號', 'yyyymmdd']).reset_index(drop=True)
+    index = AsofIndex(panel['證券代號'].to_numpy(), panel['yyyymmdd'].to_numpy())
+    ## 全部來源對齊完再一次接上, 避免大表重複複製
+    features = {}
+    if revenue_columns:
+        revenue = _read_revenue(con, list(revenue_columns)).rename(
+            columns={'yyyymmdd': '月營收期別'})
+        features.update(asof_columns(index, revenue, list(revenue_columns) + ['月營收期別']))
+    for report, items in (statement_items or {}).items():
+        statement = _read_statement(con, report, list(items), season_deadlines).rename(
+            columns={'yyyymmdd': report + '期別'})
+        features.update(asof_columns(index, statement, list(items) + [report + '期別']))
+    return pd.concat([panel, pd.DataFrame(features, index=panel.index)], axis=1)
+
+
+def _fingerprint(con, tables):
+    ## 各來源表的寫入次數 (bulk_insert_df 維護), 任一變動則重建; 不掃描資料表
+    from twse_crawler import table_version
+
+    return {table: table_version(con, table)
+            for table in tuple(tables) + ('monthly_revenue', 'financial_statement')}
+
+
+def _prices_fingerprint(prices):
+    ## 直接給定的股價網格已在記憶體中: 整個內容的雜湊
+    hashed = pd.util.hash_pandas_object(prices, index=False).to_numpy()
+    return hashlib.sha1(hashed.tobytes()).hexdigest()
+
+
+def load_feature_panel(con, path='feature_panel.parquet', rebuild=False, **kwargs):
+    """讀取特徵表快取, 來源資料表有變動或參數不同時重建
+    params
+    ======
+    path : (str)
+        parquet 檔, 旁邊的 <path>.json 記錄來源資料表狀態與參數
+    kwargs : 見 build_feature_panel
+
+    return
+    ======
+    dataframe, 證券代號 為 category
+    """
+    tables = kwargs.get('tables', ('tse_price',))
+    prices = kwargs.get('prices')
+    meta = {
+        'fingerprint': _fingerprint(con, tables),
+        'prices': None if prices is None else _prices_fingerprint(prices),
+        'kwargs': json.loads(json.dumps({k: v for k, v in kwargs.items() if k != 'prices'},
+                                        default=str)),
+    }
+    if not rebuild and os.path.exists(path) and os.path.exists(path + '.json'):
+        with open(path + '.json', encoding='utf8') as f:
+            if json.load(f) == meta:
+                return pd.read_parquet(path)
+    panel = build_feature_panel(con, **kwargs)
+    ## 代號存成 dictionary, 讀回時直接是 category
+    panel['證券代號'] = panel['證券代號'].astype('category')
+    tmp = path + '.tmp'
+    panel.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+    with open(path + '.json', 'w', encoding='utf8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    logging.info('feature panel rebuilt: {} rows -> {}'.format(len(panel), path))
+    return panel
+
+
+def feature_matrix(panel, column):
+    """特徵表的某個欄位 --> 日期 x 股票 矩陣 (給 portfolio 回測使用)"""
+    return panel.pivot(index='yyyymmdd', columns='證券代號', values=column)
@@ -0,0 +1,273 @@
+#! encoding = utf8
+"""全市場投資組合回測
+
+以 日期 x 股票 的收盤價矩陣一次回測同一個策略:
+- 策略只需產生目標權重矩陣 (每列加總 <= 1), 只有換股日那幾列會被使用
+- 換股日依目標權重買賣(可整張), 扣手續費 / 證交稅, 兩次換股之間持股不動,
+  淨值 = 現金 + 持股 @ 價格, 每個區間一次矩陣乘法
+- 停牌(當天無收盤價)的股票不能買賣, 維持原持股; 估值用最後一筆收盤價
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+## 手續費 0.1425%, 證交稅 0.3% (賣出時收), 手續費最低 20 元
+FEE_RATE = 0.001425
+TAX_RATE = 0.003
+MIN_FEE = 20
+TRADING_DAYS_PER_YEAR = 250
+
+
+def load_panel(con, field='收盤價', start=None, end=None, tables=('tse_price', 'otc_price'),
+               adjust=None):
+    """由 sqlite 股價表讀出 日期 x 股票 矩陣
+    params
+    ======
+    con : sqlite3 connection
+    field : (str)
+        欄位名稱, e.g. 收盤價 / 成交量
+    start, end : 日期 (含)
+    adjust : adjustment.AdjustmentStore
+        給定則回傳除權息還原後的價格
+
+    return
+    ======
+    dataframe (index yyyymmdd, columns 證券代號)
+    """
+    from trading_calendar import to_yyyymmdd
+
+    where, args = [], []
+    if start is not None:
+        where.append('yyyymmdd >= ?')
+        args.append(to_yyyymmdd(start))
+    if end is not None:
+        where.append('yyyymmdd <= ?')
+        args.append(to_yyyymmdd(end))
+    where = ' WHERE ' + ' AND '.join(where) if where else ''
+    sql = ' UNION ALL '.join('SELECT 證券代號, yyyymmdd, "{}" AS value FROM {}{}'.format(
+        field, table, where) for table in tables)
+    df = pd.read_sql_query(sql, con, params=args * len(tables))
+    df['yyyymmdd'] = pd.to_numeric(df['yyyymmdd'].astype(str).str.replace('-', '').str[:8])
+    df['證券代號'] = df['證券代號'].astype(str)
+    if adjust is not None:
+        df = adjust.adjust(df, columns=['value'])
+    return df.pivot_table(index='yyyymmdd', columns='證券代號', values='value', aggfunc='last')
+
+
+def _as_datetime(index):
+    if pd.api.types.is_integer_dtype(index):
+        return pd.to_datetime(index.astype(str), format='%Y%m%d')
+    return pd.DatetimeIndex(pd.to_datetime(index))
+
+
+def rebalance_dates(index, freq='M'):
+    """換股日 (每期第一個交易日)
+    params
+    ======
+    index : 交易日 index (yyyymmdd int 或 datetime)
+    freq : (int or str)
+        int : 每 n 個交易日
+        'W' / 'M' / 'Q' / 'Y' : 每週 / 月 / 季 / 年的第一個交易日
+
+    return
+    ======
+    換股日的列位置 (ndarray)
+    """
+    if isinstance(freq, (int, np.integer)):
+        return np.arange(0, len(index), int(freq))
+    periods = _as_datetime(index).to_period(freq)
+    return np.flatnonzero(~periods.duplicated())
+
+
+def equal_weight(signal, max_positions=None):
+    """等權重
+    params
+    ======
+    signal : dataframe (日期 x 股票)
+        bool: 是否持有; 數值: 分數(越大越好), NaN 代表不可選
+    max_positions : (int)
+        每期最多持有檔數, 依分數取前 n 名
+
+    return
+    ======
+    權重 dataframe, 每列加總為 1 (無可選股票則為 0)
+    """
+    if signal.dtypes.eq(bool).all():
+        score = signal.where(signal)
+    else:
+        score = signal.astype(float)
+    selected = score.notna()
+    if max_positions is not None:
+        selected &= score.rank(axis=1, ascending=False, method='first') <= max_positions
+    counts = selected.sum(axis=1).replace(0, np.nan)
+    return selected.div(counts, axis=0).fillna(0.0)
+
+
+def inverse_volatility_weight(signal, close, window=60, max_positions=None):
+    """依波動度倒數分配權重 (波動大的部位小)"""
+    selected = equal_weight(signal, max_positions) > 0
+    vol = close.pct_change(fill_method=None).rolling(window, min_periods=window // 2).std()
+    inv = (1 / vol.reindex_like(selected)).where(selected & (vol > 0))
+    return inv.div(inv.sum(axis=1), axis=0).fillna(0.0)
+
+
+def cap_weight(weights, max_weight):
+    """單一持股權重上限, 超出的部分保留為現金"""
+    return weights.clip(upper=max_weight)
+
+
+class PortfolioBacktest:
+    """日期 x 股票 矩陣上的投資組合回測
+    params
+    ======
+    close : dataframe (index 交易日, columns 證券代號)
+        收盤價, 停牌為 NaN
+    initial_capital : (float)
+        初始資金
+    fee_rate : (float)
+        手續費率 (買賣都收)
+    fee_discount : (float)
+        手續費折扣, e.g. 0.6 代表 6 折
+    tax_rate : (float)
+        證交稅率 (賣出收)
+    min_fee : (float)
+        每筆最低手續費
+    lot_size : (int)
+        交易單位股數, 1000 為整張, 1 為零股
+    """
+
+    def __init__(self, close, initial_capital=1000000, fee_rate=FEE_RATE, fee_discount=1.0,
+                 tax_rate=TAX_RATE, min_fee=MIN_FEE, lot_size=1000):
+        self.close = close.sort_index()
+        self.initial_capital = initial_capital
+        self.fee_rate = fee_rate * fee_discount
+        self.tax_rate = tax_rate
+        self.min_fee = min_fee
+        self.lot_size = lot_size
+        raw = self.close.to_numpy(dtype=np.float64)
+        self._tradable = np.isfinite(raw) & (raw > 0)
+        ## 估值用最後一筆收盤價, 上市前為 0
+        self._prices = np.nan_to_num(self.close.ffill().to_numpy(dtype=np.float64))
+
+    def _costs(self, trade_value, sell_value):
+        fee = trade_value * self.fee_rate
+        fee = np.where(trade_value > 0, np.maximum(fee, self.min_fee), 0.0)
+        return fee, sell_value * self.tax_rate
+
+    def _target_shares(self, target_value, price, tradable):
+        shares = np.zeros_like(target_value)
+        lots = np.floor(target_value[tradable] / price[tradable] / self.lot_size)
+        shares[tradable] = lots * self.lot_size
+        return shares
+
+    def _rebalance(self, shares, cash, weight, t):
+        """單一換股日: 回傳 (新持股, 現金, 成交金額, 手續費, 證交稅)"""
+        price = self._prices[t]
+        tradable = self._tradable[t]
+        held_value = shares * price
+        equity = cash + held_value.sum()
+        weight = np.where(tradable, np.nan_to_num(weight), 0.0)
+        ## 停牌股票不能調整, 其餘資金依權重分配
+        frozen = ~tradable & (shares != 0)
+        budget = equity - held_value[frozen].sum()
+        total = weight.sum()
+        if total > 1:
+            weight = weight / total
+        new_shares = shares.copy()
+        target = weight * budget
+        for _ in range(2):
+            ## 先以目標部位估算交易成本, 再扣掉成本重算一次部位
+            new_shares[tradable] = self._target_shares(target, price, tradable)[tradable]
+            delta = (new_shares - shares) * price
+            fee, tax = self._costs(np.abs(delta), np.maximum(-delta, 0))
+            cost = fee.sum() + tax.sum()
+            target = weight * max(budget - cost, 0.0)
+        delta = (new_shares - shares) * price
+        fee, tax = self._costs(np.abs(delta), np.maximum(-delta, 0))
+        ## 估算後多賣出的部位 (最低手續費 / 證交稅) 可能讓成本超過預估:
+        ## 現金不足時由買進金額最大的股票逐單位減少, 不以融資回測
+        while delta.sum() + fee.sum() + tax.sum() > cash:
+            buys = np.flatnonzero(delta > 0)
+            if not len(buys):
+                break
+            i = buys[np.argmax(delta[buys])]
+            new_shares[i] -= self.lot_size
+            delta[i] = (new_shares[i] - shares[i]) * price[i]
+            fee, tax = self._costs(np.abs(delta), np.maximum(-delta, 0))
+        cash = cash - delta.sum() - fee.sum() - tax.sum()
+        return new_shares, cash, np.abs(delta).sum(), fee.sum(), tax.sum()
+
+    def run(self, weights, rebalance='M'):
+        """執行回測
+        params
+        ======
+        weights : dataframe (日期 x 股票)
+            目標權重, 只取換股日的列 (缺的日期/股票視為 0)
+        rebalance : (int or str)
+            換股頻率, 見 rebalance_dates
+
+        return
+        ======
+        dataframe (index 交易日)
+            equity 淨值, cash 現金, positions 持股檔數,
+            turnover 成交金額, fee 手續費, tax 證交稅
+        """
+        index = self.close.index
+        n_dates, n_codes = self._prices.shape
+        rows = rebalance_dates(index, rebalance)
+        target = weights.reindex(index=index[rows], columns=self.close.columns)
+        target = target.to_numpy(dtype=np.float64)
+
+        equity = np.full(n_dates, float(self.initial_capital))
+        cash_arr = np.full(n_dates, float(self.initial_capital))
+        positions = np.zeros(n_dates, dtype=np.int64)
+        turnover = np.zeros(n_dates)
+        fees = np.zeros(n_dates)
+        taxes = np.zeros(n_dates)
+        shares = np.zeros(n_codes)
+        cash = float(self.initial_capital)
+        bounds = np.append(rows, n_dates)
+        for k, t in enumerate(rows):
+            shares, cash, turnover[t], fees[t], taxes[t] = self._rebalance(
+                shares, cash, target[k], t)
+            ## 到下一個換股日前持股不動
+            period = slice(t, bounds[k + 1])
+            equity[period] = cash + self._prices[period] @ shares
+            cash_arr[period] = cash
+            positions[period] = np.count_nonzero(shares)
+        logging.info('backtest {} days x {} stocks, {} rebalances'.format(
+            n_dates, n_codes, len(rows)))
+        return pd.DataFrame({
+            'equity': equity,
+            'cash': cash_arr,
+            'positions': positions,
+            'turnover': turnover,
+            'fee': fees,
+            'tax': taxes,
+        }, index=index)
+
+
+def performance(equity):
+    """績效統計
+    params
+    ======
+    equity : series
+        淨值序列
+
+    return
+    ======
+    dict : 總報酬, 年化報酬, 年化波動度, sharpe, 最大回撤 (皆為比例)
+    """
+    equity = equity.dropna()
+    returns = equity.pct_change().dropna()
+    years = len(equity) / TRADING_DAYS_PER_YEAR
+    total = equity.iloc[-1] / equity.iloc[0] - 1
+    vol = returns.std() * np.sqrt(TRADING_DAYS_PER_YEAR)
+    return {
+        'total_return': total,
+        'cagr': (1 + total) ** (1 / years) - 1 if years > 0 and total > -1 else np.nan,
+        'volatility': vol,
+        'sharpe': returns.mean() * TRADING_DAYS_PER_YEAR / vol if vol > 0 else np.nan,
+        'max_drawdown': (1 - equity / equity.cummax()).max(),
+    }
@@ -0,0 +1,202 @@
+#! encoding = utf8
+"""sqlite 股價表 (tse_price / otc_price) 的格式轉換與查詢
+
+現行格式 (twse_crawler.price_table_sql):
+- WITHOUT ROWID, PRIMARY KEY (證券代號, yyyymmdd): 同一檔股票的歷史在 B-tree 中是連續的一段,
+  WHERE 證券代號 = ? AND yyyymmdd > ? ORDER BY yyyymmdd 只讀需要的頁面, 也不用排序
+- 索引 <table>_yyyymmdd: 某一天的全部股票 / MAX(yyyymmdd)
+- yyyymmdd 為整數
+舊格式 (PRIMARY KEY (yyyymmdd, 證券代號), 日期為文字) 以 migrate() 轉換
+
+PriceDB 的 SQL 依 (查詢, 表, 欄位) 產生一次, 參數一律以 ? 傳入,
+sqlite3 的 statement cache 會重複使用編譯好的 statement
+
+    import price_db
+    if price_db.needs_migration(con):
+        price_db.migrate(con)
+    db = price_db.PriceDB(con)
+    h = db.history('2330', start='20180101', columns=['收盤價'])
+"""
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from twse_crawler import PRICE_TABLES, bump_table_version, price_table_sql
+
+## 舊格式只有這兩個表 (market_price 一開始就是現行格式)
+MARKET_TABLES = ('tse_price', 'otc_price')
+
+## 舊資料的日期可能是 20180129 / '20180129' / '2018-01-29' / '2018-01-29 00:00:00'
+_DATE_SQL = """CASE typeof(yyyymmdd)
+            WHEN 'integer' THEN yyyymmdd
+            WHEN 'real' THEN CAST(yyyymmdd AS INTEGER)
+            ELSE CAST(REPLACE(REPLACE(SUBSTR(CAST(yyyymmdd AS TEXT), 1, 10), '-', ''), '/', '')
+                      AS INTEGER)
+        END"""
+
+
+def _table_columns(con, table):
+    """[(欄位, 是否為 primary key 的第幾欄)], 表不存在回傳 []"""
+    return [(row[1], row[5]) for row in con.execute('PRAGMA table_info({})'.format(table))]
+
+
+def table_layout(con, table):
+    """'missing' / 'current' / 'legacy'"""
+    columns = _table_columns(con, table)
+    if not columns:
+        return 'missing'
+    sql = con.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                      (table,)).fetchone()[0]
+    first_key = [name for name, pk in columns if pk == 1]
+    if 'WITHOUT ROWID' in sql.upper() and first_key == ['證券代號']:
+        return 'current'
+    return 'legacy'
+
+
+def needs_migration(con, tables=MARKET_TABLES):
+    """仍為舊格式的表"""
+    return [table for table in tables if table_layout(con, table) == 'legacy']
+
+
+def migrate(con, tables=MARKET_TABLES, analyze=True):
+    """舊格式的股價表 --> 現行格式 (同一個 transaction, 失敗則整個 rollback)
+    - 日期轉成整數 yyyymmdd, 證券代號 / 日期為空的列丟掉
+    - 轉換後同一 (證券代號, yyyymmdd) 有多筆 (e.g. '2018-01-29' 與 20180129) 時保留整數日期那筆
+    - 舊表釋出的頁面留在檔案中, 要縮小檔案需另外 VACUUM
+    params
+    ======
+    con : sqlite3 connection
+    tables : list of str
+    analyze : (bool)
+        完成後 ANALYZE, 讓 query planner 有統計資料
+
+    return
+    ======
+    dict : {table: {'rows': 轉換前筆數, 'migrated': 轉換後筆數, 'seconds'}}
+    """
+    report = {}
+    for table in needs_migration(con, tables):
+        started = time.perf_counter()
+        old = '{}_legacy'.format(table)
+        existing = [name for name, _ in _table_columns(con, table)]
+        columns = ['證券代號'] + [col for col, _ in PRICE_TABLES[table] if col in existing]
+        SQL_CREATE, SQL_INDEX = price_table_sql(table)
+        SQL_COPY = """
+            INSERT OR REPLACE INTO {0} (yyyymmdd, {1})
+            SELECT {2}, {1} FROM {3}
+            WHERE yyyymmdd IS NOT NULL AND 證券代號 IS NOT NULL
+            ORDER BY 證券代號, {2}, typeof(yyyymmdd) = 'integer'
+        """.format(table, ', '.join(columns), _DATE_SQL, old)
+        if con.in_transaction:
+            con.commit()
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            n_rows = con.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+            ## 舊表的 autoindex 會跟著改名, 新表的索引名稱不會衝突
+            con.execute('ALTER TABLE {} RENAME TO {}'.format(table, old))
+            con.execute(SQL_CREATE)
+            con.execute(SQL_COPY)
+            con.execute('DROP TABLE {}'.format(old))
+            con.execute(SQL_INDEX)
+            bump_table_version(con.cursor(), table)
+            n_migrated = con.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        report[table] = {'rows': n_rows, 'migrated': n_migrated,
+                         'seconds': time.perf_counter() - started}
+        logging.info('migrate {}: {}'.format(table, report[table]))
+    if report and analyze:
+        con.execute('ANALYZE')
+        con.commit()
+    return report
+
+
+class PriceDB:
+    """股價表的查詢
+    params
+    ======
+    con : sqlite3 connection
+    tables : list of str
+        查詢的表, 一檔股票只會在其中一個表; 只查合併表則為 ['market_price']
+    """
+
+    def __init__(self, con, tables=MARKET_TABLES):
+        self.con = con
+        self.tables = [table for table in tables if table_layout(con, table) != 'missing']
+        legacy = needs_migration(con, self.tables)
+        if legacy:
+            logging.warning('{} still in the old layout, run price_db.migrate(con)'.format(legacy))
+        self._columns = {table: set(name for name, _ in _table_columns(con, table))
+                         for table in self.tables}
+        self._sql = {}
+
+    def _select(self, table, columns):
+        return ', '.join(['yyyymmdd', '證券代號'] + [
+            col if col in self._columns[table] else 'NULL AS {}'.format(col)
+            for col in columns])
+
+    def _statement(self, kind, columns):
+        key = (kind, columns)
+        if key not in self._sql:
+            where = {
+                'history': '證券代號 = ? AND yyyymmdd BETWEEN ? AND ?',
+                'day': 'yyyymmdd = ?',
+            }[kind]
+            parts = ['SELECT {} FROM {} WHERE {}'.format(self._select(table, columns), table, where)
+                     for table in self.tables]
+            order = 'yyyymmdd' if kind == 'history' else '證券代號'
+            self._sql[key] = '{} ORDER BY {}'.format(' UNION ALL '.join(parts), order)
+        return self._sql[key]
+
+    def _query(self, sql, params, columns, as_frame):
+        rows = self.con.execute(sql, params * len(self.tables)).fetchall()
+        names = ['yyyymmdd', '證券代號'] + list(columns)
+        values = list(zip(*rows)) if rows else [()] * len(names)
+        out = {'yyyymmdd': np.array(values[0], dtype=np.int64),
+               '證券代號': np.array(values[1], dtype=object)}
+        for name, value in zip(names[2:], values[2:]):
+            out[name] = np.array(value, dtype=np.float64)
+        return pd.DataFrame(out) if as_frame else out
+
+    def history(self, code, start=None, end=None, columns=('收盤價',), as_frame=True):
+        """單一股票的歷史, 依日期排序
+        params
+        ======
+        code : (str) 證券代號
+        start, end : 日期範圍 (含), 任何 to_yyyymmdd 支援的格式
+        columns : list of str
+            數值欄位, 表中沒有的欄位為 NaN
+        as_frame : (bool)
+            False 則回傳 dict of numpy array
+
+        return
+        ======
+        dataframe (yyyymmdd, 證券代號 + columns)
+        """
+        from trading_calendar import to_yyyymmdd
+
+        columns = tuple(columns)
+        low = 0 if start is None else to_yyyymmdd(start)
+        high = 99991231 if end is None else to_yyyymmdd(end)
+        return self._query(self._statement('history', columns), [str(code), low, high],
+                           columns, as_frame)
+
+    def day(self, date, columns=('收盤價',), as_frame=True):
+        """某一天的全部股票, 依代號排序"""
+        from trading_calendar import to_yyyymmdd
+
+        columns = tuple(columns)
+        return self._query(self._statement('day', columns), [to_yyyymmdd(date)],
+                           columns, as_frame)
+
+    def last_date(self, table=None):
+        """最新的日期 (int yyyymmdd), 空表回傳 None"""
+        tables = self.tables if table is None else [table]
+        values = [self.con.execute('SELECT MAX(yyyymmdd) FROM {}'.format(t)).fetchone()[0]
+                  for t in tables]
+        values = [v for v in values if v is not None]
+        return max(values) if values else None
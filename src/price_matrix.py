@@ -0,0 +1,215 @@
+#! encoding = utf8
+"""日期 x 股票 的寬矩陣 (float32 memory-mapped .npy)
+
+<root>/meta.json   : 日期數, 股票代號清單, 容量
+<root>/dates.npy   : int32 yyyymmdd
+<root>/close.npy   : float32 (日期容量, 股票容量), 其他欄位同
+開啟時只做 memmap, 不讀進記憶體; 新交易日直接寫進預留的列(容量不足才擴充)
+"""
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+FIELDS = {
+    'open': '開盤價',
+    'high': '最高價',
+    'low': '最低價',
+    'close': '收盤價',
+    'volume': '成交量',
+}
+DATE_CAPACITY = 512
+CODE_CAPACITY = 256
+## 擴充時每次從舊檔複製的列數, 不把整個矩陣讀進記憶體
+GROW_ROWS = 1024
+
+
+class PriceMatrix:
+    """memory-mapped 的 date x stock 價格矩陣
+    params
+    ======
+    root : (str)
+        資料目錄
+    mode : (str)
+        'r' 唯讀 / 'r+' 可寫入
+    """
+
+    def __init__(self, root='price_matrix', mode='r'):
+        self.root = root
+        self.mode = mode
+        with open(self._path('meta.json'), encoding='utf8') as f:
+            self.meta = json.load(f)
+        self._code_index = {code: i for i, code in enumerate(self.meta['codes'])}
+        self._open()
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _open(self):
+        self._dates = np.load(self._path('dates.npy'), mmap_mode=self.mode)
+        self._fields = {field: np.load(self._path(field + '.npy'), mmap_mode=self.mode)
+                        for field in FIELDS}
+
+    @classmethod
+    def create(cls, root='price_matrix', date_capacity=DATE_CAPACITY,
+               code_capacity=CODE_CAPACITY):
+        """建立空的矩陣"""
+        os.makedirs(root, exist_ok=True)
+        dates = np.lib.format.open_memmap(os.path.join(root, 'dates.npy'), mode='w+',
+                                          dtype=np.int32, shape=(date_capacity,))
+        dates[:] = 0
+        del dates
+        for field in FIELDS:
+            matrix = np.lib.format.open_memmap(os.path.join(root, field + '.npy'), mode='w+',
+                                               dtype=np.float32,
+                                               shape=(date_capacity, code_capacity))
+            matrix[:] = np.nan
+            del matrix
+        meta = {'n_dates': 0, 'codes': [], 'fields': list(FIELDS)}
+        with open(os.path.join(root, 'meta.json'), 'w', encoding='utf8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        return cls(root, mode='r+')
+
+    @property
+    def dates(self):
+        """int32 yyyymmdd 陣列"""
+        return self._dates[:self.meta['n_dates']]
+
+    @property
+    def codes(self):
+        return list(self.meta['codes'])
+
+    @property
+    def shape(self):
+        return self.meta['n_dates'], len(self.meta['codes'])
+
+    def __getitem__(self, field):
+        """e.g. matrix['close'] --> (日期, 股票) 的 memmap view"""
+        return self._fields[field][:self.meta['n_dates'], :len(self.meta['codes'])]
+
+    def code_index(self, code):
+        return self._code_index[str(code)]
+
+    def date_slice(self, start=None, end=None):
+        """start ~ end (含) 對應的列範圍, 以二分搜尋取得"""
+        from trading_calendar import to_yyyymmdd
+
+        dates = self.dates
+        lo = 0 if start is None else int(np.searchsorted(dates, to_yyyymmdd(start), 'left'))
+        hi = len(dates) if end is None else int(np.searchsorted(dates, to_yyyymmdd(end), 'right'))
+        return slice(lo, hi)
+
+    def series(self, code, field='close', start=None, end=None):
+        """單一股票的時間序列 (numpy view)"""
+        return self[field][self.date_slice(start, end), self.code_index(code)]
+
+    def frame(self, field='close', start=None, end=None, codes=None):
+        """轉成 dataframe (index yyyymmdd, columns 證券代號)"""
+        rows = self.date_slice(start, end)
+        if codes is None:
+            values, columns = self[field][rows], self.codes
+        else:
+            columns = [str(code) for code in codes]
+            values = self[field][rows][:, [self.code_index(code) for code in columns]]
+        return pd.DataFrame(values, index=pd.Index(self.dates[rows], name='yyyymmdd'),
+                            columns=pd.Index(columns, name='證券代號'))
+
+    def _save_meta(self):
+        with open(self._path('meta.json'), 'w', encoding='utf8') as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+
+    def _grow(self, n_dates, n_codes, used):
+        """容量不足時以 2 倍擴充
+        新檔寫在 .tmp, 由舊的 memmap 每 GROW_ROWS 列複製一段, 完成後才取代舊檔
+        used : 擴充前已使用的 (日期數, 股票數)
+        """
+        date_cap, code_cap = self._fields['close'].shape
+        if n_dates <= date_cap and n_codes <= code_cap:
+            return
+        new_date_cap = date_cap if n_dates <= date_cap else max(date_cap * 2, n_dates)
+        new_code_cap = code_cap if n_codes <= code_cap else max(code_cap * 2, n_codes)
+        logging.info('grow price matrix to ({}, {})'.format(new_date_cap, new_code_cap))
+        used_dates, used_codes = used
+        dates = np.lib.format.open_memmap(self._path('dates.npy.tmp'), mode='w+',
+                                          dtype=np.int32, shape=(new_date_cap,))
+        dates[:] = 0
+        dates[:used_dates] = self._dates[:used_dates]
+        dates.flush()
+        del dates
+        for field in FIELDS:
+            old = self._fields[field]
+            matrix = np.lib.format.open_memmap(self._path(field + '.npy.tmp'), mode='w+',
+                                               dtype=np.float32,
+                                               shape=(new_date_cap, new_code_cap))
+            for start in range(0, new_date_cap, GROW_ROWS):
+                stop = min(start + GROW_ROWS, new_date_cap)
+                matrix[start:stop] = np.nan
+                if start < used_dates:
+                    copy = min(stop, used_dates)
+                    matrix[start:copy, :used_codes] = old[start:copy, :used_codes]
+            matrix.flush()
+            del matrix, old
+        self._dates = self._fields = None
+        for name in ['dates'] + list(FIELDS):
+            os.replace(self._path(name + '.npy.tmp'), self._path(name + '.npy'))
+        self._open()
+
+    def append(self, df):
+        """寫入新的交易日 (已存在的日期則覆寫該格)
+        params
+        ======
+        df : dataframe
+            tse_price / otc_price 格式 (證券代號, yyyymmdd, 開盤價 ...)
+            新日期需晚於矩陣內最後一個日期
+        return
+        ======
+        新增的日期數
+        """
+        from price_store import yyyymmdd_series
+
+        if self.mode == 'r':
+            raise IOError('price matrix opened read-only, use mode="r+"')
+        if df is None or len(df) == 0:
+            return 0
+        days = yyyymmdd_series(df['yyyymmdd']).to_numpy()
+        codes = df['證券代號'].astype(str).to_numpy()
+        old_dates = self.dates
+        new_dates = np.unique(days[~np.isin(days, old_dates)])
+        if len(old_dates) and len(new_dates) and new_dates[0] < old_dates[-1]:
+            raise ValueError('cannot insert {} before last date {}'.format(
+                new_dates[0], old_dates[-1]))
+        used = self.shape
+        for code in pd.unique(codes):
+            if code not in self._code_index:
+                self._code_index[code] = len(self.meta['codes'])
+                self.meta['codes'].append(code)
+        n_dates = len(old_dates) + len(new_dates)
+        self._grow(n_dates, len(self.meta['codes']), used)
+        self._dates[len(old_dates):n_dates] = new_dates
+        self.meta['n_dates'] = n_dates
+
+        rows = np.searchsorted(self.dates, days)
+        cols = np.fromiter((self._code_index[code] for code in codes), dtype=np.int64,
+                           count=len(codes))
+        for field, column in FIELDS.items():
+            if column in df.columns:
+                self._fields[field][rows, cols] = df[column].to_numpy(dtype=np.float32)
+        for matrix in self._fields.values():
+            matrix.flush()
+        self._dates.flush()
+        self._save_meta()
+        return len(new_dates)
+
+    @classmethod
+    def build_from_sqlite(cls, con, root='price_matrix', tables=('tse_price', 'otc_price'),
+                          chunksize=500000):
+        """由 sqlite 股價表建立矩陣 (依日期排序分批寫入)"""
+        matrix = cls.create(root)
+        sql = 'SELECT * FROM ({}) ORDER BY yyyymmdd'.format(
+            ' UNION ALL '.join('SELECT 證券代號, yyyymmdd, 開盤價, 最高價, 最低價, 收盤價, 成交量 '
+                               'FROM {}'.format(table) for table in tables))
+        for chunk in pd.read_sql_query(sql, con, chunksize=chunksize):
+            matrix.append(chunk)
+        return matrix
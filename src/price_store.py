@@ -0,0 +1,193 @@
+#! encoding = utf8
+"""Parquet 股價資料集 (與 sqlite 的 tse_price / otc_price 並存)
+
+目錄結構 <root>/market=tse/year=2018/part-0.parquet
+- 依 market / year 分區, 查詢時只讀需要的分區
+- 分區內依 (證券代號, yyyymmdd) 排序寫入, row group 的 min/max 統計
+  讓單一股票的查詢只讀少數 row group
+- 只讀需要的欄位
+
+需要 pyarrow
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+MARKETS = ('tse', 'otc')
+## 兩個市場欄位的聯集, 缺的欄位補 NaN
+PRICE_SCHEMA = [
+    ('證券代號', 'string'),
+    ('yyyymmdd', 'int32'),
+    ('成交量', 'float64'),
+    ('成交筆數', 'float64'),
+    ('成交金額', 'float64'),
+    ('開盤價', 'float64'),
+    ('最高價', 'float64'),
+    ('最低價', 'float64'),
+    ('收盤價', 'float64'),
+    ('本益比', 'float64'),
+]
+PRICE_COLUMNS = [name for name, _ in PRICE_SCHEMA]
+ROW_GROUP_SIZE = 32768
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('price_store requires pyarrow: pip install pyarrow')
+    return pyarrow
+
+
+def yyyymmdd_series(series):
+    """'2018-01-29' / '20180129' / 20180129 / datetime --> int32 yyyymmdd (整欄轉換)"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return (series.dt.year * 10000 + series.dt.month * 100 + series.dt.day).astype('int32')
+    if pd.api.types.is_integer_dtype(series):
+        return series.astype('int32')
+    text = series.astype(str).str.replace(r'\D', '', regex=True).str[:8]
+    return pd.to_numeric(text).astype('int32')
+
+
+def normalize_prices(df):
+    """轉成 PRICE_SCHEMA 的欄位與型別"""
+    out = pd.DataFrame(index=df.index)
+    for name, dtype in PRICE_SCHEMA:
+        if name == 'yyyymmdd':
+            out[name] = yyyymmdd_series(df[name])
+        elif name in df.columns:
+            out[name] = df[name].astype(dtype)
+        else:
+            out[name] = pd.Series(np.nan, index=df.index, dtype=dtype)
+    return out.reset_index(drop=True)
+
+
+class ParquetPriceStore:
+    """依 market / year 分區的 parquet 股價資料集
+    params
+    ======
+    root : (str)
+        資料集目錄
+    """
+
+    def __init__(self, root='price_store'):
+        self.root = root
+
+    def _partition_dir(self, market, year):
+        return os.path.join(self.root, 'market={}'.format(market), 'year={}'.format(year))
+
+    def _schema(self):
+        pa = _pyarrow()
+        return pa.schema([(name, pa.string() if dtype == 'string' else pa.from_numpy_dtype(dtype))
+                          for name, dtype in PRICE_SCHEMA])
+
+    def write(self, df, market):
+        """寫入(合併)股價, 同一 (證券代號, yyyymmdd) 以新資料為準
+        params
+        ======
+        df : dataframe
+            tse_price / otc_price 格式
+        market : (str)
+            'tse' or 'otc'
+        return
+        ======
+        寫入筆數
+        """
+        pa = _pyarrow()
+        assert market in MARKETS, 'market must be one of {}'.format(MARKETS)
+        if df is None or len(df) == 0:
+            return 0
+        df = normalize_prices(df)
+        years = df['yyyymmdd'] // 10000
+        for year, part in df.groupby(years):
+            directory = self._partition_dir(market, year)
+            path = os.path.join(directory, 'part-0.parquet')
+            if os.path.exists(path):
+                old = pa.parquet.read_table(path).to_pandas()
+                part = pd.concat([old, part], ignore_index=True)
+            part = part.drop_duplicates(['證券代號', 'yyyymmdd'], keep='last')
+            part = part.sort_values(['證券代號', 'yyyymmdd'])
+            table = pa.Table.from_pandas(part, schema=self._schema(), preserve_index=False)
+            os.makedirs(directory, exist_ok=True)
+            tmp = path + '.tmp'
+            pa.parquet.write_table(table, tmp, row_group_size=ROW_GROUP_SIZE)
+            os.replace(tmp, path)
+            logging.debug('write {} rows to {}'.format(len(part), path))
+        return len(df)
+
+    def dataset(self):
+        pa = _pyarrow()
+        return pa.dataset.dataset(self.root, format='parquet', partitioning='hive',
+                                  schema=self._schema().append(pa.field('market', pa.string()))
+                                  .append(pa.field('year', pa.int32())))
+
+    def load_prices(self, ids=None, start=None, end=None, columns=None, markets=None):
+        """查詢股價, 條件下推到分區與 row group
+        params
+        ======
+        ids : list of str
+            證券代號, None 代表全部
+        start, end : 日期 (含), 任何 to_yyyymmdd 支援的格式
+        columns : list of str
+            需要的欄位 (證券代號, yyyymmdd 一定會包含)
+        markets : list of str
+            'tse' / 'otc', None 代表全部
+
+        return
+        ======
+        dataframe 依 (證券代號, yyyymmdd) 排序
+        """
+        pa = _pyarrow()
+        from trading_calendar import to_yyyymmdd
+
+        if not os.path.isdir(self.root):
+            return pd.DataFrame(columns=(['證券代號', 'yyyymmdd'] + list(columns or [])))
+        field = pa.dataset.field
+        expr = None
+
+        def add(cond):
+            return cond if expr is None else expr & cond
+
+        if markets is not None:
+            expr = add(field('market').isin(list(markets)))
+        if start is not None:
+            start = to_yyyymmdd(start)
+            expr = add((field('year') >= start // 10000) & (field('yyyymmdd') >= start))
+        if end is not None:
+            end = to_yyyymmdd(end)
+            expr = add((field('year') <= end // 10000) & (field('yyyymmdd') <= end))
+        if ids is not None:
+            ids = [ids] if isinstance(ids, str) else [str(i) for i in ids]
+            expr = add(field('證券代號').isin(ids))
+        if columns is None:
+            columns = PRICE_COLUMNS + ['market']
+        columns = ['證券代號', 'yyyymmdd'] + [c for c in columns if c not in ('證券代號', 'yyyymmdd')]
+        table = self.dataset().to_table(columns=columns, filter=expr)
+        df = table.to_pandas()
+        return df.sort_values(['證券代號', 'yyyymmdd']).reset_index(drop=True)
+
+    def export_from_sqlite(self, con, chunksize=500000):
+        """把 sqlite 的 tse_price / otc_price 轉存到 parquet 資料集
+        依日期讀出 (yyyymmdd 索引), 經 streaming.ParquetSink 累積到換年度才寫出,
+        每個年度分區只寫一次
+        """
+        from streaming import ParquetSink
+
+        total = 0
+        for market in MARKETS:
+            sql = 'SELECT * FROM {}_price ORDER BY yyyymmdd'.format(market)
+            with ParquetSink(self, market) as sink:
+                for chunk in pd.read_sql_query(sql, con, chunksize=chunksize):
+                    sink.write(chunk)
+            total += sink.rows
+            logging.info('export {}_price done: {}'.format(market, sink.result()))
+        return total
+
+
+def load_prices(ids=None, start=None, end=None, columns=None, markets=None, root='price_store'):
+    """ParquetPriceStore(root).load_prices 的捷徑"""
+    return ParquetPriceStore(root).load_prices(ids, start, end, columns, markets)
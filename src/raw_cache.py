@@ -0,0 +1,160 @@
+#! encoding = utf8
+"""原始回應的本地快取
+
+每個回應以 (endpoint, 參數) 的 sha256 為 key, gzip 壓縮後存成
+<root>/<endpoint>/<key[:2]>/<key>.gz, 旁邊的 <key>.json 記錄參數與抓取時間
+- 已收盤的交易日/已定案的月份: immutable, 永不過期
+- 當日行情/當月營收: 有 TTL, 過期後重抓
+- 空白(假日/尚未公布)或錯誤的回應不寫入 (見 fetch 的 validate)
+parser 修改後可用 iter_entries 離線重跑全部歷史資料, 不需連網
+"""
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import metrics
+
+## 當日行情/當月資料的預設存活秒數
+DAILY_TTL = 10 * 60
+MONTHLY_TTL = 24 * 60 * 60
+
+
+def daily_policy(day, today=None):
+    """每日行情: 今天以前的資料不會再變動
+    return
+    ======
+    (immutable, ttl)
+    """
+    today = datetime.date.today() if today is None else today
+    return day < today, DAILY_TTL
+
+
+def monthly_policy(year, month, today=None):
+    """月營收: 上個月(10日前陸續公布)與本月仍會變動, 更早的月份視為定案
+    year : 西元年
+    """
+    today = datetime.date.today() if today is None else today
+    last_month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+    return (year, month) < last_month, MONTHLY_TTL
+
+
+def seasonal_policy(year, season, today=None):
+    """季報: 公布期限(5/15, 8/14, 11/14, 隔年3/31)後一個月視為定案"""
+    today = datetime.date.today() if today is None else today
+    deadline = {
+        1: datetime.date(year, 5, 15),
+        2: datetime.date(year, 8, 14),
+        3: datetime.date(year, 11, 14),
+        4: datetime.date(year + 1, 3, 31),
+    }[int(season)]
+    return today > deadline + datetime.timedelta(days=30), MONTHLY_TTL
+
+
+class RawCache:
+    """原始回應的磁碟快取
+    params
+    ======
+    root : (str)
+        快取目錄
+    """
+
+    def __init__(self, root='raw_cache'):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(endpoint, params):
+        text = json.dumps([endpoint, params], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+    def _path(self, endpoint, key):
+        return os.path.join(self.root, endpoint, key[:2], key)
+
+    def _write(self, path, content):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def get(self, endpoint, params):
+        """讀取快取, 不存在或已過期回傳 None"""
+        path = self._path(endpoint, self.key(endpoint, params))
+        try:
+            with open(path + '.json', encoding='utf8') as f:
+                meta = json.load(f)
+            if not meta['immutable'] and time.time() - meta['fetched_at'] > meta['ttl']:
+                return None
+            with open(path + '.gz', 'rb') as f:
+                return gzip.decompress(f.read())
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, endpoint, params, content, immutable=True, ttl=None):
+        """寫入快取
+        params
+        ======
+        content : (bytes)
+            原始回應
+        immutable : (bool)
+            True 代表資料已定案, 永不過期
+        ttl : (int)
+            immutable=False 時的存活秒數
+        """
+        path = self._path(endpoint, self.key(endpoint, params))
+        self._write(path + '.gz', gzip.compress(content))
+        meta = {
+            'endpoint': endpoint,
+            'params': params,
+            'fetched_at': time.time(),
+            'immutable': bool(immutable),
+            'ttl': ttl,
+        }
+        self._write(path + '.json', json.dumps(meta, ensure_ascii=False, default=str).encode('utf8'))
+
+    def fetch(self, endpoint, params, download, immutable=True, ttl=None, validate=None):
+        """有快取就讀快取, 否則呼叫 download() 取得 bytes 並寫入
+        params
+        ======
+        endpoint : (str)
+            e.g. 'tse_mi_index'
+        params : (dict)
+            決定內容的參數 (不含 cache buster 之類的參數)
+        download : callable() -> bytes
+        validate : callable(bytes) -> bool
+            回應是否為完整的資料; False (空白/錯誤頁) 則不寫入, 下次重新下載
+        """
+        content = self.get(endpoint, params)
+        if content is not None:
+            self.hits += 1
+            metrics.inc('cache.hits')
+            return content
+        self.misses += 1
+        metrics.inc('cache.misses')
+        content = download()
+        if validate is not None and not validate(content):
+            metrics.inc('cache.rejected')
+            return content
+        self.put(endpoint, params, content, immutable, ttl)
+        return content
+
+    def iter_entries(self, endpoint):
+        """依序讀出某 endpoint 所有快取 (meta, content), 供離線重新解析"""
+        directory = os.path.join(self.root, endpoint)
+        if not os.path.isdir(directory):
+            return
+        for sub in sorted(os.listdir(directory)):
+            for name in sorted(os.listdir(os.path.join(directory, sub))):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(directory, sub, name[:-len('.json')])
+                with open(path + '.json', encoding='utf8') as f:
+                    meta = json.load(f)
+                with open(path + '.gz', 'rb') as f:
+                    yield meta, gzip.decompress(f.read())
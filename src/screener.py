@@ -0,0 +1,276 @@
+#! encoding = utf8
+"""選股條件查詢
+
+條件以宣告式寫法給定, e.g.
+    ['成交筆數 > 1000', '本益比 < 15', ('毛利率(%)(營業毛利)/(營業收入)', '>', 30)]
+資料為 point_in_time 的特徵表 (證券代號, yyyymmdd, 各欄位), 依日期排好後每天是一段連續的列
+- 單日查詢 : 每個欄位在每一天內預先排序 (第一次使用時建立), 條件先用二分搜尋
+  算出符合筆數, 從最少的條件開始取出候選, 其餘條件只比對候選列
+- 整段歷史 : 先抽樣估計各條件的符合比例, 由最嚴格的條件開始, 每個條件只比對
+  前面條件留下的列
+每次查詢記錄各條件的符合筆數 / 比例 / 耗時 (last_stats)
+文字欄位的條件只支援 == / != (e.g. '上市櫃 == sii')
+"""
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+OPS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal,
+    '!=': np.not_equal,
+}
+_CONDITION = re.compile(r'^\s*(.+?)\s*(<=|>=|==|!=|<|>)\s*(\S+)\s*$')
+## screen_all 估計條件符合比例的抽樣列數
+SAMPLE_ROWS = 4096
+
+
+class Condition:
+    """單一條件
+    params
+    ======
+    column : (str)
+        欄位名稱
+    op : (str)
+        <, <=, >, >=, ==, != , between (value 為 (下限, 上限), 含), in (value 為 list)
+    value :
+        比較值, 文字只能用 == / !=
+    """
+
+    def __init__(self, column, op, value):
+        if op not in OPS and op not in ('between', 'in'):
+            raise ValueError('unknown op {!r}'.format(op))
+        if isinstance(value, str) and op not in ('==', '!='):
+            raise ValueError('{} {} needs a numeric value, got {!r}'.format(column, op, value))
+        self.column = column
+        self.op = op
+        self.value = value
+
+    @classmethod
+    def parse(cls, condition):
+        """'本益比 < 15' / ('本益比', '<', 15) / Condition --> Condition"""
+        if isinstance(condition, Condition):
+            return condition
+        if isinstance(condition, str):
+            match = _CONDITION.match(condition)
+            if match is None:
+                raise ValueError('cannot parse condition {!r}'.format(condition))
+            column, op, value = match.groups()
+            try:
+                value = float(value)
+            except ValueError:
+                ## 文字 (e.g. 上市櫃 == sii), 可加引號
+                value = value.strip('\'"')
+            return cls(column, op, value)
+        return cls(*condition)
+
+    def mask(self, values):
+        """整個陣列的比較結果, NaN 一律不符合"""
+        if self.op == 'between':
+            low, high = self.value
+            return (values >= low) & (values <= high)
+        if self.op == 'in':
+            return np.isin(values, list(self.value))
+        if isinstance(self.value, str):
+            values = np.asarray(values, dtype=object)
+            return OPS[self.op](values, self.value).astype(bool) & ~pd.isna(values)
+        with np.errstate(invalid='ignore'):
+            return OPS[self.op](values, self.value)
+
+    def __repr__(self):
+        return '{} {} {}'.format(self.column, self.op, self.value)
+
+
+class Screener:
+    """特徵表上的選股查詢
+    params
+    ======
+    panel : dataframe
+        含 證券代號, yyyymmdd 與條件用到的欄位 (e.g. point_in_time.load_feature_panel)
+    """
+
+    def __init__(self, panel, code_col='證券代號', date_col='yyyymmdd'):
+        dates = panel[date_col].to_numpy(dtype=np.int64)
+        ## 不複製整張表, 只記錄依日期排序的列順序, 欄位用到時才取出
+        self._order = np.argsort(dates, kind='stable')
+        self.panel = panel
+        self.code_col = code_col
+        self.date_col = date_col
+        self._row_dates = dates[self._order]
+        self.dates, starts = np.unique(self._row_dates, return_index=True)
+        self._bounds = np.append(starts, len(dates))
+        self._codes = np.asarray(panel[code_col].to_numpy())[self._order]
+        self._values = {}
+        self._sorted = {}
+        self.last_stats = None
+
+    @classmethod
+    def from_sqlite(cls, con, path='feature_panel.parquet', **kwargs):
+        """由 point_in_time.load_feature_panel 的特徵表建立"""
+        from point_in_time import load_feature_panel
+
+        return cls(load_feature_panel(con, path, **kwargs))
+
+    def _column(self, column):
+        if column not in self._values:
+            values = self.panel[column]
+            if pd.api.types.is_numeric_dtype(values):
+                values = values.to_numpy(dtype=np.float64, na_value=np.nan)
+            else:
+                values = np.asarray(values.to_numpy())
+            self._values[column] = values[self._order]
+        return self._values[column]
+
+    def _sorted_index(self, column):
+        """欄位在每一天內由小到大排序後的列位置 (NaN 排在最後)"""
+        if column not in self._sorted:
+            values = self._column(column)
+            day = np.repeat(np.arange(len(self.dates)), np.diff(self._bounds))
+            order = np.lexsort((values, day))
+            sorted_values = values[order]
+            ## 每天非 NaN 的筆數
+            valid = np.add.reduceat(~np.isnan(values), self._bounds[:-1]) \
+                if len(values) else np.zeros(0, dtype=np.int64)
+            self._sorted[column] = (order, sorted_values, valid)
+        return self._sorted[column]
+
+    def _day(self, date):
+        from trading_calendar import to_yyyymmdd
+
+        i = int(np.searchsorted(self.dates, to_yyyymmdd(date)))
+        if i == len(self.dates) or self.dates[i] != to_yyyymmdd(date):
+            raise KeyError('no data at {}'.format(date))
+        return i
+
+    def _day_range(self, start, end):
+        from trading_calendar import to_yyyymmdd
+
+        first = 0 if start is None else int(np.searchsorted(self.dates, to_yyyymmdd(start)))
+        last = len(self.dates) if end is None else \
+            int(np.searchsorted(self.dates, to_yyyymmdd(end), 'right'))
+        return first, last
+
+    def _index_range(self, condition, day):
+        """用排序陣列二分搜尋, 回傳符合條件的列位置; 無法用範圍表示的條件回傳 None"""
+        if condition.op in ('!=', 'in') or isinstance(condition.value, str) or \
+                not pd.api.types.is_numeric_dtype(self.panel[condition.column]):
+            return None
+        order, sorted_values, valid = self._sorted_index(condition.column)
+        lo = self._bounds[day]
+        values = sorted_values[lo:lo + valid[day]]
+        op, value = condition.op, condition.value
+        if op == 'between':
+            i = np.searchsorted(values, value[0], 'left')
+            j = np.searchsorted(values, value[1], 'right')
+        elif op in ('<', '<='):
+            i, j = 0, np.searchsorted(values, value, 'left' if op == '<' else 'right')
+        elif op in ('>', '>='):
+            i, j = np.searchsorted(values, value, 'right' if op == '>' else 'left'), len(values)
+        else:
+            i, j = np.searchsorted(values, value, 'left'), np.searchsorted(values, value, 'right')
+        return order[lo + i:lo + max(i, j)]
+
+    def screen(self, date, conditions, columns=None):
+        """單日選股
+        params
+        ======
+        date : 交易日
+        conditions : list of Condition / str / tuple
+        columns : list of str
+            回傳的欄位, 預設為條件用到的欄位
+
+        return
+        ======
+        dataframe (證券代號 + columns), 依代號排序
+        各條件的統計存在 self.last_stats
+        """
+        conditions = [Condition.parse(c) for c in conditions]
+        day = self._day(date)
+        lo, hi = self._bounds[day], self._bounds[day + 1]
+        universe = hi - lo
+        ## 先以排序陣列算出各條件單獨的符合列
+        matches, stats = [], []
+        for condition in conditions:
+            start = time.perf_counter()
+            rows = self._index_range(condition, day)
+            if rows is None:
+                rows = lo + np.flatnonzero(condition.mask(self._column(condition.column)[lo:hi]))
+            matches.append(rows)
+            stats.append({'condition': repr(condition), 'matched': len(rows),
+                          'selectivity': len(rows) / universe if universe else 0.0,
+                          'ms': (time.perf_counter() - start) * 1000})
+        ## 由最嚴格的條件開始, 其餘條件只比對候選列
+        order = sorted(range(len(conditions)), key=lambda k: stats[k]['matched'])
+        candidates = np.arange(lo, hi) if not order else np.sort(matches[order[0]])
+        for rank, k in enumerate(order):
+            start = time.perf_counter()
+            if rank:
+                values = self._column(conditions[k].column)[candidates]
+                candidates = candidates[conditions[k].mask(values)]
+            stats[k]['remaining'] = len(candidates)
+            stats[k]['ms'] += (time.perf_counter() - start) * 1000
+            stats[k]['rank'] = rank
+        self.last_stats = pd.DataFrame(stats)
+        return self._result(candidates, conditions, columns)
+
+    def screen_all(self, conditions, start=None, end=None, columns=None):
+        """同一組條件套用在每個交易日
+        params
+        ======
+        start, end : 日期範圍 (含), 預設為全部
+
+        return
+        ======
+        dataframe (證券代號, yyyymmdd + columns), 依 (yyyymmdd, 證券代號) 排序
+        """
+        conditions = [Condition.parse(c) for c in conditions]
+        first, last = self._day_range(start, end)
+        lo, hi = self._bounds[first], self._bounds[last]
+        universe = hi - lo
+        ## 均勻抽樣估計各條件的符合比例 (selectivity), 只用來決定比對順序
+        sample = np.unique(np.linspace(lo, hi - 1, min(universe, SAMPLE_ROWS)).astype(np.int64))
+        stats = []
+        for condition in conditions:
+            t0 = time.perf_counter()
+            matched = int(np.count_nonzero(condition.mask(self._column(condition.column)[sample])))
+            stats.append({'condition': repr(condition),
+                          'selectivity': matched / len(sample) if len(sample) else 0.0,
+                          'ms': (time.perf_counter() - t0) * 1000})
+        order = sorted(range(len(conditions)), key=lambda k: stats[k]['selectivity'])
+        ## 第一個條件比對整段, 之後的條件只比對前面留下的列
+        rows = np.arange(lo, hi)
+        for rank, k in enumerate(order):
+            t0 = time.perf_counter()
+            column = self._column(conditions[k].column)
+            values = column[lo:hi] if rank == 0 else column[rows]
+            stats[k]['evaluated'] = len(rows)
+            rows = rows[conditions[k].mask(values)]
+            stats[k]['remaining'] = len(rows)
+            stats[k]['ms'] += (time.perf_counter() - t0) * 1000
+            stats[k]['rank'] = rank
+        self.last_stats = pd.DataFrame(stats)
+        result = self._result(rows, conditions, columns, sort=False)
+        result.insert(1, self.date_col, self._row_dates[rows])
+        return result.sort_values([self.date_col, self.code_col]).reset_index(drop=True)
+
+    def _result(self, rows, conditions, columns, sort=True):
+        if columns is None:
+            columns = list(dict.fromkeys(c.column for c in conditions))
+        out = {self.code_col: np.asarray(self._codes[rows]).astype(str)}
+        for column in columns:
+            out[column] = self._column(column)[rows]
+        result = pd.DataFrame(out)
+        if sort:
+            result = result.sort_values(self.code_col).reset_index(drop=True)
+        return result
+
+    def counts(self, conditions, start=None, end=None):
+        """每個交易日符合的檔數 (series, index yyyymmdd)"""
+        first, last = self._day_range(start, end)
+        result = self.screen_all(conditions, start, end, columns=[])
+        return result.groupby(self.date_col).size().reindex(self.dates[first:last], fill_value=0)
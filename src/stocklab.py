@@ -0,0 +1,274 @@
+#! encoding = utf8
+"""stocklab 命令列
+
+    python src/stocklab.py sync --check                  # 今天是否開盤 / 還有幾天待抓
+    python src/stocklab.py sync --db twse.db
+    python src/stocklab.py crawl --market tse otc --start 20180101 --end 20181231 \\
+        --backend parquet --db price_store
+    python src/stocklab.py backtest --code 2330 --strategy 2 --keep 10 --buy -0.1
+    python src/stocklab.py sweep --code 2330 --keep 2:30:2 --buy -0.05:-0.16:-0.01
+
+module top 只 import 標準函式庫; 各子命令用到的套件 (pandas / requests / pyarrow / pypyodbc)
+在子命令內才 import, 儲存後端由 storage.get_backend 依名稱載入.
+--timing 印出啟動時間 (到子命令開始工作為止) 與總時間
+"""
+import time
+
+_STARTED = time.perf_counter()
+
+import argparse  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _ready(args):
+    """子命令需要的模組都已 import, 記錄啟動時間"""
+    args.startup = (time.perf_counter() - _STARTED, len(sys.modules))
+    logging.info('startup {:.3f}s, {} modules loaded'.format(*args.startup))
+
+
+def _use_abu_qt():
+    ## 回測相關模組在 abu_QT/
+    path = os.path.join(HERE, '..', 'abu_QT')
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def _backend(args):
+    from storage import get_backend
+
+    options = {}
+    if args.backend == 'sqlserver' and args.password_file is not None:
+        options['password_file'] = args.password_file
+    return get_backend(args.backend, args.db, **options)
+
+
+def _values(text, cast):
+    """'2:30:2' (同 range, 不含終點) 或 '5,10,20' --> list"""
+    if ':' not in text:
+        return [cast(v) for v in text.split(',')]
+    start, stop, step = (cast(v) for v in text.split(':'))
+    n = int(round((stop - start) / step))
+    return [cast(round(start + i * step, 6)) for i in range(max(n, 0))]
+
+
+def cmd_crawl(args):
+    """抓取股價寫入後端 (streaming.export_prices)"""
+    from fetch_engine import FetchEngine
+    from streaming import export_prices
+
+    _ready(args)
+    backend = _backend(args)
+    engine = FetchEngine(max_workers=args.workers, rate=args.rate)
+    errors = 0
+    try:
+        for market in args.market:
+            report = export_prices(market, backend.sink(market), start=args.start,
+                                   end=args.end, n_days=args.days, engine=engine)
+            errors += report['errors']
+            print('{}: {}'.format(market, report))
+    finally:
+        backend.close()
+    return 1 if errors else 0
+
+
+def _check(job, markets):
+    """今天是否開盤 / 各市場待抓日期; 有待抓日期回傳 0, 沒有回傳 1"""
+    import datetime
+
+    today = datetime.date.today()
+    status = {True: 'yes', False: 'no', None: 'unknown'}[job.calendar.is_trading_day(today)]
+    print('{} trading day: {}'.format(today, status))
+    pending = 0
+    for market in markets:
+        days = job.pending_days(market)
+        last = job.last_date(market)
+        pending += len(days)
+        print('{}: last {}, {} pending{}'.format(
+            market, last, len(days),
+            ' ({} ~ {})'.format(days[0], days[-1]) if days else ''))
+    return 0 if pending else 1
+
+
+def cmd_sync(args):
+    """增量同步 sqlite 的 tse_price / otc_price (sync.SyncJob)"""
+    import sqlite3
+
+    from sync import SyncJob
+    from trading_calendar import to_date
+
+    if args.check:
+        _ready(args)
+        con = sqlite3.connect(args.db)
+        try:
+            return _check(SyncJob(con), args.market)
+        finally:
+            con.close()
+
+    from fetch_engine import FetchEngine
+    from twse_crawler import enable_wal
+
+    _ready(args)
+    con = sqlite3.connect(args.db)
+    enable_wal(con)
+    try:
+        job = SyncJob(con, engine=FetchEngine(max_workers=args.workers, rate=args.rate),
+                      batch_days=args.batch_days)
+        report = job.run(args.market,
+                         start=None if args.start is None else to_date(args.start),
+                         end=None if args.end is None else to_date(args.end))
+    finally:
+        con.close()
+    for market, result in report.items():
+        print('{}: {}'.format(market, result))
+    return 1 if any(result['errors'] for result in report.values()) else 0
+
+
+def _load_trade_days(args):
+    from stock import StockTradeDays
+
+    backend = _backend(args)
+    try:
+        df = backend.history(args.code, args.start, args.end, ['收盤價'])
+    finally:
+        backend.close()
+    df = df.dropna(subset=['收盤價'])
+    if df.empty:
+        raise SystemExit('no price data for {}'.format(args.code))
+    return StockTradeDays(df['收盤價'].to_numpy(), None, df['yyyymmdd'].astype(str).to_numpy())
+
+
+def _strategy_cls(name):
+    from stock import TradeStrategy1, TradeStrategy2
+
+    return {'1': TradeStrategy1, '2': TradeStrategy2}[name]
+
+
+def cmd_backtest(args):
+    """單一股票 / 單組參數的向量化回測"""
+    _use_abu_qt()
+    from stock import VectorTradeLoopBack
+
+    _ready(args)
+    trade_days = _load_trade_days(args)
+    params = {'keep_stock_threshold': args.keep, 'buy_change_threshold': args.buy}
+    strategy = _strategy_cls(args.strategy)(**{k: v for k, v in params.items() if v is not None})
+    loop_back = VectorTradeLoopBack(trade_days, strategy)
+    loop_back.execute_trade()
+    profit = float(loop_back.profit_array.sum()) if len(loop_back.profit_array) else 0.0
+    print('{} {} ~ {} ({} days), strategy {}: keep {} buy {}'.format(
+        args.code, trade_days.date_array[0], trade_days.date_array[-1], len(trade_days),
+        args.strategy, strategy.keep_stock_threshold, args.buy))
+    print('trades {}, days held {}, profit {:.4f}'.format(
+        len(loop_back.buy_indices), len(loop_back.profit_array), profit))
+    return 0
+
+
+def cmd_sweep(args):
+    """持股天數 x 買入閥值 的平行參數掃描 (sweep.sweep)"""
+    _use_abu_qt()
+    from sweep import sweep
+
+    _ready(args)
+    trade_days = _load_trade_days(args)
+    keep_list = _values(args.keep, int)
+    buy_list = _values(args.buy, float)
+    print('持股天數--參數組:{}'.format(keep_list))
+    print('下跌閥值--參數組:{}'.format(buy_list))
+    result = sweep(trade_days, keep_list, buy_list, strategy_cls=_strategy_cls(args.strategy),
+                   processes=args.processes, top_k=args.top_k)
+    print('共測試:{}組'.format(len(keep_list) * len(buy_list)))
+    for profit, keep, buy, trades in result:
+        print('{:>10.4f}  keep {:>3}  buy {:>6}  trades {}'.format(profit, keep, buy, trades))
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='stocklab', description='台股爬蟲 / 同步 / 回測')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--log-file', default=None)
+    parser.add_argument('--timing', action='store_true', help='印出啟動時間與總時間')
+    parser.add_argument('--metrics', default=None,
+                        help='結束時寫出 metrics (.prom / .txt 為 Prometheus, 其他為 JSON)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    from storage import BACKENDS
+
+    def add_storage(sub, default_backend='sqlite'):
+        sub.add_argument('--backend', default=default_backend, choices=sorted(BACKENDS),
+                         help='儲存後端 (storage.BACKENDS)')
+        sub.add_argument('--db', default=None,
+                         help='sqlite 檔案 / parquet 目錄 / SQL Server 連線字串')
+        sub.add_argument('--password-file', default=None, help='SQL Server 密碼檔')
+
+    def add_range(sub):
+        sub.add_argument('--start', default=None)
+        sub.add_argument('--end', default=None)
+
+    def add_fetch(sub):
+        sub.add_argument('--workers', type=int, default=4)
+        sub.add_argument('--rate', type=float, default=2.0, help='每個 host 每秒請求數')
+
+    sub = commands.add_parser('crawl', help=cmd_crawl.__doc__)
+    sub.add_argument('--market', nargs='+', default=['tse', 'otc'], choices=['tse', 'otc'])
+    sub.add_argument('--days', type=int, default=None, help='最近 N 個交易日 (取代 --start)')
+    add_range(sub)
+    add_storage(sub)
+    add_fetch(sub)
+    sub.set_defaults(func=cmd_crawl)
+
+    sub = commands.add_parser('sync', help=cmd_sync.__doc__)
+    sub.add_argument('--db', default='twse.db')
+    sub.add_argument('--market', nargs='+', default=['tse', 'otc'], choices=['tse', 'otc'])
+    sub.add_argument('--check', action='store_true',
+                     help='只回報今天是否開盤與待抓日期; 有待抓日期 exit 0, 沒有 exit 1')
+    sub.add_argument('--batch-days', type=int, default=20)
+    add_range(sub)
+    add_fetch(sub)
+    sub.set_defaults(func=cmd_sync)
+
+    for name, func in (('backtest', cmd_backtest), ('sweep', cmd_sweep)):
+        sub = commands.add_parser(name, help=func.__doc__)
+        sub.add_argument('--code', default='2330')
+        sub.add_argument('--strategy', default='2', choices=['1', '2'])
+        add_range(sub)
+        add_storage(sub)
+        sub.set_defaults(func=func)
+    sub = commands.choices['backtest']
+    sub.add_argument('--keep', type=int, default=None, help='持股天數')
+    sub.add_argument('--buy', type=float, default=None, help='買入閥值')
+    sub = commands.choices['sweep']
+    sub.add_argument('--keep', default='2:30:2', help='持股天數: start:stop:step 或 a,b,c')
+    sub.add_argument('--buy', default='-0.05:-0.16:-0.01', help='買入閥值: start:stop:step 或 a,b,c')
+    sub.add_argument('--processes', type=int, default=None)
+    sub.add_argument('--top-k', type=int, default=10)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(filename=args.log_file, level=args.log_level.upper())
+    args.startup = None
+    try:
+        code = args.func(args)
+    except ImportError as e:
+        ## 子命令 / 後端需要的選用套件 (pyarrow / pypyodbc ...) 沒安裝
+        sys.stderr.write('{}\n'.format(e))
+        code = 2
+    finally:
+        if args.metrics is not None:
+            import metrics
+
+            metrics.METRICS.write(args.metrics)
+        if args.timing:
+            seconds, modules = args.startup or (0.0, 0)
+            sys.stderr.write('startup {:.3f}s ({} modules), total {:.3f}s\n'.format(
+                seconds, modules, time.perf_counter() - _STARTED))
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+#! encoding = utf8
+"""股價儲存後端 (sqlite / SQL Server / parquet)
+
+後端以 'module:Class' 字串登記, get_backend 用到時才 import,
+只用 sqlite 的排程不會載入 pypyodbc / pyarrow; 其他後端可用 register_backend 加入
+
+每個後端提供
+- history(code, start, end, columns) : 單一股票的歷史 (yyyymmdd + columns)
+- sink(market) : streaming.export_prices 的寫入目標 (唯讀後端 raise NotImplementedError)
+- close()
+
+    backend = get_backend('sqlite', 'twse.db')
+    df = backend.history('2330', start='20040211')
+"""
+import importlib
+import os
+
+BACKENDS = {
+    'sqlite': 'storage:SqliteBackend',
+    'sqlserver': 'storage:SqlServerBackend',
+    'parquet': 'storage:ParquetBackend',
+}
+
+
+def register_backend(name, target):
+    """登記後端
+    params
+    ======
+    name : (str)
+    target : 'module:Class' 字串 (用到時才 import) 或類別
+    """
+    BACKENDS[name] = target
+
+
+def get_backend(name, location=None, **options):
+    """建立後端
+    params
+    ======
+    name : (str)
+        BACKENDS 中的名稱
+    location : (str)
+        sqlite 檔案 / parquet 目錄 / SQL Server 連線字串, None 則使用後端預設
+    options :
+        後端的其他參數
+    """
+    if name not in BACKENDS:
+        raise ValueError('unknown backend {!r}, available: {}'.format(name, sorted(BACKENDS)))
+    target = BACKENDS[name]
+    if isinstance(target, str):
+        module, attr = target.split(':')
+        target = getattr(importlib.import_module(module), attr)
+    return target(location, **options)
+
+
+class SqliteBackend:
+    """sqlite 的 tse_price / otc_price (price_db 格式)
+    params
+    ======
+    location : (str)
+        資料庫檔案, 預設 twse.db
+    """
+
+    def __init__(self, location=None):
+        import sqlite3
+        from twse_crawler import enable_wal
+
+        self.location = location or 'twse.db'
+        self.con = sqlite3.connect(self.location)
+        enable_wal(self.con)
+        self._db = None
+
+    def history(self, code, start=None, end=None, columns=('收盤價',)):
+        from price_db import PriceDB
+
+        if self._db is None:
+            self._db = PriceDB(self.con)
+        return self._db.history(code, start, end, columns)
+
+    def sink(self, market):
+        from streaming import SqliteSink
+        from sync import MARKETS
+
+        return SqliteSink(self.con, MARKETS[market])
+
+    def close(self):
+        self.con.close()
+
+
+class ParquetBackend:
+    """price_store.ParquetPriceStore
+    params
+    ======
+    location : (str)
+        資料集目錄, 預設 price_store
+    """
+
+    def __init__(self, location=None):
+        from price_store import ParquetPriceStore
+
+        self.store = ParquetPriceStore(location or 'price_store')
+
+    def history(self, code, start=None, end=None, columns=('收盤價',)):
+        df = self.store.load_prices([str(code)], start, end, list(columns))
+        return df[['yyyymmdd', '證券代號'] + list(columns)]
+
+    def sink(self, market):
+        from streaming import ParquetSink
+
+        return ParquetSink(self.store, market)
+
+    def close(self):
+        pass
+
+
+class SqlServerBackend:
+    """SQL Server 的 twstock_daily_price (price_schema.sql), 唯讀
+    params
+    ======
+    location : (str)
+        ODBC 連線字串, 未給定則以 server / database / user 組成
+    password_file : (str)
+        密碼檔, 未給定則讀環境變數 STOCKLAB_DB_PASSWORD
+    table : (str)
+    """
+
+    def __init__(self, location=None, password_file=None, server='dbm_public',
+                 database='external', user='sa', table='dbo.twstock_daily_price'):
+        try:
+            import pypyodbc
+        except ImportError:
+            raise ImportError('sqlserver backend requires pypyodbc: pip install pypyodbc')
+
+        if location is None:
+            location = 'DRIVER={{sql server}};SERVER={};UID={};PWD={};DATABASE={}'.format(
+                server, user, self._password(password_file), database)
+        self.con = pypyodbc.connect(location)
+        self.table = table
+
+    @staticmethod
+    def _password(password_file):
+        if password_file is not None:
+            with open(password_file, 'r') as f:
+                return f.read().strip()
+        if 'STOCKLAB_DB_PASSWORD' not in os.environ:
+            raise ValueError('password_file or STOCKLAB_DB_PASSWORD is required')
+        return os.environ['STOCKLAB_DB_PASSWORD']
+
+    def history(self, code, start=None, end=None, columns=('收盤價',)):
+        import pandas as pd
+        from price_store import yyyymmdd_series
+        from trading_calendar import to_date
+
+        where, params = ['證券代號 = ?'], [str(code)]
+        if start is not None:
+            where.append('yyyymmdd >= ?')
+            params.append(to_date(start).strftime('%Y%m%d'))
+        if end is not None:
+            where.append('yyyymmdd <= ?')
+            params.append(to_date(end).strftime('%Y%m%d'))
+        sql = 'SELECT yyyymmdd, 證券代號, {} FROM {} WHERE {} ORDER BY yyyymmdd'.format(
+            ', '.join(columns), self.table, ' AND '.join(where))
+        df = pd.read_sql(sql, self.con, params=params)
+        return df.assign(yyyymmdd=yyyymmdd_series(df['yyyymmdd']))
+
+    def sink(self, market):
+        raise NotImplementedError('sqlserver backend is read-only')
+
+    def close(self):
+        self.con.close()
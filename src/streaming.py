@@ -0,0 +1,332 @@
+#! encoding = utf8
+"""串流匯出股價: 一個交易日一批, 不把整段歷史留在記憶體
+
+- twse_crawler.iter_tse_days / iter_otc_days 依完成順序 yield 當天的 dataframe,
+  欄位/型別固定為 price_store.PRICE_SCHEMA; in_order 再排回日期順序
+- RollingDedup 只記住最近 window 天的 (yyyymmdd, 證券代號) 與每天內容的雜湊:
+  重複的 key 丟掉, 內容與前一個交易日完全相同的一天 (交易所回傳前一天的舊資料)
+  整天丟掉, 取代原本對整段結果做一次 drop_duplicates
+- SqliteSink (bulk_insert_df) 累積到 chunk_rows 筆才寫出;
+  ParquetSink (ParquetPriceStore.write) 換年度時才寫出, 每個年度分區只重寫一次
+記憶體用量只與 max_pending / window / chunk_rows 有關, 與抓取天數無關
+
+    from streaming import SqliteSink, export_prices
+    with SqliteSink(con, 'tse_price') as sink:
+        export_prices('tse', sink, start='20040211', end='20181231')
+"""
+import datetime
+import hashlib
+import logging
+from collections import OrderedDict
+
+import pandas as pd
+
+import metrics
+
+KEY_COLUMNS = ('yyyymmdd', '證券代號')
+
+
+class RollingDedup:
+    """以最近 window 個交易日為範圍的去重
+    資料需依日期順序傳入 (見 in_order), 舊資料的判斷是與前一個交易日比較
+    params
+    ======
+    window : (int)
+        記住的交易日數
+    """
+
+    def __init__(self, window=10):
+        self.window = window
+        self._seen = OrderedDict()
+        ## {day: 當天內容的雜湊}
+        self._digests = OrderedDict()
+        self.duplicate_rows = 0
+        self.stale_days = []
+
+    def _digest(self, df):
+        ## 當天內容 (不含日期) 依代號排序後的雜湊
+        values = df.drop(columns=['yyyymmdd']).sort_values('證券代號')
+        hashed = pd.util.hash_pandas_object(values, index=False).to_numpy()
+        return hashlib.sha1(hashed.tobytes()).hexdigest()
+
+    def _remember(self, store, key, value):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self.window:
+            store.popitem(last=False)
+
+    def __call__(self, df):
+        """回傳去重後的 dataframe (可能為空)"""
+        parts = []
+        for day, part in df.groupby('yyyymmdd', sort=True):
+            day = int(day)
+            n_rows = len(part)
+            part = part.drop_duplicates('證券代號', keep='last')
+            seen = self._seen.get(day)
+            if seen is None:
+                digest = self._digest(part)
+                ## 前一個交易日 (舊資料的日子不記錄, 連續幾天都是舊資料也會比對到原本那天)
+                previous = max((d for d in self._digests if d < day), default=None)
+                if previous is not None and self._digests[previous] == digest:
+                    logging.warning('{} is identical to {}, dropped as stale'.format(day, previous))
+                    self.stale_days.append(day)
+                    metrics.inc('stream.stale_days')
+                    self.duplicate_rows += n_rows
+                    metrics.inc('stream.duplicate_rows', n_rows)
+                    continue
+                self._remember(self._digests, day, digest)
+                seen = set()
+            else:
+                part = part[~part['證券代號'].isin(seen)]
+            seen.update(part['證券代號'])
+            self._remember(self._seen, day, seen)
+            self.duplicate_rows += n_rows - len(part)
+            metrics.inc('stream.duplicate_rows', n_rows - len(part))
+            parts.append(part)
+        if not parts:
+            return df.iloc[:0]
+        return parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
+
+
+def in_order(pairs, keys, summary):
+    """FetchEngine.iter_fetch 依完成順序的 (key, data) --> 依 keys 的順序 yield
+    先完成的 key 暫存, 前面的 key 都完成 (有資料 / 假日 / 錯誤) 才送出;
+    暫存量約為 max_pending, 只有前面某個 key 重試很久時才會變多
+    params
+    ======
+    pairs : iter_fetch 的結果
+    keys : list
+        iter_fetch 送出的 keys, 依希望的順序
+    summary : FetchSummary
+        同一個 iter_fetch 的 summary (判斷假日 / 錯誤)
+    """
+    pending, closed = {}, set()
+    position = 0
+    try:
+        for key, data in pairs:
+            pending[key] = data
+            while position < len(keys):
+                key = keys[position]
+                if key in pending:
+                    yield key, pending.pop(key)
+                else:
+                    closed.update(summary.holidays[len(closed):])
+                    if key not in closed and key not in summary.errors:
+                        break
+                position += 1
+        for key in keys[position:]:
+            if key in pending:
+                yield key, pending.pop(key)
+    finally:
+        ## 提早結束時取消還在排隊的下載
+        pairs.close()
+
+
+class _BufferedSink:
+    """累積到 chunk_rows 筆才寫出; with 區塊結束時寫出剩下的資料"""
+
+    def __init__(self, chunk_rows):
+        self.chunk_rows = chunk_rows
+        self._buffer = []
+        self._buffered = 0
+        self.rows = 0
+        self.flushes = 0
+
+    def write(self, df):
+        if df is None or len(df) == 0:
+            return
+        self._buffer.append(df)
+        self._buffered += len(df)
+        if self._buffered >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        df = pd.concat(self._buffer, ignore_index=True)
+        self._buffer, self._buffered = [], 0
+        self._write(df)
+        self.rows += len(df)
+        self.flushes += 1
+
+    def _write(self, df):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+        return self.result()
+
+    def result(self):
+        return {'rows': self.rows, 'flushes': self.flushes}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        ## 已收到的每一天都是完整的, 發生例外也先寫出
+        self.flush()
+
+
+class SqliteSink(_BufferedSink):
+    """寫入 tse_price / otc_price (bulk_insert_df upsert)
+    params
+    ======
+    con : sqlite3 connection
+    tablename : (str)
+    chunk_rows : (int)
+        每次寫入的筆數
+    """
+
+    def __init__(self, con, tablename, chunk_rows=200000):
+        from twse_crawler import create_db
+
+        super().__init__(chunk_rows)
+        self.con = con
+        self.tablename = tablename
+        self.loaded = {'inserted': 0, 'updated': 0, 'skipped': 0}
+        create_db(tablename, con)
+
+    def _write(self, df):
+        from twse_crawler import bulk_insert_df
+
+        for key, value in bulk_insert_df(df, self.con, self.tablename).items():
+            if key in self.loaded:
+                self.loaded[key] += value
+
+    def result(self):
+        return dict(super().result(), **self.loaded)
+
+
+class ParquetSink(_BufferedSink):
+    """寫入 ParquetPriceStore (依 market / year 分區)
+    每次寫入會重寫涉及的年度分區, 所以累積到換年度 (或 close) 才寫出:
+    資料依日期順序傳入時每個年度分區只寫一次
+    params
+    ======
+    store : ParquetPriceStore or (str) 資料集目錄
+    market : 'tse' or 'otc'
+        None 則依資料的 market 欄位分別寫入 (market_data 的合併資料)
+    chunk_rows : (int)
+        記憶體上限, 同一年度累積超過此筆數也先寫出 (該分區之後會再重寫一次);
+        一年的上市 + 上櫃約 45 萬筆
+    """
+
+    def __init__(self, store, market=None, chunk_rows=2000000):
+        from price_store import ParquetPriceStore
+
+        super().__init__(chunk_rows)
+        self.store = ParquetPriceStore(store) if isinstance(store, str) else store
+        self.market = market
+        self._years = set()
+
+    def write(self, df):
+        from price_store import yyyymmdd_series
+
+        if df is None or len(df) == 0:
+            return
+        years = (yyyymmdd_series(df['yyyymmdd']) // 10000).to_numpy()
+        for year, part in df.groupby(years, sort=True):
+            if self._years and year not in self._years:
+                self.flush()
+            self._years.add(year)
+            super().write(part)
+
+    def flush(self):
+        self._years = set()
+        super().flush()
+
+    def _write(self, df):
+        if self.market is not None:
+            self.store.write(df, self.market)
+            return
+        for market, part in df.groupby('market'):
+            self.store.write(part, market)
+
+
+def _iter_days_func(market):
+    import twse_crawler
+    return {
+        'tse': twse_crawler.iter_tse_days,
+        'otc': twse_crawler.iter_otc_days,
+    }[market]
+
+
+def _range_rounds(start, end, calendar, summary, market):
+    ## start ~ end 只需一輪, 由舊到新抓
+    from fetch_engine import FetchSummary
+
+    days = sorted(calendar.candidate_days(start, end, market))
+    run_summary = FetchSummary()
+    yield days, run_summary
+    calendar.learn_from_summary(run_summary, market)
+    if summary is not None:
+        summary.merge(run_summary)
+
+
+def iter_prices(market, start=None, end=None, n_days=None, engine=None, summary=None,
+                calendar=None, url=None, window=10, max_pending=None):
+    """依日期順序 yield (day, 去重後的當天 dataframe)
+    params
+    ======
+    market : 'tse' or 'otc'
+    start, end : 日期範圍 (含); 給 n_days 時為 end 往前 n_days 個交易日
+    n_days : (int)
+    window : (int)
+        RollingDedup 的天數, 0 代表不去重
+    max_pending : (int)
+        同時在途的日期數
+    """
+    from fetch_engine import FetchEngine
+    from trading_calendar import TradingCalendar, to_date
+    from twse_crawler import _last_n_days_rounds
+
+    engine = FetchEngine() if engine is None else engine
+    calendar = TradingCalendar() if calendar is None else calendar
+    end = datetime.date.today() if end is None else to_date(end)
+    if n_days is not None:
+        rounds = _last_n_days_rounds(n_days, end, calendar, summary, market)
+    elif start is not None:
+        rounds = _range_rounds(to_date(start), end, calendar, summary, market)
+    else:
+        raise ValueError('either start or n_days is required')
+    dedup = RollingDedup(window) if window else None
+    iter_days = _iter_days_func(market)
+    for days, run_summary in rounds:
+        days = sorted(days)
+        pairs = iter_days(days, engine=engine, summary=run_summary, url=url,
+                          max_pending=max_pending)
+        for day, df in in_order(pairs, days, run_summary):
+            if dedup is not None:
+                df = dedup(df)
+            if len(df):
+                yield day, df
+
+
+def export_prices(market, sink, start=None, end=None, n_days=None, engine=None, summary=None,
+                  calendar=None, url=None, window=10, max_pending=None):
+    """抓取 -> 去重 -> 寫入 sink, 每天處理完就交給 sink
+    params
+    ======
+    sink : SqliteSink / ParquetSink (或任何有 write(df) / close() 的物件)
+    其餘見 iter_prices
+
+    return
+    ======
+    dict : days, rows 與 sink.close() 的結果
+    """
+    from fetch_engine import FetchSummary
+
+    summary = FetchSummary() if summary is None else summary
+    days = rows = 0
+    with metrics.timer('stream.{}'.format(market)):
+        for _, df in iter_prices(market, start, end, n_days, engine, summary, calendar, url,
+                                 window, max_pending):
+            sink.write(df)
+            days += 1
+            rows += len(df)
+        result = sink.close()
+    metrics.inc('stream.{}.rows'.format(market), rows)
+    report = {'days': days, 'rows': rows, 'holidays': len(summary.holidays),
+              'errors': len(summary.errors), 'sink': result}
+    logging.info('export {}: {}'.format(market, report))
+    return report
@@ -0,0 +1,196 @@
+#! encoding = utf8
+"""增量同步: 只抓資料庫缺少的交易日
+
+- 以 MAX(yyyymmdd) 之後的日期 + 資料表中間缺漏的交易日為待抓清單
+- 每個日期寫入後記錄在 sync_checkpoint, 中斷(當機/被擋)後重跑
+  會從第一個未完成的日期繼續, 已完成的日期不再重抓
+- 還沒公布的日期 (trading_calendar.is_published) 取得空資料不記錄, 下次重抓
+"""
+import datetime
+import logging
+
+import metrics
+from trading_calendar import TradingCalendar, is_published, to_date, to_yyyymmdd
+
+## 上市每日收盤行情最早可查日期
+DEFAULT_START = datetime.date(2004, 2, 11)
+
+MARKETS = {
+    'tse': 'tse_price',
+    'otc': 'otc_price',
+}
+
+
+def days_data_func(market):
+    """market ('tse' / 'otc') 的 get_*_days_data(days, engine=None, summary=None, url=None)"""
+    import twse_crawler
+    return {
+        'tse': twse_crawler.get_tse_days_data,
+        'otc': twse_crawler.get_otc_days_data,
+    }[market]
+
+
+class SyncJob:
+    """可從中斷處繼續的增量同步工作
+    params
+    ======
+    con : sqlite3 connection
+    calendar : TradingCalendar
+        未指定則使用同一個資料庫的 trading_calendar 表
+    engine : FetchEngine
+    batch_days : (int)
+        每批並行抓取的天數, 每批寫入後 commit checkpoint
+    urls : dict
+        {market: url}, 測試時指向其他伺服器
+    now : callable
+        回傳現在時間, 判斷當天行情是否已公布; 預設 datetime.datetime.now
+    """
+
+    def __init__(self, con, calendar=None, engine=None, batch_days=20, urls=None, now=None):
+        self.con = con
+        self.calendar = TradingCalendar(con) if calendar is None else calendar
+        self.engine = engine
+        self.batch_days = batch_days
+        self.urls = urls or {}
+        self.now = datetime.datetime.now if now is None else now
+        ## 表都已存在時不 import twse_crawler (pandas / requests), 只查待抓日期的排程可以很快啟動
+        existing = set(row[0] for row in con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"))
+        missing = [t for t in MARKETS.values() if t not in existing]
+        if missing:
+            from twse_crawler import create_db
+
+            for tablename in missing:
+                create_db(tablename, con)
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS sync_checkpoint(
+                market TEXT,
+                yyyymmdd INTEGER,
+                status TEXT,
+                rows INTEGER,
+                updated_at TEXT,
+                PRIMARY KEY (market, yyyymmdd)
+            )
+        """)
+        con.commit()
+
+    def _stored_days(self, market):
+        ## 沿 yyyymmdd 索引逐一跳到下一個日期 (skip scan), 只讀每天的第一筆而不是整張表
+        cursor = self.con.execute("""
+            WITH RECURSIVE days(d) AS (
+                SELECT MIN(yyyymmdd) FROM {0}
+                UNION ALL
+                SELECT (SELECT MIN(yyyymmdd) FROM {0} WHERE yyyymmdd > d) FROM days
+                WHERE d IS NOT NULL
+            )
+            SELECT d FROM days WHERE d IS NOT NULL
+        """.format(MARKETS[market]))
+        return set(to_date(row[0]) for row in cursor)
+
+    def _finished_days(self, market):
+        cursor = self.con.execute(
+            'SELECT yyyymmdd FROM sync_checkpoint WHERE market = ?', (market,))
+        return set(to_date(row[0]) for row in cursor)
+
+    def _checkpoint(self, market, days, status, rows=None):
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        self.con.executemany(
+            'INSERT OR REPLACE INTO sync_checkpoint (market, yyyymmdd, status, rows, updated_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(market, to_yyyymmdd(day), status, (rows or {}).get(day), now) for day in days])
+        self.con.commit()
+
+    def last_date(self, market):
+        """資料表中最新的日期, 空表回傳 None"""
+        value = self.con.execute(
+            'SELECT MAX(yyyymmdd) FROM {}'.format(MARKETS[market])).fetchone()[0]
+        return None if value is None else to_date(value)
+
+    def pending_days(self, market, start=None, end=None):
+        """待抓的日期 (由舊到新)
+        = start ~ end 間可能開盤的日子 - 已在資料表 - 已記錄完成/休市
+        start 預設為資料表最早的日期 (空表則 DEFAULT_START)
+        """
+        stored = self._stored_days(market)
+        if start is None:
+            start = min(stored) if stored else DEFAULT_START
+        end = self.now().date() if end is None else end
+        skip = stored | self._finished_days(market)
+        return sorted(day for day in self.calendar.candidate_days(start, end, market)
+                      if day not in skip)
+
+    def run(self, markets=('tse', 'otc'), start=None, end=None, stop_on_error=True):
+        """依序同步各市場
+        params
+        ======
+        stop_on_error : (bool)
+            某批有下載失敗(e.g. 被擋)即停止該市場, 下次由失敗的日期繼續
+
+        return
+        ======
+        dict : {market: {'pending', 'done', 'holidays', 'unpublished', 'errors', 'inserted'}}
+            unpublished 為還沒公布而取得空資料的日期數 (不記錄, 下次重抓)
+        """
+        from fetch_engine import FetchEngine, FetchSummary
+        from price_db import needs_migration
+        from twse_crawler import bulk_insert_df
+
+        legacy = needs_migration(self.con, list(MARKETS.values()))
+        if legacy:
+            ## 舊格式的日期是文字, 與新寫入的整數日期不會視為同一天
+            logging.warning('{} still in the old layout, run price_db.migrate(con) first'.format(
+                legacy))
+        engine = FetchEngine() if self.engine is None else self.engine
+        self.calendar.learn_from_db(self.con, tables=list(MARKETS.values()))
+        report = {}
+        for market in markets:
+            days = self.pending_days(market, start, end)
+            result = {'pending': len(days), 'done': 0, 'holidays': 0, 'unpublished': 0,
+                      'errors': {}, 'inserted': 0}
+            report[market] = result
+            logging.info('sync {}: {} days pending (last date {})'.format(
+                market, len(days), self.last_date(market)))
+            get_days_data = days_data_func(market)
+            for i in range(0, len(days), self.batch_days):
+                batch = days[i:i + self.batch_days]
+                summary = FetchSummary()
+                with metrics.timer('sync.{}.fetch'.format(market)):
+                    df = get_days_data(batch, engine=engine, summary=summary,
+                                       url=self.urls.get(market))
+                if len(df):
+                    loaded = bulk_insert_df(df, self.con, MARKETS[market])
+                    result['inserted'] += loaded['inserted']
+                    rows = df.groupby('yyyymmdd').size()
+                    rows = {to_date(k): int(v) for k, v in rows.items()}
+                    self._checkpoint(market, summary.trading_days, 'done', rows)
+                now = self.now()
+                holidays = [day for day in summary.holidays if is_published(day, now)]
+                self._checkpoint(market, holidays, 'holiday')
+                self.calendar.learn_from_summary(summary, market, now)
+                result['done'] += len(summary.trading_days)
+                result['holidays'] += len(holidays)
+                result['unpublished'] += len(summary.holidays) - len(holidays)
+                result['errors'].update(
+                    (day.strftime('%Y%m%d'), error) for day, error in summary.errors.items())
+                if summary.errors and stop_on_error:
+                    logging.warning('sync {} stopped at {}: {}'.format(
+                        market, min(summary.errors), summary))
+                    break
+            logging.info('sync {} finished: {}'.format(market, result))
+        return report
+
+
+def sync(con, markets=('tse', 'otc'), start=None, end=None, engine=None, batch_days=20,
+         metrics_path=None):
+    """增量同步 tse_price / otc_price, 回傳各市場統計 (見 SyncJob.run)
+    metrics_path : (str)
+        本次執行的量測輸出檔 (.prom 為 Prometheus text, 其他為 JSON)
+    """
+    metrics.METRICS.reset()
+    job = SyncJob(con, engine=engine, batch_days=batch_days)
+    try:
+        return job.run(markets, start=start, end=end)
+    finally:
+        logging.info('sync metrics\n' + metrics.METRICS.summary())
+        if metrics_path is not None:
+            metrics.METRICS.write(metrics_path)
@@ -0,0 +1,246 @@
+#! encoding = utf8
+"""交易日曆
+
+記錄哪些日期有開盤, 讓爬蟲直接跳過假日而不用每天打一次 request 試探
+- 任一市場成功取得資料 --> 交易日
+- 某市場取得空資料 --> 該市場當天不再重抓; 每個市場都是空資料 --> 非交易日
+  (單一市場的空回應可能只是該市場當天沒有資料, 不足以判定整個市場休市)
+- tse_price / otc_price 已有的日期 --> 交易日
+- 另可匯入休市日清單
+未知的平日需實際抓取確認; 週末預設為休市, 但 MAKEUP_DAYS 中的週六補行上班日
+(可能是補行交易日) 仍會抓取, 由資料決定
+當天行情公布前 (PUBLISH_TIME) 的空資料只代表還沒公布, 不記為休市
+"""
+import datetime
+import logging
+import re
+import sqlite3
+
+## 交易所於收盤後公布當日行情, 晚於此時間當天仍無資料才視為休市
+PUBLISH_TIME = datetime.time(18, 0)
+
+## 週六補行上班日 (人事行政總處公告), 交易所可能開盤; 實際是否交易由抓到的資料決定
+MAKEUP_DAYS = frozenset(datetime.date(*ymd) for ymd in [
+    (2012, 2, 4), (2012, 3, 3), (2012, 12, 22),
+    (2013, 2, 23), (2013, 9, 14),
+    (2014, 12, 27),
+    (2016, 1, 30), (2016, 6, 4), (2016, 9, 10),
+    (2017, 2, 18), (2017, 6, 3), (2017, 9, 30),
+    (2018, 3, 31), (2018, 12, 22),
+    (2019, 1, 19), (2019, 2, 23), (2019, 10, 5),
+    (2020, 2, 15), (2020, 6, 20), (2020, 9, 26),
+    (2021, 2, 20), (2021, 9, 11),
+    (2023, 1, 7), (2023, 2, 4), (2023, 2, 18), (2023, 3, 25), (2023, 6, 17), (2023, 9, 23),
+    (2024, 2, 17),
+])
+
+
+def to_date(value):
+    """各種日期格式 --> datetime.date
+    支援 datetime/date, 20180129, '20180129', '2018-01-29', '2018/01/29',
+    民國年 '107/01/29'
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    digits = re.findall(r'\d+', str(value))
+    if len(digits) == 1 and len(digits[0]) >= 8:
+        text = digits[0][:8]
+        return datetime.date(int(text[:4]), int(text[4:6]), int(text[6:8]))
+    if len(digits) >= 3:
+        year, month, day = (int(d) for d in digits[:3])
+        if year < 1000:
+            year += 1911
+        return datetime.date(year, month, day)
+    raise ValueError('unknown date format {!r}'.format(value))
+
+
+def to_yyyymmdd(value):
+    """各種日期格式 --> 整數 yyyymmdd"""
+    day = to_date(value)
+    return day.year * 10000 + day.month * 100 + day.day
+
+
+def is_published(day, now=None):
+    """day 的行情是否已公布 (早於今天, 或今天已過 PUBLISH_TIME)
+    params
+    ======
+    now : datetime.datetime
+        預設為現在
+    """
+    now = datetime.datetime.now() if now is None else now
+    day = to_date(day)
+    return day < now.date() or (day == now.date() and now.time() >= PUBLISH_TIME)
+
+
+class TradingCalendar:
+    """交易日曆, 存在 sqlite 的 trading_calendar 表
+    params
+    ======
+    con : sqlite3 connection
+        None 則只存在記憶體
+    weekends_closed : (bool)
+        未知的週六日是否直接視為非交易日 (makeup_days 除外, 預設 True)
+    makeup_days : iterable of date
+        可能是補行交易日的週六, 預設 MAKEUP_DAYS
+    markets : list of str
+        每個市場都是空資料才記為非交易日
+    """
+
+    def __init__(self, con=None, tablename='trading_calendar', weekends_closed=True,
+                 markets=('tse', 'otc'), makeup_days=MAKEUP_DAYS):
+        self.con = con
+        self.tablename = tablename
+        self.weekends_closed = weekends_closed
+        self.makeup_days = frozenset(to_date(day) for day in makeup_days)
+        self.markets = frozenset(markets)
+        self._days = {}
+        ## {day: 取得空資料的市場}
+        self._closed = {}
+        if con is not None:
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS {}(
+                    yyyymmdd INTEGER PRIMARY KEY,
+                    is_trading INTEGER,
+                    source TEXT
+                )
+            """.format(tablename))
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS {}_closed(
+                    market TEXT,
+                    yyyymmdd INTEGER,
+                    PRIMARY KEY (market, yyyymmdd)
+                ) WITHOUT ROWID
+            """.format(tablename))
+            con.commit()
+            for yyyymmdd, is_trading in con.execute(
+                    'SELECT yyyymmdd, is_trading FROM {}'.format(tablename)):
+                self._days[to_date(yyyymmdd)] = bool(is_trading)
+            for market, yyyymmdd in con.execute(
+                    'SELECT market, yyyymmdd FROM {}_closed'.format(tablename)):
+                self._closed.setdefault(to_date(yyyymmdd), set()).add(market)
+
+    def __len__(self):
+        return len(self._days)
+
+    def __contains__(self, day):
+        return to_date(day) in self._days
+
+    def mark(self, days, is_trading, source='crawl'):
+        """記錄 days 是否為交易日 (已知的交易日不會被改成非交易日)"""
+        rows = []
+        for day in days:
+            day = to_date(day)
+            if not is_trading and self._days.get(day):
+                continue
+            self._days[day] = bool(is_trading)
+            rows.append((to_yyyymmdd(day), int(is_trading), source))
+        if self.con is not None and rows:
+            self.con.executemany(
+                'INSERT OR REPLACE INTO {} (yyyymmdd, is_trading, source) '
+                'VALUES (?, ?, ?)'.format(self.tablename), rows)
+            self.con.commit()
+        return len(rows)
+
+    def add_holidays(self, days, source='holiday_list'):
+        """匯入休市日清單"""
+        return self.mark(days, False, source)
+
+    def mark_closed(self, days, market, source='crawl'):
+        """記錄 market 在 days 取得空資料, 每個市場都是空資料的日期記為非交易日"""
+        days = [to_date(day) for day in days]
+        rows = []
+        for day in days:
+            closed = self._closed.setdefault(day, set())
+            if market not in closed:
+                closed.add(market)
+                rows.append((market, to_yyyymmdd(day)))
+        if self.con is not None and rows:
+            self.con.executemany(
+                'INSERT OR IGNORE INTO {}_closed (market, yyyymmdd) '
+                'VALUES (?, ?)'.format(self.tablename), rows)
+            self.con.commit()
+        return self.mark([day for day in days if self._closed[day] >= self.markets],
+                         False, source)
+
+    def learn_from_summary(self, summary, market=None, now=None):
+        """由 FetchSummary 學習: 有資料 --> 交易日, 空資料 --> 見 mark_closed
+        (錯誤的日期與還沒公布的日期不記錄, 下次會重抓)
+        params
+        ======
+        market : (str)
+            summary 所屬的市場; None 代表 summary.holidays 已是每個市場都沒有資料的日期
+        now : datetime.datetime
+            見 is_published
+        """
+        self.mark(summary.trading_days, True)
+        holidays = [day for day in summary.holidays if is_published(day, now)]
+        if market is None:
+            self.mark(holidays, False)
+        else:
+            self.mark_closed(holidays, market)
+
+    def learn_from_db(self, con=None, tables=('tse_price', 'otc_price')):
+        """資料庫內已有股價的日期皆為交易日"""
+        con = self.con if con is None else con
+        days = set()
+        for table in tables:
+            try:
+                cursor = con.execute('SELECT DISTINCT yyyymmdd FROM {}'.format(table))
+            except sqlite3.OperationalError:
+                logging.info('table {} not found, skip'.format(table))
+                continue
+            days.update(to_date(row[0]) for row in cursor)
+        days = [day for day in days if not self._days.get(day)]
+        return self.mark(days, True, 'db')
+
+    def is_trading_day(self, day, market=None):
+        """True / False, 無法判斷(尚未抓過的日期)回傳 None
+        params
+        ======
+        market : (str)
+            有給則該市場已取得空資料的日期也回傳 False
+        """
+        day = to_date(day)
+        if day in self._days:
+            return self._days[day]
+        if market is not None and market in self._closed.get(day, ()):
+            return False
+        if self.weekends_closed and day.weekday() >= 5 and day not in self.makeup_days:
+            return False
+        return None
+
+    def candidate_days(self, start, end, market=None):
+        """start ~ end 之間可能是交易日的日期(由新到舊), 已知的休市日直接跳過
+        (market 見 is_trading_day)
+        """
+        start, end = to_date(start), to_date(end)
+        day = end
+        while day >= start:
+            if self.is_trading_day(day, market) is not False:
+                yield day
+            day -= datetime.timedelta(days=1)
+
+    def previous_candidates(self, n, end, limit=None, market=None):
+        """end (含) 往前 n 個可能是交易日的日期
+        params
+        ======
+        limit : datetime.date
+            最早不超過此日
+        market : (str)
+            見 is_trading_day
+        """
+        start = to_date(limit) if limit is not None else datetime.date(1900, 1, 1)
+        days = []
+        for day in self.candidate_days(start, end, market):
+            if len(days) >= n:
+                break
+            days.append(day)
+        return days
+
+    def trading_days(self, start, end):
+        """start ~ end 之間已確認的交易日(由舊到新)"""
+        start, end = to_date(start), to_date(end)
+        return sorted(day for day, is_trading in self._days.items()
+                      if is_trading and start <= day <= end)
@@ -2,57 +2,202 @@
 
 import pandas as pd
 import numpy as np
-import asyncio
 import datetime,time
+import json
 import sqlite3
 import logging
 import requests
 import re
-from io import StringIO
-from tqdm import tqdm
+
+import metrics
+import parsers
+import raw_cache
+from trading_calendar import to_date
+
+
+## 股價表的欄位 (證券代號, yyyymmdd 以外)
+## market_price 為上市 + 上櫃合併的表 (market_data.get_market_data), 欄位為兩者的聯集
+PRICE_TABLES = {
+    'tse_price': [('成交量', 'REAL'), ('成交筆數', 'INTEGER'), ('開盤價', 'REAL'),
+                  ('最高價', 'REAL'), ('最低價', 'REAL'), ('收盤價', 'REAL'), ('本益比', 'REAL')],
+    'otc_price': [('成交量', 'REAL'), ('成交筆數', 'INTEGER'), ('成交金額', 'INTEGER'),
+                  ('開盤價', 'REAL'), ('最高價', 'REAL'), ('最低價', 'REAL'), ('收盤價', 'REAL')],
+    'market_price': [('market', 'TEXT'), ('成交量', 'REAL'), ('成交筆數', 'INTEGER'),
+                     ('成交金額', 'INTEGER'), ('開盤價', 'REAL'), ('最高價', 'REAL'),
+                     ('最低價', 'REAL'), ('收盤價', 'REAL'), ('本益比', 'REAL')],
+}
+
+
+def price_table_sql(tablename, name=None):
+    """股價表的 (CREATE TABLE, CREATE INDEX) SQL
+    依 (證券代號, yyyymmdd) 叢集存放 (WITHOUT ROWID), 單一股票的歷史是連續的一段;
+    「某天全部股票」走 yyyymmdd 索引. 日期存整數 yyyymmdd (舊資料庫見 price_db.migrate)
+    name : (str)
+        實際建立的表名, 預設同 tablename
+    """
+    name = tablename if name is None else name
+    columns = ''.join(',\n                {} {}'.format(col, dtype)
+                      for col, dtype in PRICE_TABLES[tablename])
+    SQL_CREATE = """
+            CREATE TABLE IF NOT EXISTS {0}(
+                yyyymmdd INTEGER NOT NULL,
+                證券代號 TEXT NOT NULL{1},
+                PRIMARY KEY (證券代號,yyyymmdd)
+            ) WITHOUT ROWID
+        """.format(name, columns)
+    SQL_INDEX = 'CREATE INDEX IF NOT EXISTS {0}_yyyymmdd ON {0}(yyyymmdd)'.format(name)
+    return SQL_CREATE, SQL_INDEX
+
+
+def enable_wal(con):
+    """資料庫切換成 journal_mode=WAL (記錄在檔案中, 之後的連線都是 WAL)
+    已經是 WAL 時只讀取設定; transaction 中無法切換, 記錄 warning
+    return
+    ======
+    實際的 journal_mode ('wal', 'delete', 'memory' ...)
+    """
+    mode = con.execute('PRAGMA journal_mode').fetchone()[0].lower()
+    if mode in ('wal', 'memory'):
+        return mode
+    if con.in_transaction:
+        logging.warning('journal_mode stays {}: cannot switch to WAL inside a transaction'.format(
+            mode))
+        return mode
+    mode = con.execute('PRAGMA journal_mode=WAL').fetchone()[0].lower()
+    if mode != 'wal':
+        logging.warning('journal_mode stays {}: WAL not supported here'.format(mode))
+    return mode
 
 
 def create_db(tablename, con, drop=False):
+    ## 連線開啟時沒有設定 WAL 的呼叫端, 在這裡補上
+    enable_wal(con)
     cursor = con.cursor()
+    SQL_INDEX = None
     if drop:
         SQL_DROP = """DROP TABLE IF EXISTS {} """.format(tablename)
         cursor.execute(SQL_DROP)
         logging.info('DROP TABLE {} SUCCESSED!!'.format(tablename))
-    if tablename == 'tse_price':
+    if tablename in PRICE_TABLES:
+        SQL_CREATE, SQL_INDEX = price_table_sql(tablename)
+    elif tablename == 'monthly_revenue':
         SQL_CREATE = """
-            CREATE TABLE {}(
+            CREATE TABLE IF NOT EXISTS {}(
+                公司代號 TEXT,
                 yyyymmdd date,
-                證券代號 TEXT,
-                成交量 REAL,
-                成交筆數 INTEGER, 
-                開盤價 REAL, 
-                最高價 REAL, 
-                最低價 REAL, 
-                收盤價 REAL, 
-                本益比 REAL,
-                PRIMARY KEY (yyyymmdd,證券代號)
+                公司名稱 TEXT,
+                當月營收 REAL,
+                上月營收 REAL,
+                "上月比較增減(%)" REAL,
+                去年當月營收 REAL,
+                "去年同月增減(%)" REAL,
+                當月累計營收 REAL,
+                去年累計營收 REAL,
+                "前期比較增減(%)" REAL,
+                上市櫃 TEXT,
+                PRIMARY KEY (公司代號,yyyymmdd)
             )
         """.format(tablename)
-    elif tablename =='otc_price':
+    elif tablename == 'financial_statement':
+        ## 季報各項目 (長表): yyyymmdd 為季末日, 報表為 綜合損益/資產負債/營益分析彙總表
         SQL_CREATE = """
-            CREATE TABLE {}(
+            CREATE TABLE IF NOT EXISTS {}(
+                公司代號 TEXT,
                 yyyymmdd date,
-                證券代號 TEXT,
-                成交量 REAL,
-                成交筆數 INTEGER,
-                成交金額 INTEGER,
-                開盤價 REAL,
-                最高價 REAL,
-                最低價 REAL,
-                收盤價 REAL,
-                PRIMARY KEY (yyyymmdd,證券代號)
+                報表 TEXT,
+                項目 TEXT,
+                值 REAL,
+                上市櫃 TEXT,
+                PRIMARY KEY (公司代號,yyyymmdd,報表,項目)
             )
         """.format(tablename)
+    elif tablename == 'adjust_event':
+        ## 除權息/減資事件: yyyymmdd 為除權息(恢復買賣)日, 參考價 / 前收盤 為調整因子
+        SQL_CREATE = """
+            CREATE TABLE IF NOT EXISTS {}(
+                證券代號 TEXT,
+                yyyymmdd date,
+                前收盤 REAL,
+                參考價 REAL,
+                類型 TEXT,
+                來源 TEXT,
+                PRIMARY KEY (證券代號,yyyymmdd)
+            ) WITHOUT ROWID
+        """.format(tablename)
+    elif tablename == 'adjust_factor':
+        ## 每檔股票由第一個事件起的累積調整因子 (adjustment.py 維護)
+        SQL_CREATE = """
+            CREATE TABLE IF NOT EXISTS {}(
+                證券代號 TEXT,
+                yyyymmdd date,
+                factor REAL,
+                cum_factor REAL,
+                PRIMARY KEY (證券代號,yyyymmdd)
+            ) WITHOUT ROWID
+        """.format(tablename)
+    else:
+        raise ValueError('unknown table {}'.format(tablename))
     cursor.execute(SQL_CREATE)
+    if SQL_INDEX is not None:
+        cursor.execute(SQL_INDEX)
     con.commit()
     logging.info('CREATE TABLE {} SUCCESSED!!'.format(tablename))
 
 
+TSE_URL = 'http://app.twse.com.tw/ch/trading/exchange/MI_INDEX/MI_INDEX.php'
+OTC_URL = 'http://www.tpex.org.tw/web/stock/aftertrading/daily_close_quotes/stk_quote_result.php'
+
+TSE_COLUMNS = ['證券代號', 'yyyymmdd', '成交量', '成交筆數', '開盤價', '最高價',
+               '最低價', '收盤價', '本益比']
+
+
+def _tse_date_str(day):
+    """datetime.date --> 民國年字串 106/01/20"""
+    return '{0}/{1:02d}/{2:02d}'.format(day.year - 1911, day.month, day.day)
+
+
+def fetch_tse_raw(date, session=None, url=None, cache=None):
+    """下載上市公司每日股價原始 csv 文字
+    params
+    ======
+    date :(str)
+        106/01/20
+    session : FetchEngine or requests.Session
+        未指定則直接使用 requests
+    cache : RawCache
+        未指定則使用 session.cache (若有)
+    """
+    session = requests if session is None else session
+    cache = getattr(session, 'cache', None) if cache is None else cache
+    data = {
+        'download': 'csv',
+        'qdate': date,
+        'selectType': 'ALL',
+    }
+
+    def download():
+        return session.post(url or TSE_URL, data=data).content
+
+    def validate(content):
+        ## 假日/尚未公布的空白回應與錯誤頁不進快取
+        return parsers.has_tse_rows(content.decode('big5', errors='replace'))
+
+    if cache is None:
+        content = download()
+    else:
+        immutable, ttl = raw_cache.daily_policy(to_date(date))
+        content = cache.fetch('tse_mi_index', {'qdate': date}, download, immutable, ttl,
+                              validate)
+    return content.decode('big5', errors='replace')
+
+
+def parse_tse_text(text):
+    """解析 fetch_tse_raw 的 csv 文字, 無資料(假日)回傳 None
+    (實作見 parsers.parse_tse_csv)
+    """
+    return parsers.parse_tse_csv(text)
+
+
 def get_tse_data(date):
     """上市公司每日股價 
     params
@@ -64,75 +209,215 @@ def get_tse_data(date):
     ======
     dataframe 
     """
-    r = requests.post('http://app.twse.com.tw/ch/trading/exchange/MI_INDEX/MI_INDEX.php', data={
-        'download': 'csv',
-        'qdate': date,
-        'selectType': 'ALL',
-    })
-    r.encoding = 'big5'
-    df = pd.read_csv(StringIO("\n".join([i.translate({ord(c): None for c in ' '})
-                                         for i in r.text.split('\n')
-                                         if len(i.split('",')) == 16 and i[0] != '='])), header=0)
-    df.set_index('證券代號', inplace=True)
-    df.columns = ['證券名稱', '成交量', '成交筆數', '成交金額', '開盤價', '最高價', '最低價', '收盤價',
-                  '漲跌(+/-)', '漲跌價差', '最後揭示買價', '最後揭示買量', '最後揭示賣價', '最後揭示賣量', '本益比']
-
-    df['成交量'] /= 1000
-    df = df.drop(['漲跌(+/-)', '證券名稱', '最後揭示買量', '最後揭示賣量'], axis=1)
-    df = df.replace('--', np.nan)
-    df = df.apply(pd.to_numeric)
-    assert len(set(df.index)) == len(df.index)
+    df = parse_tse_text(fetch_tse_raw(date))
+    if df is None:
+        raise ValueError('no tse data at {}, check the date is holiday'.format(date))
+    return df
+
+
+def get_tse_days_data(days, engine=None, summary=None, url=None):
+    """並行抓取指定日期的上市股價
+    params
+    ======
+    days : iterable of datetime.date
+    engine : FetchEngine
+        未指定則使用預設參數建立
+    summary : FetchSummary
+        假日/錯誤/重試統計
+
+    return
+    ======
+    dataframe (欄位同 TSE_COLUMNS)
+    """
+    from fetch_engine import FetchEngine
+
+    engine = FetchEngine() if engine is None else engine
+
+    def fetch(engine, day):
+        return fetch_tse_day(engine, day, url)
+
+    def parse(text, day):
+        df = parse_tse_text(text)
+        if df is None:
+            return None
+        df['yyyymmdd'] = day.strftime('%Y%m%d')
+        return df.reset_index()
+
+    tw_stock_list = [df for _, df in engine.iter_fetch(days, fetch, parse, summary)]
+    if not tw_stock_list:
+        return pd.DataFrame(columns=TSE_COLUMNS)
+    tw_stock_df = pd.concat(tw_stock_list, ignore_index=True)
+    tw_stock_df = tw_stock_df.sort_values(['yyyymmdd', '證券代號'], ascending=[False, True])
+    return tw_stock_df[TSE_COLUMNS].reset_index(drop=True)
+
+
+def fetch_tse_day(engine, day, url=None):
+    """以 datetime.date 下載上市當天的原始 csv 文字"""
+    return fetch_tse_raw(_tse_date_str(day), session=engine, url=url)
+
+
+def parse_tse_day(text, day):
+    """fetch_tse_day 的結果 --> price_store.PRICE_SCHEMA 的 dataframe, 假日回傳 None"""
+    from price_store import normalize_prices
+
+    df = parse_tse_text(text)
+    if df is None:
+        return None
+    df = df.reset_index()
+    df['yyyymmdd'] = day.year * 10000 + day.month * 100 + day.day
+    return normalize_prices(df)
 
+
+def iter_tse_days(days, engine=None, summary=None, url=None, max_pending=None):
+    """串流版 get_tse_days_data: 依完成順序 yield (day, 當天 dataframe)
+    dataframe 為 price_store.PRICE_SCHEMA 的固定欄位/型別 (yyyymmdd 為 int),
+    不在記憶體中累積
+    params
+    ======
+    max_pending : (int)
+        同時在途的日期數, 預設 engine.max_workers * 2
+    """
+    from fetch_engine import FetchEngine
+
+    engine = FetchEngine() if engine is None else engine
+    max_pending = engine.max_workers * 2 if max_pending is None else max_pending
+
+    def fetch(engine, day):
+        return fetch_tse_day(engine, day, url)
+
+    return engine.iter_fetch(days, fetch, parse_tse_day, summary, max_pending)
+
+
+def _get_range_data(get_days_data, start, end, engine, summary, calendar, url, market):
+    """只抓 calendar 判斷 market 可能開盤的日子, 抓完再把結果記回 calendar"""
+    from fetch_engine import FetchSummary
+    from trading_calendar import TradingCalendar
+
+    calendar = TradingCalendar() if calendar is None else calendar
+    run_summary = FetchSummary()
+    df = get_days_data(list(calendar.candidate_days(start, end, market)),
+                       engine=engine, summary=run_summary, url=url)
+    calendar.learn_from_summary(run_summary, market)
+    if summary is not None:
+        summary.merge(run_summary)
     return df
 
 
-def get_tse_ndays_data(n_days):
-    """抓距離今天n_days資料
+def _last_n_days_rounds(n_days, end, calendar, summary, market, max_rounds=10):
+    """由 end 往前找 n_days 個交易日, 每輪 yield (待抓日期, 本輪 FetchSummary)
+    呼叫端抓完該輪後才記回 calendar; 每輪只抓還缺的天數, 遇到假日再往前補,
+    不重複抓已確認的日期
     """
-    data = {}  # 股價資料
-    time = datetime.datetime.now()
-    count = 0
-    while (len(data) < n_days) and (count < n_days):
-        count += 1
-        # 假如日月 < 9 要補零
-        month_str = str(time.month) if time.month > 9 else '0' + \
-            str(time.month)
-        day_str = str(time.day) if time.day > 9 else '0' + str(time.day)
-
-        # e.x 20100101
-        taiwan_time_str = str(time.year - 1911) + '/' + \
-            month_str + '/' + day_str
-        international_time_str = str(time.year) + month_str + day_str
-
-        print('parsing', international_time_str)
-        # 使用 get_tse_data 爬資料
-        try:
-            data[international_time_str] = get_tse_data(taiwan_time_str)
-            print('success!')
-        except:
-            # 假日爬不到
-            print('fail! check the date is holiday')
-
-        # 減一天
-        time -= datetime.timedelta(days=1)
-
-    # 把資料疊起來
-    tw_stock_list = []
-    for date, df in tqdm(data.items()):
-        df['yyyymmdd'] = pd.to_datetime(date)
-        tw_stock_list.append(df)
-    tw_stock_df = pd.concat(tw_stock_list)
-    # 重置index
-    tw_stock_df = tw_stock_df.reset_index()
+    from fetch_engine import FetchSummary
+
+    found = 0
+    for _ in range(max_rounds):
+        days = calendar.previous_candidates(n_days - found, end, market=market)
+        if not days:
+            break
+        run_summary = FetchSummary()
+        yield days, run_summary
+        calendar.learn_from_summary(run_summary, market)
+        if summary is not None:
+            summary.merge(run_summary)
+        found += len(run_summary.trading_days)
+        if found >= n_days:
+            break
+        end = min(days) - datetime.timedelta(days=1)
+
+
+def _get_last_n_days(get_days_data, n_days, end, engine, summary, calendar, url, market,
+                     max_rounds=10):
+    """由 end 往前抓 n_days 個交易日 (見 _last_n_days_rounds)"""
+    from fetch_engine import FetchEngine
+    from trading_calendar import TradingCalendar
+
+    engine = FetchEngine() if engine is None else engine
+    calendar = TradingCalendar() if calendar is None else calendar
+    end = datetime.date.today() if end is None else end
+    df_list = [get_days_data(days, engine=engine, summary=run_summary, url=url)
+               for days, run_summary in _last_n_days_rounds(n_days, end, calendar, summary,
+                                                            market, max_rounds)]
+    df_list = [df for df in df_list if len(df)]
+    if not df_list:
+        return pd.DataFrame()
+    return pd.concat(df_list, ignore_index=True)
+
+
+def get_tse_range_data(start, end, engine=None, summary=None, calendar=None, url=None):
+    """並行抓取 start ~ end 的上市股價, 跳過 calendar 已知的休市日
+    params
+    ======
+    start, end : datetime.date
+    calendar : TradingCalendar
+    """
+    return _get_range_data(get_tse_days_data, start, end, engine, summary, calendar, url,
+                           'tse')
+
+
+def get_tse_ndays_data(n_days, engine=None, summary=None, calendar=None, end=None, url=None):
+    """抓距離今天(或 end)最近 n_days 個交易日資料
+    整段結果放在記憶體, 多年的資料改用 streaming.export_prices 直接寫入資料庫/parquet
+    """
+    tw_stock_df = _get_last_n_days(get_tse_days_data, n_days, end, engine, summary,
+                                   calendar, url, 'tse')
+    if tw_stock_df.empty:
+        return pd.DataFrame(columns=TSE_COLUMNS)
     tw_stock_df.drop_duplicates(
         subset=['證券代號', '成交量', '成交筆數', '開盤價', '最高價', '最低價', '收盤價', '本益比'], inplace=True
     )
-    tw_stock_df = tw_stock_df[['證券代號', 'yyyymmdd', '成交量',
-                               '成交筆數', '開盤價', '最高價', '最低價', '收盤價', '本益比']]
-    tw_stock_df['yyyymmdd'] = tw_stock_df['yyyymmdd'].astype('str')
     return tw_stock_df
 
 
+def fetch_otc_raw(date_tuple, session=None, url=None, cache=None):
+    """下載上櫃股價原始 json
+    params
+    ======
+    data_tuple : (tuple)
+        (2018,1,29)
+    session : FetchEngine or requests.Session
+    cache : RawCache
+        未指定則使用 session.cache (若有)
+    """
+    session = requests if session is None else session
+    cache = getattr(session, 'cache', None) if cache is None else cache
+    date_str = '{0}/{1:02d}/{2:02d}'.format(
+        date_tuple[0] - 1911, date_tuple[1], date_tuple[2])
+
+    def download():
+        ttime = str(int(time.time() * 100))
+        page = session.get(url or OTC_URL, params={'l': 'zh-tw', 'd': date_str, '_': ttime})
+        if not page.ok:
+            logging.error("Can not get OTC data at {}".format(date_str))
+            page.raise_for_status()
+        return page.content
+
+    def validate(content):
+        ## 假日/尚未公布 (aaData 為空或 reportDate 不符) 與錯誤頁不進快取
+        try:
+            return parsers.has_otc_rows(json.loads(content), date_tuple)
+        except ValueError:
+            return False
+
+    if cache is None:
+        content = download()
+    else:
+        immutable, ttl = raw_cache.daily_policy(datetime.date(*date_tuple))
+        content = cache.fetch('otc_daily_close', {'d': date_str}, download, immutable, ttl,
+                              validate)
+    return json.loads(content)
+
+
+def parse_otc_json(result, date_tuple):
+    """解析 fetch_otc_raw 的 json, 無資料(假日)回傳 None
+    (實作見 parsers.parse_otc_json)
+    """
+    df = parsers.parse_otc_json(result, date_tuple)
+    if df is None:
+        logging.info("No OTC data at {}".format(date_tuple))
+    return df
+
+
 def get_otc_data(date_tuple):
     ## stolen from https://github.com/Asoul/tsec/blob/master/crawl.py#L76
     """下載上櫃股價資料
@@ -143,91 +428,82 @@ def get_otc_data(date_tuple):
     
     return
     ======
-    當日otc股價 dataframe
+    當日otc股價 dataframe, 無資料回傳 None
     """
-    
+    try:
+        result = fetch_otc_raw(date_tuple)
+    except requests.RequestException:
+        return
+    return parse_otc_json(result, date_tuple)
 
-    date_str = '{0}/{1:02d}/{2:02d}'.format(
-        date_tuple[0] - 1911, date_tuple[1], date_tuple[2])
-    yyyymmdd = str(date_tuple[0]) + date_str[4:6] + date_str[-2:]
-    
-    ttime = str(int(time.time() * 100))
-    url = 'http://www.tpex.org.tw/web/stock/aftertrading/daily_close_quotes/stk_quote_result.php?l=zh-tw&d={}&_={}'.format(
-        date_str, ttime)
-    page = requests.get(url)
 
-    if not page.ok:
-        logging.error("Can not get OTC data at {}".format(date_str))
-        return
+def get_otc_days_data(days, engine=None, summary=None, url=None):
+    """並行抓取指定日期的上櫃股價
+    params
+    ======
+    days : iterable of datetime.date
+    engine : FetchEngine
+    summary : FetchSummary
+    """
+    from fetch_engine import FetchEngine
 
-    result = page.json()
+    engine = FetchEngine() if engine is None else engine
 
-    if result['reportDate'] != date_str:
-        logging.error("Get error date OTC data at {}".format(date_str))
-        return
-    
-    
-    stock_ids = []
-    yyyymmdd_dates = []
-    volumns_amount = []
-    deal_amount = []
-    turnover = []
-    open_price = []
-    close_price = []
-    highest_price = []
-    lowest_price = []
-
-    for table in [result['mmData'], result['aaData']]:        
-        for tr in table:
-            if len(tr) == 17:
-                row = clean_row([
-                    yyyymmdd,
-                    tr[8],  # 成交股數 -- 成交量
-                    tr[10],  # 成交筆數
-                    tr[9],  # 成交金額
-                    # tr[3],  # 漲跌價差                
-                    # tr[-4]  # 發行股數
-                    tr[4],  # 開盤價
-                    tr[5],  # 最高價
-                    tr[6],  # 最低價
-                    tr[2]  # 收盤價
-                ])
-                row.insert(0,tr[0])
-                stock_ids.append(row[0])
-                yyyymmdd_dates.append(row[1])
-                volumns_amount.append(float(row[2])/1000)
-                deal_amount.append(int(row[3]))
-                turnover.append(int(row[4]))
-                open_price.append(float(row[5]))
-                close_price.append(float(row[6]))
-                highest_price.append(float(row[7]))
-                lowest_price.append(float(row[8]))
-    otc_price_df = pd.DataFrame({
-        '證券代號' : stock_ids,
-        'yyyymmdd' : yyyymmdd_dates,
-        '成交量' : volumns_amount,
-        '成交筆數' : deal_amount,
-        '成交金額': turnover,
-        '開盤價' : open_price,
-        '最高價':highest_price,
-        '最低價':lowest_price,
-        '收盤價':close_price
-    })
-    return otc_price_df                
-        
-def get_otc_ndays_data(n_days):
+    def fetch(engine, day):
+        return fetch_otc_day(engine, day, url)
+
+    def parse(result, day):
+        return parse_otc_json(result, (day.year, day.month, day.day))
+
+    otc_price_list = [df for _, df in engine.iter_fetch(days, fetch, parse, summary)]
+    if not otc_price_list:
+        return pd.DataFrame()
+    otc_price_df = pd.concat(otc_price_list, ignore_index=True)
+    otc_price_df = otc_price_df.sort_values(['yyyymmdd', '證券代號'], ascending=[False, True])
+    return otc_price_df.reset_index(drop=True)
+
+
+def fetch_otc_day(engine, day, url=None):
+    """以 datetime.date 下載上櫃當天的原始 json"""
+    return fetch_otc_raw((day.year, day.month, day.day), session=engine, url=url)
+
+
+def parse_otc_day(result, day):
+    """fetch_otc_day 的結果 --> price_store.PRICE_SCHEMA 的 dataframe, 假日回傳 None"""
+    from price_store import normalize_prices
+
+    df = parse_otc_json(result, (day.year, day.month, day.day))
+    return None if df is None else normalize_prices(df)
+
+
+def iter_otc_days(days, engine=None, summary=None, url=None, max_pending=None):
+    """串流版 get_otc_days_data: 依完成順序 yield (day, 當天 dataframe)
+    欄位/型別同 iter_tse_days
+    """
+    from fetch_engine import FetchEngine
+
+    engine = FetchEngine() if engine is None else engine
+    max_pending = engine.max_workers * 2 if max_pending is None else max_pending
+
+    def fetch(engine, day):
+        return fetch_otc_day(engine, day, url)
+
+    return engine.iter_fetch(days, fetch, parse_otc_day, summary, max_pending)
+
+
+def get_otc_range_data(start, end, engine=None, summary=None, calendar=None, url=None):
+    """並行抓取 start ~ end 的上櫃股價, 跳過 calendar 已知的休市日"""
+    return _get_range_data(get_otc_days_data, start, end, engine, summary, calendar, url,
+                           'otc')
+
+
+def get_otc_ndays_data(n_days, engine=None, summary=None, calendar=None, end=None, url=None):
+    """抓距離今天(或 end)最近 n_days 個交易日的上櫃資料
+    (多年的資料改用 streaming.export_prices)
+    """
     assert (n_days > 0) and isinstance(n_days,int),'n_days must be positive int'
-    today = datetime.datetime.today()
-    otc_ndays_price = pd.DataFrame()
-    count = 0
-    while (count < n_days):
-        parse_day = today
-        count+=1
-        date_tuple = (parse_day.year, parse_day.month, parse_day.day)
-        otc_price_df = get_otc_data(date_tuple)
-        otc_ndays_price = otc_ndays_price.append(otc_price_df)
-        parse_day -= datetime.timedelta(days=1)
-    return otc_ndays_price
+    return _get_last_n_days(get_otc_days_data, n_days, end, engine, summary,
+                            calendar, url, 'otc')
 
 def clean_row(row):
     ''' Clean comma and spaces '''
@@ -238,7 +514,23 @@ def clean_row(row):
     return row
 
 
+def reparse_tse_archive(cache):
+    """離線重新解析 cache 中所有上市行情 (不連網)
+    return
+    ======
+    dataframe (含 證券代號, yyyymmdd 欄位), 無資料回傳 None
+    """
+    items = ((content.decode('big5', errors='replace'),
+              to_date(meta['params']['qdate']).timetuple()[:3])
+             for meta, content in cache.iter_entries('tse_mi_index'))
+    return parsers.parse_tse_batch(items)
+
 
+def reparse_otc_archive(cache):
+    """離線重新解析 cache 中所有上櫃行情 (不連網)"""
+    items = ((json.loads(content), to_date(meta['params']['d']).timetuple()[:3])
+             for meta, content in cache.iter_entries('otc_daily_close'))
+    return parsers.parse_otc_batch(items)
 
 
 def insertDataFrameToDb(df, con, tablename):
@@ -277,16 +569,181 @@ def insertDataFrameToDb(df, con, tablename):
     con.commit()
 
 
-if __name__ == '__main__':
+## 各資料表的 primary key, bulk_insert_df 以此判斷新增/更新/略過
+TABLE_KEYS = {
+    'tse_price': ('證券代號', 'yyyymmdd'),
+    'otc_price': ('證券代號', 'yyyymmdd'),
+    ## 證券代號在上市/上櫃間不重複, 撞號由 market_data.iter_market_prices 拒絕
+    'market_price': ('證券代號', 'yyyymmdd'),
+    'monthly_revenue': ('公司代號', 'yyyymmdd'),
+    'financial_statement': ('公司代號', 'yyyymmdd', '報表', '項目'),
+    'adjust_event': ('證券代號', 'yyyymmdd'),
+    'adjust_factor': ('證券代號', 'yyyymmdd'),
+}
 
-    logging.basicConfig(level=logging.DEBUG)
 
-    con = sqlite3.connect('twse.db')
-    create_db('tse_price',con,drop=True)
-    create_db('otc_price',con,drop=True)
+## 各資料表的寫入次數 (bulk_insert_df 有新增/更新時加一), 快取以此判斷資料表是否變動
+VERSION_TABLE = 'table_version'
+
+
+def _quote(col):
+    return '"{}"'.format(col)
+
+
+def bump_table_version(cursor, tablename):
+    """table_version 加一, 需與寫入在同一個 transaction (不經 bulk_insert_df 寫入資料表時呼叫)"""
+    cursor.execute('CREATE TABLE IF NOT EXISTS {}(tablename TEXT PRIMARY KEY, '
+                   'version INTEGER NOT NULL)'.format(VERSION_TABLE))
+    cursor.execute('INSERT INTO {} (tablename, version) VALUES (?, 1) '
+                   'ON CONFLICT(tablename) DO UPDATE SET version = version + 1'.format(
+                       VERSION_TABLE), (tablename,))
+
+
+def table_version(con, tablename):
+    """資料表經 bulk_insert_df 變動的次數, 沒有紀錄回傳 0
+    只讀一列, 不掃描資料表 (point_in_time 的快取以此判斷來源是否變動)
+    """
+    try:
+        row = con.execute('SELECT version FROM {} WHERE tablename = ?'.format(VERSION_TABLE),
+                          (tablename,)).fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return 0 if row is None else row[0]
+
+
+def _table_columns(con, tablename):
+    cursor = con.execute('PRAGMA table_info({})'.format(_quote(tablename)))
+    return [row[1] for row in cursor.fetchall()]
+
+
+def _df_to_rows(df, cols):
+    """依欄位順序把 dataframe 轉成 list of tuple, pd.nan --> None
+    一次處理整個欄位(tolist)而不是逐列 iterrows
+    """
+    columns = []
+    for col in cols:
+        series = df[col]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            series = series.dt.strftime('%Y%m%d')
+        values = series.tolist()
+        null_mask = series.isnull().to_numpy()
+        if null_mask.any():
+            for i in np.flatnonzero(null_mask):
+                values[i] = None
+        columns.append(values)
+    return list(zip(*columns))
+
+
+def bulk_insert_df(df, con, tablename, chunksize=100000, upsert=True,
+                   synchronous='NORMAL'):
+    """批次寫入 tse_price / otc_price / monthly_revenue / financial_statement
+    每個 chunk 先 executemany 到 temp staging table,
+    再以 INSERT ... ON CONFLICT DO UPDATE 一次合併到目標表
+
+    params
+    ======
+    df : (dataframe)
+        欲寫入的資料, 欄位名稱需與資料表相同(多餘欄位忽略)
+    con : sqlite3 connection
+    tablename : (str)
+        TABLE_KEYS 中的資料表
+    chunksize : (int)
+        每幾筆 commit 一次
+    upsert : (bool)
+        True : 已存在且內容不同的資料更新
+        False : 已存在的資料一律略過
+    synchronous : (str)
+        寫入期間的 PRAGMA synchronous (OFF, NORMAL, FULL)
+
+    return
+    ======
+    dict : {'inserted': 新增筆數, 'updated': 更新筆數, 'skipped': 略過筆數}
+    """
+    if tablename not in TABLE_KEYS:
+        raise ValueError('unknown table {}'.format(tablename))
+    keys = list(TABLE_KEYS[tablename])
+    table_cols = _table_columns(con, tablename)
+    cols = [col for col in table_cols if col in df.columns]
+    missing = [key for key in keys if key not in cols]
+    if missing:
+        raise ValueError('dataframe missing key columns {}'.format(missing))
+    values = [col for col in cols if col not in keys]
+
+    result = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    started = time.perf_counter()
+    n_total = len(df)
+    if tablename in PRICE_TABLES:
+        ## 股價表日期一律存整數 yyyymmdd
+        from price_store import yyyymmdd_series
+        df = df.assign(yyyymmdd=yyyymmdd_series(df['yyyymmdd']))
+    ## 同一批資料內重複的 key 只保留最後一筆
+    df = df.drop_duplicates(subset=keys, keep='last')
+    result['skipped'] += n_total - len(df)
+
+    fields = ','.join(_quote(col) for col in cols)
+    join_on = ' AND '.join('t.{0} = s.{0}'.format(_quote(key)) for key in keys)
+    same_value = ' AND '.join('t.{0} IS s.{0}'.format(_quote(col))
+                              for col in values) or '1'
+    SQL_STAGE = 'INSERT INTO temp.{0} ({1}) VALUES ({2})'.format(
+        _quote('_stage_' + tablename), fields, ','.join('?' * len(cols)))
+    SQL_EXIST = 'SELECT COUNT(*), COALESCE(SUM(NOT ({0})), 0) FROM temp.{1} s ' \
+                'JOIN {2} t ON {3}'.format(same_value, _quote('_stage_' + tablename),
+                                           _quote(tablename), join_on)
+    if upsert and values:
+        conflict = 'DO UPDATE SET {0} WHERE NOT ({1})'.format(
+            ','.join('{0}=excluded.{0}'.format(_quote(col)) for col in values),
+            ' AND '.join('{0} IS excluded.{0}'.format(_quote(col)) for col in values))
+    else:
+        conflict = 'DO NOTHING'
+    SQL_MERGE = 'INSERT INTO {0} ({1}) SELECT {1} FROM temp.{2} WHERE true ' \
+                'ON CONFLICT({3}) {4}'.format(
+                    _quote(tablename), fields, _quote('_stage_' + tablename),
+                    ','.join(_quote(key) for key in keys), conflict)
+
     cursor = con.cursor()
+    old_sync = cursor.execute('PRAGMA synchronous').fetchone()[0]
+    cursor.execute('PRAGMA synchronous={}'.format(synchronous))
+    cursor.execute('DROP TABLE IF EXISTS temp.{}'.format(_quote('_stage_' + tablename)))
+    cursor.execute('CREATE TEMP TABLE {0} AS SELECT {1} FROM {2} WHERE 0'.format(
+        _quote('_stage_' + tablename), fields, _quote(tablename)))
+    try:
+        for start in range(0, len(df), chunksize):
+            ## chunk 內依 primary key 順序寫入, 不逐列跳著插入;
+            ## 不整批排序: 依日期分 chunk 時 yyyymmdd 索引只在尾端附加
+            chunk = df.iloc[start:start + chunksize].sort_values(keys, kind='stable')
+            rows = _df_to_rows(chunk, cols)
+            cursor.execute('DELETE FROM temp.{}'.format(_quote('_stage_' + tablename)))
+            cursor.executemany(SQL_STAGE, rows)
+            n_exist, n_changed = cursor.execute(SQL_EXIST).fetchone()
+            cursor.execute(SQL_MERGE)
+            if len(rows) - n_exist or (upsert and n_changed):
+                bump_table_version(cursor, tablename)
+            con.commit()
+            result['inserted'] += len(rows) - n_exist
+            if upsert:
+                result['updated'] += n_changed
+                result['skipped'] += n_exist - n_changed
+            else:
+                result['skipped'] += n_exist
+            logging.debug('{} chunk at {} done: {}'.format(tablename, start, result))
+    finally:
+        cursor.execute('DROP TABLE IF EXISTS temp.{}'.format(_quote('_stage_' + tablename)))
+        cursor.execute('PRAGMA synchronous={}'.format(old_sync))
+    metrics.observe('insert.' + tablename, time.perf_counter() - started)
+    metrics.inc('insert.{}.rows'.format(tablename), n_total)
+    for key, value in result.items():
+        metrics.inc('insert.' + key, value)
+    logging.info('{} inserted:{inserted} updated:{updated} skipped:{skipped}'.format(
+        tablename, **result))
+    return result
+
 
-    # df = crawlPrice('107/01/03')
-    # logging.info(df)
-    df_tse = get_tse_ndays_data(5) #
-    df_otc = get_otc_ndays_data(5) # 
+if __name__ == '__main__':
+    from sync import sync
+
+    logging.basicConfig(level=logging.INFO)
+
+    con = sqlite3.connect('twse.db')
+    ## 只抓資料庫缺少的交易日, 中斷後重跑會從未完成的日期繼續
+    report = sync(con, metrics_path='sync_metrics.prom')
+    print(report)
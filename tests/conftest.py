@@ -0,0 +1,112 @@
+#! encoding = utf8
+"""測試共用: src / abu_QT 加入 sys.path, 本機的 stub HTTP 伺服器"""
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for name in ('abu_QT', 'src'):
+    path = os.path.join(ROOT, name)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+TSE_HEADER = ('"證券代號","證券名稱","成交股數","成交筆數","成交金額","開盤價","最高價","最低價",'
+              '"收盤價","漲跌(+/-)","漲跌價差","最後揭示買價","最後揭示買量","最後揭示賣價",'
+              '"最後揭示賣量","本益比"')
+
+
+def tse_csv(day, codes=('1101', '1102', '2330')):
+    """MI_INDEX csv 回應 (big5), codes 為空代表當天沒有資料"""
+    if not codes:
+        return b'\r\n'
+    lines = ['"{}年{:02d}月{:02d}日 大盤統計資訊"'.format(day.year - 1911, day.month, day.day),
+             '"指數","收盤指數","漲跌(+/-)","漲跌點數","漲跌百分比(%)"',
+             '"發行量加權股價指數","10,000.00","+","10.00","0.10",',
+             TSE_HEADER]
+    for i, code in enumerate(codes):
+        price = 10 + i + day.day / 100
+        lines.append('"{}","名稱{}","1,234,000","{}","12,345,678","{:.2f}","{:.2f}","{:.2f}",'
+                     '"{:.2f}","+","0.50","{:.2f}","3","{:.2f}","5","12.30"'.format(
+                         code, i, 100 + i, price, price + 1, price - 1, price, price, price))
+    lines.append('"說明:"')
+    return '\r\n'.join(lines).encode('big5')
+
+
+def otc_json(day, codes=('5347', '6488')):
+    """上櫃收盤行情 json 回應, codes 為空代表當天沒有資料"""
+    rows = []
+    for i, code in enumerate(codes or ()):
+        price = '{:.2f}'.format(50 + i + day.day / 100)
+        rows.append([code, '名稱{}'.format(i), price, '+0.50', price, price, price, price,
+                     '123,000', '2,500,000', str(55 + i), price, price, '1,000', '', '', ''])
+    report = '{}/{:02d}/{:02d}'.format(day.year - 1911, day.month, day.day)
+    return json.dumps({'reportDate': report, 'aaData': rows}).encode('utf8')
+
+
+class StubServer:
+    """本機 HTTP 伺服器, 每個請求交給 handler
+    params
+    ======
+    handler : callable(method, path, params) --> (status, body bytes)
+        params 為 query string (GET) 或 form (POST) 的 dict, 每個值只取第一個
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, method, params):
+                parts = urlsplit(self.path)
+                params = {k: v[0] for k, v in parse_qs(params).items()}
+                stub.requests.append((method, parts.path, params))
+                status, body = stub.handler(method, parts.path, params)
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._reply('GET', urlsplit(self.path).query)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self._reply('POST', self.rfile.read(length).decode())
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    """stub_server(handler) --> 啟動中的 StubServer, 測試結束後關閉"""
+    servers = []
+
+    def start(handler):
+        server = StubServer(handler)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
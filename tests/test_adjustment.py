@@ -0,0 +1,123 @@
+#! encoding = utf8
+import datetime
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+
+from adjustment import (AdjustmentStore, compute_factors, detect_events, fetch_twse_events_raw,
+                        has_twse_events, parse_twse_events)
+from raw_cache import RawCache
+
+FIELDS = ['資料日期', '股票代號', '股票名稱', '除權息前收盤價', '除權息參考價', '權值+息值', '權/息']
+NO_DATA = json.dumps({'stat': '很抱歉，沒有符合條件的資料!'}).encode('utf8')
+
+
+def _events_json(rows):
+    result = {'stat': 'OK', 'fields': FIELDS, 'data': rows}
+    return json.dumps(result, ensure_ascii=False).encode('utf8')
+
+
+EVENTS = _events_json([['107年07月02日', '2330', '台積電', '230.00', '222.00', '8.00', '息'],
+                       ['107年07月03日', '1101', '台泥', '40.00', '38.00', '2.00', '權息']])
+
+
+class _Session:
+    def __init__(self, body):
+        self.body = body
+        self.calls = 0
+
+    def get(self, url, params=None):
+        self.calls += 1
+        return type('Response', (), {'content': self.body})()
+
+
+def _event(code, yyyymmdd, before, reference):
+    return {'證券代號': code, 'yyyymmdd': yyyymmdd, '前收盤': before, '參考價': reference,
+            '類型': '息', '來源': 'twse'}
+
+
+def test_parse_twse_events():
+    events = parse_twse_events(EVENTS)
+    assert events['證券代號'].tolist() == ['2330', '1101']
+    assert events['yyyymmdd'].tolist() == [20180702, 20180703]
+    assert events['參考價'].tolist() == [222.0, 38.0]
+    assert parse_twse_events(NO_DATA) is None
+
+
+def test_has_twse_events():
+    assert has_twse_events(EVENTS)
+    assert not has_twse_events(b'')
+    assert not has_twse_events(b'<html>blocked</html>')
+    assert not has_twse_events(NO_DATA)
+    assert has_twse_events(NO_DATA, final=True)
+    assert not has_twse_events(json.dumps({'stat': 'error'}).encode('utf8'), final=True)
+
+
+def test_block_page_is_an_error_and_not_cached(tmp_path):
+    cache = RawCache(str(tmp_path))
+    with pytest.raises(requests.HTTPError):
+        fetch_twse_events_raw(2010, 1, session=_Session(b'<html>blocked</html>'), cache=cache)
+    assert cache.get('twse_twt49u', {'year': 2010, 'month': 1}) is None
+
+
+def test_empty_month_cached_only_when_final(tmp_path):
+    cache = RawCache(str(tmp_path))
+    today = datetime.date.today()
+    session = _Session(NO_DATA)
+    fetch_twse_events_raw(today.year, today.month, session=session, cache=cache)
+    fetch_twse_events_raw(today.year, today.month, session=session, cache=cache)
+    assert session.calls == 2
+
+    session = _Session(NO_DATA)
+    fetch_twse_events_raw(2010, 1, session=session, cache=cache)
+    fetch_twse_events_raw(2010, 1, session=session, cache=cache)
+    assert session.calls == 1
+
+
+def test_detect_events_uses_price_limit():
+    prices = pd.DataFrame({
+        '證券代號': ['1101'] * 3 + ['2330'] * 3,
+        'yyyymmdd': [20140102, 20140103, 20140106, 20180102, 20180103, 20180104],
+        ## 1101: 2014 年漲跌幅 7%, 跌 8% 為事件; 2330: 2018 年 10%, 跌 8% 不是事件
+        '收盤價': [100.0, 92.0, 93.0, 100.0, 92.0, 50.0],
+    })
+    events = detect_events(prices)
+    assert events[['證券代號', 'yyyymmdd']].values.tolist() == [['1101', 20140103],
+                                                            ['2330', 20180104]]
+    assert events['前收盤'].tolist() == [100.0, 92.0]
+    assert (events['來源'] == 'detected').all()
+
+
+def test_compute_factors_cumprod_per_code():
+    events = pd.DataFrame([_event('2330', 20180702, 200.0, 190.0),
+                           _event('1101', 20180703, 40.0, 20.0),
+                           _event('2330', 20170703, 100.0, 95.0)])
+    factors = compute_factors(events)
+    assert factors['證券代號'].tolist() == ['1101', '2330', '2330']
+    assert factors['yyyymmdd'].tolist() == [20180703, 20170703, 20180702]
+    assert np.allclose(factors['factor'], [0.5, 0.95, 0.95])
+    assert np.allclose(factors['cum_factor'], [0.5, 0.95, 0.95 * 0.95])
+
+
+def test_ratio_and_incremental_add_events():
+    store = AdjustmentStore(sqlite3.connect(':memory:'))
+    store.add_events(pd.DataFrame([_event('2330', 20180702, 200.0, 190.0)]))
+    codes = ['2330', '2330', '2330', '1101']
+    dates = [20180629, 20180702, 20180703, 20180629]
+    ## 事件之前的價格乘上 參考價 / 前收盤, 之後不變; 沒有事件的股票為 1
+    assert np.allclose(store.ratio(codes, dates), [0.95, 1.0, 1.0, 1.0])
+
+    ## 較早的事件: 只重算 2330, 累積到更早的價格
+    result = store.add_events(pd.DataFrame([_event('2330', 20170703, 100.0, 50.0)]))
+    assert result['codes'] == 1
+    assert np.allclose(store.ratio(['2330', '2330', '2330'], [20170630, 20180629, 20180702]),
+                       [0.475, 0.95, 1.0])
+
+    ## 偵測結果不覆寫公告資料
+    store.add_events(pd.DataFrame([dict(_event('2330', 20180702, 200.0, 100.0),
+                                        來源='detected')]), overwrite=False)
+    assert np.allclose(store.ratio(['2330'], [20180629]), [0.95])
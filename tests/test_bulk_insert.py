@@ -0,0 +1,70 @@
+#! encoding = utf8
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from twse_crawler import bulk_insert_df, create_db, enable_wal
+
+
+@pytest.fixture
+def con():
+    con = sqlite3.connect(':memory:')
+    create_db('tse_price', con)
+    return con
+
+
+def _prices(days, closes, codes=('2330',)):
+    return pd.DataFrame({'證券代號': list(codes) * len(days), 'yyyymmdd': days, '收盤價': closes})
+
+
+def _rows(con):
+    return con.execute('SELECT 證券代號, yyyymmdd, 收盤價 FROM tse_price').fetchall()
+
+
+def test_insert_update_skip(con):
+    result = bulk_insert_df(_prices(['2018-01-29', '20180130'], [230.0, 231.0]), con, 'tse_price')
+    assert result == {'inserted': 2, 'updated': 0, 'skipped': 0}
+    ## 日期一律存整數 yyyymmdd
+    assert _rows(con) == [('2330', 20180129, 230.0), ('2330', 20180130, 231.0)]
+
+    result = bulk_insert_df(_prices([20180129, 20180130, 20180131], [230.0, 232.0, 233.0]),
+                            con, 'tse_price', chunksize=2)
+    assert result == {'inserted': 1, 'updated': 1, 'skipped': 1}
+    assert _rows(con)[1:] == [('2330', 20180130, 232.0), ('2330', 20180131, 233.0)]
+
+
+def test_no_upsert_keeps_existing_rows(con):
+    bulk_insert_df(_prices([20180129], [230.0]), con, 'tse_price')
+    result = bulk_insert_df(_prices([20180129], [1.0]), con, 'tse_price', upsert=False)
+    assert result == {'inserted': 0, 'updated': 0, 'skipped': 1}
+    assert _rows(con) == [('2330', 20180129, 230.0)]
+
+
+def test_duplicates_in_batch_keep_last_and_nan_is_null(con):
+    df = pd.DataFrame({'證券代號': ['2330', '2330', '1101'], 'yyyymmdd': [20180129] * 3,
+                       '收盤價': [1.0, 230.0, np.nan], 'extra': [0, 0, 0]})
+    result = bulk_insert_df(df, con, 'tse_price')
+    assert result == {'inserted': 2, 'updated': 0, 'skipped': 1}
+    assert _rows(con) == [('1101', 20180129, None), ('2330', 20180129, 230.0)]
+
+
+def test_rejects_unknown_table_and_missing_keys(con):
+    with pytest.raises(ValueError):
+        bulk_insert_df(_prices([20180129], [1.0]), con, 'no_such_table')
+    with pytest.raises(ValueError):
+        bulk_insert_df(pd.DataFrame({'yyyymmdd': [20180129], '收盤價': [1.0]}), con, 'tse_price')
+
+
+def test_enable_wal(tmp_path):
+    con = sqlite3.connect(str(tmp_path / 'a.db'))
+    con.execute('CREATE TABLE t (x)')
+    con.execute('INSERT INTO t VALUES (1)')
+    ## transaction 中無法切換: 回報實際的模式
+    assert enable_wal(con) == 'delete'
+    con.commit()
+    assert enable_wal(con) == 'wal'
+    con.close()
+    con = sqlite3.connect(str(tmp_path / 'a.db'))
+    assert con.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
@@ -0,0 +1,91 @@
+#! encoding = utf8
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from fetch_engine import FetchEngine, FetchSummary
+
+
+@pytest.fixture
+def server(stub_server):
+    """/ok 回傳 key, /empty 空白 (假日), /flaky 前兩次 503, /slow 0.2 秒後回應, 其他 404"""
+    calls = Counter()
+    lock = threading.Lock()
+
+    def handler(method, path, params):
+        key = params.get('key', '')
+        with lock:
+            calls[path, key] += 1
+            n = calls[path, key]
+        if path == '/ok':
+            return 200, key.encode()
+        if path == '/empty':
+            return 200, b''
+        if path == '/flaky':
+            return (503, b'') if n <= 2 else (200, key.encode())
+        if path == '/slow':
+            time.sleep(0.2)
+            return 200, key.encode()
+        return 404, b''
+
+    return stub_server(handler)
+
+
+def _fetcher(url, path):
+    def fetch(engine, key):
+        p = path(key) if callable(path) else path
+        return engine.get(url + p, params={'key': key}).text
+
+    return fetch
+
+
+def _parse(text, key):
+    return text or None
+
+
+def test_iter_fetch_summary(server):
+    engine = FetchEngine(max_workers=3, rate=1000, retries=0)
+    summary = FetchSummary()
+    paths = {'1': '/ok', '2': '/empty', '3': '/ok', '4': '/missing'}
+    result = dict(engine.iter_fetch(paths, _fetcher(server.url, paths.get), _parse, summary))
+
+    assert result == {'1': '1', '3': '3'}
+    assert sorted(summary.trading_days) == ['1', '3']
+    assert summary.holidays == ['2']
+    assert list(summary.errors) == ['4']
+    assert summary.retries == 0
+
+
+@pytest.mark.parametrize('max_pending', [None, 2])
+def test_retries_counted_per_call(server, max_pending):
+    ## 兩個 iter_fetch 交錯進行, 重試只記在自己的 summary
+    engine = FetchEngine(max_workers=4, rate=1000, retries=3, backoff=0.05)
+    flaky, ok = FetchSummary(), FetchSummary()
+    a = engine.iter_fetch(['a{}'.format(i) for i in range(4)],
+                          _fetcher(server.url, '/flaky'), _parse, flaky, max_pending)
+    b = engine.iter_fetch(['b{}'.format(i) for i in range(4)],
+                          _fetcher(server.url, '/slow'), _parse, ok, max_pending)
+    keys = [next(a)[0], next(b)[0]]
+    keys += [key for key, _ in b] + [key for key, _ in a]
+
+    assert sorted(keys) == ['a0', 'a1', 'a2', 'a3', 'b0', 'b1', 'b2', 'b3']
+    assert flaky.retries == 8
+    assert ok.retries == 0
+    assert not flaky.errors and not ok.errors
+
+
+def test_close_cancels_pending(server):
+    engine = FetchEngine(max_workers=2, rate=1000)
+    summary = FetchSummary()
+    keys = [str(i) for i in range(20)]
+    started = time.perf_counter()
+    gen = engine.iter_fetch(keys, _fetcher(server.url, '/slow'), _parse, summary)
+    next(gen)
+    gen.close()
+
+    ## 只等在途的下載做完, 排隊中的不會再送出
+    assert time.perf_counter() - started < 1.5
+    assert len(server.requests) <= 4
+    assert summary.elapsed > 0
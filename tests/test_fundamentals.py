@@ -0,0 +1,109 @@
+#! encoding = utf8
+import datetime
+import sqlite3
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('lxml')
+import fundamentals  # noqa: E402
+from raw_cache import RawCache  # noqa: E402
+from twse_crawler import bulk_insert_df, create_db  # noqa: E402
+
+MONTHLY_HTML = """<html><body><table>
+<tr><th>公司代號</th><th>公司名稱</th><th>當月營收</th><th>上月營收</th><th>去年當月營收</th>
+<th>上月比較增減(%)</th><th>去年同月增減(%)</th><th>當月累計營收</th><th>去年累計營收</th>
+<th>前期比較增減(%)</th><th>備註</th></tr>
+<tr><td>2330</td><td>台積電</td><td>1,000</td><td>900</td><td>800</td><td>11.11</td><td>25.00</td>
+<td>1,900</td><td>1,600</td><td>18.75</td><td>-</td></tr>
+<tr><td>1101</td><td>台泥</td><td>500</td><td>--</td><td>450</td><td>不適用</td><td>11.11</td>
+<td>500</td><td>450</td><td>11.11</td><td>-</td></tr>
+<tr><td>合計</td><td></td><td>1,500</td><td></td><td></td><td></td><td></td><td></td><td></td>
+<td></td><td></td></tr>
+</table></body></html>"""
+
+STATEMENT_HTML = """<html><body>
+<table><tr><th>公司代號</th><th>公司名稱</th><th>營業收入</th><th>基本每股盈餘（元）</th></tr>
+<tr><td>2330</td><td>台積電</td><td>100,000</td><td>3.50</td></tr></table>
+<table><tr><th>公司代號</th><th>公司名稱</th><th>利息淨收益</th><th>基本每股盈餘（元）</th></tr>
+<tr><td>2881</td><td>富邦金</td><td>20,000</td><td>--</td></tr></table>
+</body></html>"""
+
+
+class _Session:
+    def __init__(self, body):
+        self.body = body
+        self.calls = 0
+
+    def _response(self):
+        self.calls += 1
+        return type('Response', (), {'content': self.body})()
+
+    def get(self, url, **kwargs):
+        return self._response()
+
+    def post(self, url, **kwargs):
+        return self._response()
+
+
+def test_parse_monthly_html():
+    df = fundamentals.parse_monthly_html(MONTHLY_HTML, 107, 1, 'otc')
+    assert df['公司代號'].tolist() == ['2330', '1101']
+    assert df['yyyymmdd'].unique().tolist() == [20180110]
+    assert df['當月營收'].tolist() == [1000.0, 500.0]
+    assert pd.isna(df.loc[1, '上月營收']) and pd.isna(df.loc[1, '上月比較增減(%)'])
+    assert df['上市櫃'].unique().tolist() == ['上櫃']
+    assert fundamentals.parse_monthly_html('', 2018, 1) is None
+
+
+def test_parse_statement_html_and_long_format():
+    df = fundamentals.parse_statement_html(STATEMENT_HTML)
+    assert df['公司代號'].tolist() == ['2330', '2881']
+    assert df.loc[0, '營業收入'] == 100000.0 and pd.isna(df.loc[1, '營業收入'])
+    long = fundamentals.statement_to_long(df, 2018, 1, '綜合損益彙總表')
+    assert set(long['項目']) == {'營業收入', '利息淨收益', '基本每股盈餘（元）'}
+    ## NaN (-- / 不同產業沒有的項目) 不寫入
+    assert len(long) == 3
+    assert long['yyyymmdd'].unique().tolist() == [20180331]
+    assert long['上市櫃'].unique().tolist() == ['上市']
+
+
+@pytest.mark.parametrize('body, cached', [
+    (MONTHLY_HTML, True),
+    ('<html><body>查無資料</body></html>', True),
+    ('', False),
+    ('<html><body>系統維護中</body></html>', False),
+])
+def test_monthly_cache_only_complete_pages(tmp_path, body, cached):
+    cache = RawCache(str(tmp_path))
+    session = _Session(body.encode('cp950'))
+    for _ in range(2):
+        fundamentals.fetch_monthly_raw(2015, 1, session=session, cache=cache)
+    assert session.calls == (1 if cached else 2)
+
+
+def test_statement_cache_rejects_page_without_rows(tmp_path):
+    cache = RawCache(str(tmp_path))
+    session = _Session('<html><table><tr><th>公司代號</th></tr></table></html>'.encode('utf8'))
+    for _ in range(2):
+        fundamentals.fetch_statement_raw(2015, 1, session=session, cache=cache)
+    assert session.calls == 2
+    session = _Session(STATEMENT_HTML.encode('utf8'))
+    for _ in range(2):
+        fundamentals.fetch_statement_raw(2015, 1, session=session, cache=cache)
+    assert session.calls == 1
+
+
+def test_pending_months():
+    con = sqlite3.connect(':memory:')
+    create_db('monthly_revenue', con)
+    bulk_insert_df(pd.DataFrame({
+        '公司代號': ['2330'] * 3, 'yyyymmdd': [20180110, 20180310, 20180410],
+        '當月營收': [1.0] * 3, '上市櫃': ['上市'] * 3,
+    }), con, 'monthly_revenue')
+    today = datetime.date(2018, 5, 5)
+    ## 2 月沒有資料; 4 月 (上個月) 仍在公布期間
+    assert fundamentals.pending_months(con, 'sii', (2018, 1), today) == [(2018, 2), (2018, 4)]
+    ## 上櫃的資料是分開記錄的
+    assert fundamentals.pending_months(con, 'otc', (2018, 1), today) == [
+        (2018, 1), (2018, 2), (2018, 3), (2018, 4)]
@@ -0,0 +1,82 @@
+#! encoding = utf8
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from indicators import RollingIndicators, update_from_sqlite
+from twse_crawler import bulk_insert_df, create_db
+
+WINDOWS = dict(ma_windows=(3, 5), volume_windows=(3,), return_windows=(2,), std_windows=(4,))
+
+
+def _prices(n_days=30, seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range('2018-01-01', periods=n_days).strftime('%Y%m%d').astype(int)
+    frames = []
+    for i, code in enumerate(['1101', '2330']):
+        close = 50 * (i + 1) * np.exp(np.cumsum(rng.normal(0, 0.02, n_days)))
+        frames.append(pd.DataFrame({'證券代號': code, 'yyyymmdd': days, '收盤價': close,
+                                    '成交量': rng.integers(1, 100, n_days).astype(float)}))
+    df = pd.concat(frames, ignore_index=True)
+    ## 1101 停牌一天
+    df.loc[(df['證券代號'] == '1101') & (df['yyyymmdd'] == days[10]), '收盤價'] = np.nan
+    return df
+
+
+def _expected(df):
+    df = df.dropna(subset=['收盤價']).sort_values(['證券代號', 'yyyymmdd'])
+    close = df.groupby('證券代號')['收盤價']
+    return df.assign(
+        ma_5=close.transform(lambda s: s.rolling(5).mean()),
+        vol_ma_3=df.groupby('證券代號')['成交量'].transform(lambda s: s.rolling(3).mean()),
+        ret_2=close.transform(lambda s: s / s.shift(2) - 1),
+        std_4=close.transform(lambda s: (s / s.shift()).rolling(4).std()),
+        drawdown=close.transform(lambda s: (s.cummax() - s).cummax() / s.cummax()),
+    ).set_index(['證券代號', 'yyyymmdd'])
+
+
+def test_matches_pandas_rolling():
+    df = _prices()
+    result = RollingIndicators(**WINDOWS).update(df).set_index(['證券代號', 'yyyymmdd'])
+    expected = _expected(df).loc[result.index]
+    for col in ('ma_5', 'vol_ma_3', 'ret_2', 'std_4', 'drawdown'):
+        assert np.allclose(result[col], expected[col], equal_nan=True), col
+
+
+def test_save_load_continues_where_it_stopped(tmp_path):
+    df = _prices()
+    full = RollingIndicators(**WINDOWS)
+    full.update(df)
+
+    path = str(tmp_path / 'indicators.npz')
+    days = sorted(df['yyyymmdd'].unique())
+    first = RollingIndicators(**WINDOWS)
+    first.update(df[df['yyyymmdd'] <= days[14]])
+    first.save(path)
+    loaded = RollingIndicators.load(path)
+    assert loaded.spec == first.spec and loaded.last_date == days[14]
+    ## 已處理過的日期略過
+    new = loaded.update(df)
+    assert sorted(new['yyyymmdd'].unique()) == days[15:]
+    pd.testing.assert_frame_equal(loaded.snapshot(), full.snapshot())
+
+    with pytest.raises(ValueError):
+        loaded.push(days[0], ['2330'], [1.0], [1.0])
+
+
+def test_update_from_sqlite(tmp_path):
+    con = sqlite3.connect(':memory:')
+    create_db('tse_price', con)
+    df = _prices()
+    days = sorted(df['yyyymmdd'].unique())
+    bulk_insert_df(df[df['yyyymmdd'] <= days[19]], con, 'tse_price')
+    path = str(tmp_path / 'indicators.npz')
+    state, new = update_from_sqlite(con, path, tables=('tse_price',), **WINDOWS)
+    assert state.last_date == days[19] and len(new) == 39
+
+    bulk_insert_df(df, con, 'tse_price')
+    state, new = update_from_sqlite(con, path, tables=('tse_price',))
+    assert state.last_date == days[-1] and sorted(new['yyyymmdd'].unique()) == days[20:]
+    assert state.spec['ma'] == [3, 5]
@@ -0,0 +1,82 @@
+#! encoding = utf8
+import datetime
+import sqlite3
+
+import pytest
+
+from conftest import otc_json, tse_csv
+from fetch_engine import FetchEngine, FetchSummary
+from market_data import _learn_calendar, get_market_data, iter_market_days
+from trading_calendar import TradingCalendar, to_date
+
+MON = datetime.date(2018, 1, 29)
+TUE = datetime.date(2018, 1, 30)
+WED = datetime.date(2018, 1, 31)
+
+
+@pytest.fixture
+def urls(stub_server):
+    """MON 兩個市場都有資料, TUE 只有上櫃, WED 兩個市場都休市"""
+    def tse(method, path, params):
+        day = to_date(params['qdate'])
+        return 200, tse_csv(day, codes=('1101', '2330') if day == MON else None)
+
+    def otc(method, path, params):
+        day = to_date(params['d'])
+        return 200, otc_json(day, codes=('5347',) if day in (MON, TUE) else None)
+
+    return {'tse': stub_server(tse).url, 'otc': stub_server(otc).url}
+
+
+def _engine():
+    return FetchEngine(max_workers=2, rate=1000, retries=0)
+
+
+def test_iter_market_days(urls):
+    summary = FetchSummary()
+    result = dict(iter_market_days([MON, TUE], engine=_engine(), summary=summary, urls=urls))
+    assert sorted(result) == [('otc', MON), ('otc', TUE), ('tse', MON)]
+    assert result[('tse', MON)].columns[0] == 'market'
+    assert result[('tse', MON)]['證券代號'].tolist() == ['1101', '2330']
+    assert result[('otc', TUE)]['market'].unique().tolist() == ['otc']
+    assert summary.holidays == [('tse', TUE)]
+
+
+def test_learn_calendar_per_market():
+    summary = FetchSummary()
+    summary.trading_days = [('otc', TUE)]
+    summary.holidays = [('tse', TUE), ('tse', WED), ('otc', WED)]
+    calendar = TradingCalendar()
+    _learn_calendar(calendar, summary, ('tse', 'otc'))
+    ## 任一市場有資料 --> 交易日; 兩個市場都沒有 --> 休市
+    assert calendar.is_trading_day(TUE) is True
+    assert calendar.is_trading_day(WED) is False
+    assert calendar.is_trading_day(MON) is None
+
+
+def test_get_market_data(urls):
+    con = sqlite3.connect(':memory:')
+    calendar = TradingCalendar()
+    df = get_market_data((MON, WED), engine=_engine(), calendar=calendar, con=con, urls=urls)
+    assert df[['yyyymmdd', 'market', '證券代號']].values.tolist() == [
+        [20180129, 'otc', '5347'], [20180129, 'tse', '1101'], [20180129, 'tse', '2330'],
+        [20180130, 'otc', '5347']]
+    assert con.execute('SELECT market, COUNT(*) FROM market_price GROUP BY market '
+                       'ORDER BY market').fetchall() == [('otc', 2), ('tse', 2)]
+    assert [calendar.is_trading_day(day) for day in (MON, TUE, WED)] == [True, True, False]
+
+    ## 已知的休市日不再抓取
+    assert get_market_data(WED, engine=_engine(), calendar=calendar, urls=urls).empty
+
+
+def test_code_in_both_markets_is_rejected(stub_server):
+    def tse(method, path, params):
+        return 200, tse_csv(to_date(params['qdate']), codes=('5347',))
+
+    def otc(method, path, params):
+        return 200, otc_json(to_date(params['d']), codes=('5347',))
+
+    urls = {'tse': stub_server(tse).url, 'otc': stub_server(otc).url}
+    con = sqlite3.connect(':memory:')
+    with pytest.raises(ValueError):
+        get_market_data(MON, engine=_engine(), calendar=TradingCalendar(), con=con, urls=urls)
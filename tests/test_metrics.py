@@ -0,0 +1,66 @@
+#! encoding = utf8
+import datetime
+import json
+import os
+import sqlite3
+
+import pandas as pd
+
+import metrics
+import sync
+from metrics import Metrics
+from twse_crawler import create_db
+
+
+def _metrics():
+    m = Metrics(prefix='test')
+    m.inc('insert.tse_price.rows', 300)
+    m.inc('fetch.bytes', 1024)
+    m.observe('insert.tse_price', 0.5)
+    m.observe('insert.tse_price', 1.0)
+    return m
+
+
+def test_snapshot_and_rates():
+    snap = _metrics().snapshot()
+    stat = snap['timers']['insert.tse_price']
+    assert (stat['count'], stat['total'], stat['min'], stat['max']) == (2, 1.5, 0.5, 1.0)
+    assert snap['rates'] == {'insert.tse_price.rows_per_sec': 200.0}
+    assert json.loads(_metrics().to_json())['counters']['fetch.bytes'] == 1024
+
+
+def test_prometheus_export():
+    lines = _metrics().to_prometheus().splitlines()
+    assert '# TYPE test_fetch_bytes_total counter' in lines
+    assert 'test_fetch_bytes_total 1024' in lines
+    assert 'test_insert_tse_price_seconds_count 2' in lines
+    assert 'test_insert_tse_price_seconds_sum 1.500000' in lines
+    assert 'test_insert_tse_price_seconds_max 1.000000' in lines
+    assert 'test_insert_tse_price_rows_per_sec 200.000' in lines
+
+
+def test_write_by_extension(tmp_path):
+    m = _metrics()
+    m.write(str(tmp_path / 'metrics.prom'))
+    m.write(str(tmp_path / 'metrics.json'))
+    with open(str(tmp_path / 'metrics.prom'), encoding='utf8') as f:
+        assert f.read() == m.to_prometheus()
+    with open(str(tmp_path / 'metrics.json'), encoding='utf8') as f:
+        assert json.load(f)['counters'] == m.snapshot()['counters']
+
+
+def test_profile_date(tmp_path, monkeypatch):
+    calls = []
+
+    def get_days_data(days, engine=None, summary=None, url=None):
+        calls.append(days)
+        return pd.DataFrame({'證券代號': ['2330'], 'yyyymmdd': [20180129], '收盤價': [230.0]})
+
+    monkeypatch.setattr(sync, 'days_data_func', lambda market: get_days_data)
+    con = sqlite3.connect(':memory:')
+    create_db('tse_price', con)
+    path = str(tmp_path / 'day.prof')
+    df = metrics.profile_date('2018-01-29', path=path, con=con)
+    assert calls == [[datetime.date(2018, 1, 29)]]
+    assert len(df) == 1 and os.path.exists(path)
+    assert con.execute('SELECT 收盤價 FROM tse_price').fetchall() == [(230.0,)]
@@ -0,0 +1,42 @@
+#! encoding = utf8
+import datetime
+
+import parsers
+from conftest import tse_csv
+
+DAY = datetime.date(2018, 1, 29)
+
+
+def _text(extra=()):
+    lines = tse_csv(DAY).decode('big5').split('\r\n')
+    ## 額外的行插在最後一筆資料之後
+    return '\r\n'.join(lines[:-1] + list(extra) + lines[-1:])
+
+
+def _line(n_fields, code='9999'):
+    return ','.join(['"{}"'.format(code)] + ['"1"'] * (n_fields - 1))
+
+
+def test_parse_tse_csv():
+    df = parsers.parse_tse_csv(_text())
+    assert list(df.index) == ['1101', '1102', '2330']
+    assert df.loc['2330', '收盤價'] == 12.29
+    assert df.loc['1101', '成交量'] == 1234.0
+
+
+def test_tse_rows_need_exactly_16_fields():
+    rows = parsers._tse_rows(_text([_line(17), _line(26), _line(15)]))
+    assert len(rows) == 3
+    assert not any(row.startswith('"9999"') for row in rows)
+
+    df = parsers.parse_tse_csv(_text([_line(16)]))
+    assert list(df.index) == ['1101', '1102', '2330', '9999']
+
+
+def test_tse_rows_skip_formula_prefix():
+    df = parsers.parse_tse_csv(_text(['=' + _line(16, '0050')]))
+    assert '0050' not in df.index
+
+
+def test_parse_tse_csv_holiday():
+    assert parsers.parse_tse_csv(tse_csv(DAY, codes=None).decode('big5')) is None
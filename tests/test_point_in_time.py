@@ -0,0 +1,74 @@
+#! encoding = utf8
+import os
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from twse_crawler import bulk_insert_df, create_db, table_version
+
+pytest.importorskip('pyarrow')
+from point_in_time import load_feature_panel  # noqa: E402
+
+
+@pytest.fixture
+def con():
+    con = sqlite3.connect(':memory:')
+    for table in ('tse_price', 'monthly_revenue', 'financial_statement'):
+        create_db(table, con)
+    bulk_insert_df(pd.DataFrame({
+        '證券代號': ['2330'] * 3,
+        'yyyymmdd': [20180209, 20180212, 20180213],
+        '收盤價': [230.0, 231.0, 232.0],
+    }), con, 'tse_price')
+    bulk_insert_df(_revenue(100.0), con, 'monthly_revenue')
+    return con
+
+
+def _revenue(value):
+    return pd.DataFrame({'公司代號': ['2330'], 'yyyymmdd': [20180101], '當月營收': [value],
+                         '上市櫃': ['上市']})
+
+
+def test_revised_revenue_rebuilds_cache(con, tmp_path):
+    path = str(tmp_path / 'panel.parquet')
+    panel = load_feature_panel(con, path, statement_items={})
+    ## 1 月營收 2/11 起可用
+    assert panel['當月營收'].isna().tolist() == [True, False, False]
+    assert panel['當月營收'].iloc[-1] == 100.0
+
+    ## 同一期別修正: 筆數與最新日期不變
+    bulk_insert_df(_revenue(120.0), con, 'monthly_revenue')
+    panel = load_feature_panel(con, path, statement_items={})
+    assert panel['當月營收'].iloc[-1] == 120.0
+
+
+def test_revised_prices_frame_rebuilds_cache(con, tmp_path):
+    path = str(tmp_path / 'panel.parquet')
+    prices = pd.DataFrame({'證券代號': ['2330'] * 2, 'yyyymmdd': [20180212, 20180213],
+                           '收盤價': [231.0, 232.0]})
+    assert load_feature_panel(con, path, prices=prices, statement_items={})['收盤價'].iloc[-1] == 232.0
+    prices.loc[1, '收盤價'] = 233.0
+    assert load_feature_panel(con, path, prices=prices, statement_items={})['收盤價'].iloc[-1] == 233.0
+
+
+def test_corrected_price_rebuilds_cache(con, tmp_path):
+    path = str(tmp_path / 'panel.parquet')
+    panel = load_feature_panel(con, path, statement_items={})
+    assert panel['收盤價'].tolist() == [230.0, 231.0, 232.0]
+    ## 快取有效時不重建
+    mtime = os.path.getmtime(path)
+    load_feature_panel(con, path, statement_items={})
+    assert os.path.getmtime(path) == mtime
+
+    ## 修正舊資料: 筆數與最新日期不變
+    bulk_insert_df(pd.DataFrame({'證券代號': ['2330'], 'yyyymmdd': [20180209], '收盤價': [229.0]}),
+                   con, 'tse_price')
+    assert load_feature_panel(con, path, statement_items={})['收盤價'].iloc[0] == 229.0
+
+
+def test_unchanged_upsert_keeps_cache(con):
+    before = table_version(con, 'tse_price')
+    bulk_insert_df(pd.DataFrame({'證券代號': ['2330'], 'yyyymmdd': [20180209], '收盤價': [230.0]}),
+                   con, 'tse_price')
+    assert table_version(con, 'tse_price') == before
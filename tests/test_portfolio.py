@@ -0,0 +1,52 @@
+#! encoding = utf8
+import numpy as np
+import pandas as pd
+import pytest
+
+from portfolio import PortfolioBacktest, equal_weight, rebalance_dates
+
+DAYS = [20180102, 20180103, 20180104]
+
+
+def test_fee_and_tax():
+    close = pd.DataFrame({'2330': [100.0, 110.0]}, index=DAYS[:2])
+    weights = pd.DataFrame({'2330': [1.0, 0.0]}, index=DAYS[:2])
+    result = PortfolioBacktest(close, 1000000).run(weights, rebalance=1)
+    ## 10 張加手續費超過資金, 買 9 張: 900000 * 0.1425%
+    assert result['turnover'].tolist() == [900000.0, 990000.0]
+    assert result['fee'].tolist() == pytest.approx([1282.5, 1410.75])
+    ## 證交稅只在賣出時收
+    assert result['tax'].tolist() == pytest.approx([0.0, 2970.0])
+    assert result['cash'].tolist() == pytest.approx([98717.5, 1084336.75])
+    assert result['equity'].iloc[-1] == pytest.approx(1084336.75)
+    assert result['positions'].tolist() == [1, 0]
+
+
+def test_min_fee_and_tax_never_overdraw_cash():
+    ## 第二次換股時 A 減碼的最低手續費 / 證交稅超過估算, 需減少 B 的買進
+    close = pd.DataFrame({'A': [1.0] * 3, 'B': [1.0] * 3}, index=DAYS)
+    weights = pd.DataFrame({'A': [0.5] * 3, 'B': [0.0, 0.5, 0.5]}, index=DAYS)
+    result = PortfolioBacktest(close, 10000, lot_size=1).run(weights, rebalance=1)
+    assert (result['cash'] >= 0).all()
+    assert result['fee'].tolist() == [20.0, 40.0, 40.0]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_costs_are_the_only_change_at_constant_prices(seed):
+    rng = np.random.default_rng(seed)
+    n_days, n_codes = 30, 8
+    close = pd.DataFrame(np.tile(rng.uniform(5, 300, n_codes), (n_days, 1)),
+                         index=range(20180101, 20180101 + n_days))
+    signal = pd.DataFrame(rng.random((n_days, n_codes)), index=close.index) > 0.5
+    result = PortfolioBacktest(close, 500000).run(equal_weight(signal), rebalance=5)
+    assert (result['cash'] >= 0).all()
+    ## 價格不變時淨值只因手續費 / 證交稅減少
+    costs = (result['fee'] + result['tax']).to_numpy()
+    equity = np.r_[500000.0, result['equity'].to_numpy()]
+    assert np.allclose(np.diff(equity), -costs)
+
+
+def test_rebalance_dates():
+    index = pd.Index([20180102, 20180103, 20180201, 20180202, 20180301])
+    assert rebalance_dates(index, 'M').tolist() == [0, 2, 4]
+    assert rebalance_dates(index, 2).tolist() == [0, 2, 4]
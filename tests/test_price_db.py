@@ -0,0 +1,80 @@
+#! encoding = utf8
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import price_db
+from twse_crawler import bulk_insert_df, create_db, table_version
+
+## 改版前 create_db 的 tse_price
+LEGACY_DDL = """
+    CREATE TABLE tse_price(
+        yyyymmdd date,
+        證券代號 TEXT,
+        成交量 REAL,
+        收盤價 REAL,
+        PRIMARY KEY (yyyymmdd,證券代號)
+    )
+"""
+
+
+@pytest.fixture
+def legacy():
+    con = sqlite3.connect(':memory:')
+    con.execute(LEGACY_DDL)
+    con.executemany('INSERT INTO tse_price VALUES (?, ?, ?, ?)', [
+        ('2018-01-29', '2330', 1.0, 230.0),
+        ('2018-01-30 00:00:00', '2330', 1.0, 231.0),
+        ('20180131', '2330', 1.0, 232.0),
+        ## 同一天: 文字日期與整數日期各一筆, 保留整數那筆
+        ('2018-02-01', '2330', 1.0, 0.0),
+        (20180201, '2330', 1.0, 233.0),
+        (20180129, '1101', 2.0, 40.0),
+        (None, '1101', 2.0, 41.0),
+    ])
+    con.commit()
+    return con
+
+
+def test_migrate_legacy_table(legacy):
+    assert price_db.needs_migration(legacy) == ['tse_price']
+    report = price_db.migrate(legacy)
+    assert report['tse_price']['rows'] == 7
+    assert report['tse_price']['migrated'] == 5
+    assert price_db.table_layout(legacy, 'tse_price') == 'current'
+    assert price_db.needs_migration(legacy) == []
+    assert price_db.migrate(legacy) == {}
+    rows = legacy.execute('SELECT 證券代號, yyyymmdd, 收盤價 FROM tse_price').fetchall()
+    assert rows == [('1101', 20180129, 40.0), ('2330', 20180129, 230.0),
+                    ('2330', 20180130, 231.0), ('2330', 20180131, 232.0),
+                    ('2330', 20180201, 233.0)]
+    ## 快取 (point_in_time) 需要知道資料表已變動
+    assert table_version(legacy, 'tse_price') == 1
+
+
+def test_price_db_queries():
+    con = sqlite3.connect(':memory:')
+    create_db('tse_price', con)
+    create_db('otc_price', con)
+    bulk_insert_df(pd.DataFrame({'證券代號': ['2330', '2330', '1101'],
+                                 'yyyymmdd': [20180129, 20180130, 20180130],
+                                 '收盤價': [230.0, 231.0, 40.0], '本益比': [15.0, 15.1, 9.0]}),
+                   con, 'tse_price')
+    bulk_insert_df(pd.DataFrame({'證券代號': ['5347'], 'yyyymmdd': [20180131],
+                                 '收盤價': [50.0], '成交金額': [1000]}), con, 'otc_price')
+    db = price_db.PriceDB(con)
+
+    history = db.history('2330', start='2018-01-30', columns=['收盤價'])
+    assert history['yyyymmdd'].tolist() == [20180130]
+    assert history['收盤價'].tolist() == [231.0]
+
+    ## 表中沒有的欄位為 NaN
+    otc = db.history('5347', columns=['收盤價', '本益比'], as_frame=False)
+    assert otc['收盤價'].tolist() == [50.0]
+    assert np.isnan(otc['本益比']).all()
+
+    assert db.day(20180130)['證券代號'].tolist() == ['1101', '2330']
+    assert db.last_date() == 20180131
+    assert db.last_date('tse_price') == 20180130
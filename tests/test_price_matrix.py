@@ -0,0 +1,74 @@
+#! encoding = utf8
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import price_matrix
+from price_matrix import PriceMatrix
+
+
+def _prices(days, codes, start=0.0):
+    rows = [(code, day, start + 100.0 * i + j) for j, day in enumerate(days)
+            for i, code in enumerate(codes)]
+    df = pd.DataFrame(rows, columns=['證券代號', 'yyyymmdd', '收盤價'])
+    df['成交量'] = 1.0
+    return df
+
+
+def test_create_append_reopen(tmp_path):
+    root = str(tmp_path / 'matrix')
+    matrix = PriceMatrix.create(root, date_capacity=4, code_capacity=2)
+    assert matrix.shape == (0, 0)
+    assert matrix.append(_prices([20180129, 20180130], ['2330', '1101'])) == 2
+    ## 已存在的日期覆寫, 新的股票加在最後
+    assert matrix.append(pd.DataFrame({'證券代號': ['2330', '2412'], 'yyyymmdd': [20180130] * 2,
+                                       '收盤價': [7.0, 8.0]})) == 0
+    with pytest.raises(ValueError):
+        matrix.append(_prices([20180101], ['2330']))
+
+    reopened = PriceMatrix(root)
+    assert reopened.codes == ['2330', '1101', '2412']
+    assert reopened.dates.tolist() == [20180129, 20180130]
+    assert reopened.series('2330').tolist() == [0.0, 7.0]
+    assert reopened.series('1101', start='2018-01-30').tolist() == [101.0]
+    frame = reopened.frame(codes=['2412'])
+    assert np.isnan(frame.loc[20180129, '2412']) and frame.loc[20180130, '2412'] == 8.0
+    assert np.isnan(reopened['open']).all()
+    with pytest.raises(IOError):
+        reopened.append(_prices([20180131], ['2330']))
+
+
+def test_grow_keeps_data(tmp_path, monkeypatch):
+    ## 每次只複製 3 列, 測試分段複製
+    monkeypatch.setattr(price_matrix, 'GROW_ROWS', 3)
+    root = str(tmp_path / 'matrix')
+    matrix = PriceMatrix.create(root, date_capacity=4, code_capacity=2)
+    days = list(range(20180101, 20180111))
+    codes = ['1101', '2330', '2412']
+    for day in days:
+        matrix.append(_prices([day], codes, start=day - 20180101))
+    assert matrix['close'].shape == (10, 3)
+    assert matrix._fields['close'].shape == (16, 4)
+    assert not (tmp_path / 'matrix' / 'close.npy.tmp').exists()
+
+    reopened = PriceMatrix(root)
+    expected = np.arange(10)[:, None] + 100.0 * np.arange(3)[None, :]
+    assert np.array_equal(reopened['close'], expected)
+    assert np.isnan(reopened._fields['close'][10:]).all()
+    assert np.isnan(reopened._fields['close'][:, 3]).all()
+
+
+def test_grow_does_not_load_matrix(tmp_path, monkeypatch):
+    monkeypatch.setattr(price_matrix, 'GROW_ROWS', 16)
+    matrix = PriceMatrix.create(str(tmp_path / 'matrix'), date_capacity=256, code_capacity=256)
+    days = list(range(20100101, 20100101 + 256))
+    matrix.append(_prices(days, [str(1000 + i) for i in range(256)]))
+    tracemalloc.start()
+    matrix._grow(512, 256, matrix.shape)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    ## 一個欄位已使用的部分為 256 KB
+    assert peak < 256 * 256 * 4 / 2
+    assert matrix['close'][:, 0].tolist() == [float(j) for j in range(256)]
@@ -0,0 +1,70 @@
+#! encoding = utf8
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from twse_crawler import bulk_insert_df, create_db
+
+pytest.importorskip('pyarrow')
+from price_store import ParquetPriceStore  # noqa: E402
+
+DAYS = [20161229, 20161230, 20170103, 20170104, 20180102, 20180103]
+CODES = ['1101', '2330', '2412']
+
+
+class _CountingStore(ParquetPriceStore):
+    def __init__(self, root):
+        super().__init__(root)
+        self.writes = []
+
+    def write(self, df, market):
+        self.writes.append((market, sorted(set((df['yyyymmdd'] // 10000).tolist()))))
+        return super().write(df, market)
+
+
+def _prices(codes, offset=0.0):
+    rows = [(code, day, 10.0 * i + j + offset) for i, code in enumerate(codes)
+            for j, day in enumerate(DAYS)]
+    return pd.DataFrame(rows, columns=['證券代號', 'yyyymmdd', '收盤價'])
+
+
+@pytest.fixture
+def store(tmp_path):
+    con = sqlite3.connect(':memory:')
+    for market, codes in (('tse', CODES), ('otc', ['5347', '6488'])):
+        create_db('{}_price'.format(market), con)
+        bulk_insert_df(_prices(codes), con, '{}_price'.format(market))
+    store = _CountingStore(str(tmp_path / 'store'))
+    ## chunk 跨年度: 每個分區仍只寫一次
+    assert store.export_from_sqlite(con, chunksize=4) == 30
+    return store
+
+
+def test_export_writes_each_partition_once(store):
+    assert store.writes == [('tse', [2016]), ('tse', [2017]), ('tse', [2018]),
+                            ('otc', [2016]), ('otc', [2017]), ('otc', [2018])]
+    df = store.load_prices(columns=['收盤價'])
+    assert len(df) == 30
+    assert df.loc[(df['證券代號'] == '2330') & (df['yyyymmdd'] == 20170104), '收盤價'].item() == 13.0
+
+
+def test_load_prices_filters(store):
+    df = store.load_prices(['2330'], start='20170101', end='2017-12-31', columns=['收盤價'])
+    assert df.columns.tolist() == ['證券代號', 'yyyymmdd', '收盤價']
+    assert df['yyyymmdd'].tolist() == [20170103, 20170104]
+    assert store.load_prices(markets=['otc'])['證券代號'].unique().tolist() == ['5347', '6488']
+
+
+def test_load_prices_prunes_partitions(store):
+    ## 其他年度的分區損毀也不影響: 只讀 year=2018
+    with open(store._partition_dir('tse', 2016) + '/part-0.parquet', 'wb') as f:
+        f.write(b'not parquet')
+    df = store.load_prices(start=20180101, markets=['tse'], columns=['收盤價'])
+    assert sorted(set(df['yyyymmdd'])) == [20180102, 20180103]
+
+
+def test_write_merges_with_existing_partition(store):
+    store.write(_prices(['2330'], offset=100.0).query('yyyymmdd == 20180103'), 'tse')
+    df = store.load_prices(['2330'], start=20180101, columns=['收盤價'], markets=['tse'])
+    assert df['收盤價'].tolist() == [14.0, 105.0]
@@ -0,0 +1,73 @@
+#! encoding = utf8
+import datetime
+import json
+
+import pytest
+
+from conftest import tse_csv
+from fetch_engine import FetchEngine
+from raw_cache import RawCache
+from twse_crawler import fetch_otc_raw, fetch_tse_raw
+
+DAY = datetime.date(2018, 1, 29)
+
+
+@pytest.fixture
+def server(stub_server):
+    """bodies 中的內容依序回傳 (最後一個重複使用)"""
+    bodies = []
+
+    def handler(method, path, params):
+        return 200, bodies.pop(0) if len(bodies) > 1 else bodies[0]
+
+    server = stub_server(handler)
+    server.bodies = bodies
+    return server
+
+
+def _engine(tmp_path):
+    return FetchEngine(rate=1000, retries=0, cache=RawCache(str(tmp_path)))
+
+
+def test_fetch_validate(tmp_path):
+    cache = RawCache(str(tmp_path))
+    assert cache.fetch('x', {'d': 1}, lambda: b'', validate=bool) == b''
+    assert cache.get('x', {'d': 1}) is None
+    assert cache.fetch('x', {'d': 1}, lambda: b'data', validate=bool) == b'data'
+    assert cache.get('x', {'d': 1}) == b'data'
+
+
+def test_tse_empty_body_not_cached(server, tmp_path):
+    engine = _engine(tmp_path)
+    server.bodies[:] = [b'\r\n', b'<html>error</html>', tse_csv(DAY)]
+    qdate = '107/01/29'
+    for _ in range(2):
+        fetch_tse_raw(qdate, session=engine, url=server.url)
+        assert engine.cache.get('tse_mi_index', {'qdate': qdate}) is None
+
+    text = fetch_tse_raw(qdate, session=engine, url=server.url)
+    assert '2330' in text
+    assert engine.cache.get('tse_mi_index', {'qdate': qdate}) == tse_csv(DAY)
+    fetch_tse_raw(qdate, session=engine, url=server.url)
+    assert len(server.requests) == 3
+
+
+def test_otc_empty_body_not_cached(server, tmp_path):
+    engine = _engine(tmp_path)
+    row = ['6488', '環球晶', '20.5', '+0.5', '20.00', '21.00', '19.50', '20.2', '123,000',
+           '2,500,000', '55', '20.4', '20.6', '1,000', 'x', 'y', 'z']
+    server.bodies[:] = [
+        b'not json',
+        json.dumps({'reportDate': '107/01/26', 'aaData': [row]}).encode(),
+        json.dumps({'reportDate': '107/01/29', 'aaData': []}).encode(),
+        json.dumps({'reportDate': '107/01/29', 'aaData': [row]}).encode(),
+    ]
+    date_tuple = (2018, 1, 29)
+    with pytest.raises(ValueError):
+        fetch_otc_raw(date_tuple, session=engine, url=server.url)
+    for _ in range(2):
+        fetch_otc_raw(date_tuple, session=engine, url=server.url)
+        assert engine.cache.get('otc_daily_close', {'d': '107/01/29'}) is None
+
+    assert fetch_otc_raw(date_tuple, session=engine, url=server.url)['aaData'] == [row]
+    assert engine.cache.get('otc_daily_close', {'d': '107/01/29'}) is not None
@@ -0,0 +1,65 @@
+#! encoding = utf8
+import numpy as np
+import pandas as pd
+import pytest
+
+from screener import Condition, Screener
+
+
+@pytest.fixture(scope='module')
+def panel():
+    rng = np.random.default_rng(0)
+    dates = [20180102, 20180103, 20180104, 20180105]
+    codes = ['{:04d}'.format(1101 + i) for i in range(300)]
+    df = pd.DataFrame([(c, d) for d in dates for c in codes], columns=['證券代號', 'yyyymmdd'])
+    df['收盤價'] = rng.uniform(5, 500, len(df)).round(2)
+    df['本益比'] = rng.uniform(3, 40, len(df)).round(1)
+    df.loc[rng.random(len(df)) < 0.1, '本益比'] = np.nan
+    df['成交筆數'] = rng.integers(0, 5000, len(df))
+    df['上市櫃'] = rng.choice(['上市', '上櫃'], len(df))
+    ## 日期打亂, Screener 自行排序
+    return df.sample(frac=1, random_state=1).reset_index(drop=True)
+
+
+CONDITIONS = ['成交筆數 > 1000', '本益比 < 15', ('收盤價', 'between', (10, 300)), '上市櫃 == 上市']
+
+
+def _expected(panel):
+    mask = (panel['成交筆數'] > 1000) & (panel['本益比'] < 15) & \
+        panel['收盤價'].between(10, 300) & (panel['上市櫃'] == '上市')
+    return panel[mask].sort_values(['yyyymmdd', '證券代號']).reset_index(drop=True)
+
+
+def test_screen_all_matches_pandas(panel):
+    screener = Screener(panel)
+    result = screener.screen_all(CONDITIONS)
+    expected = _expected(panel)
+    assert result['證券代號'].tolist() == expected['證券代號'].tolist()
+    assert result['yyyymmdd'].tolist() == expected['yyyymmdd'].tolist()
+
+    stats = screener.last_stats.sort_values('rank')
+    assert stats['evaluated'].iloc[0] == len(panel)
+    ## 之後的條件只比對前一個條件留下的列
+    assert stats['evaluated'].iloc[1:].tolist() == stats['remaining'].iloc[:-1].tolist()
+    assert stats['remaining'].iloc[-1] == len(expected)
+
+
+def test_screen_matches_screen_all(panel):
+    screener = Screener(panel)
+    every_day = screener.screen_all(CONDITIONS)
+    for date, day in every_day.groupby('yyyymmdd'):
+        one_day = screener.screen(date, CONDITIONS)
+        assert one_day['證券代號'].tolist() == day['證券代號'].tolist()
+    counts = screener.counts(CONDITIONS, start=20180103, end=20180104)
+    assert counts.index.tolist() == [20180103, 20180104]
+
+
+def test_string_conditions(panel):
+    screener = Screener(panel)
+    assert Condition.parse('上市櫃 == "上櫃"').value == '上櫃'
+    result = screener.screen_all(['上市櫃 != 上櫃'], columns=['上市櫃'])
+    assert set(result['上市櫃']) == {'上市'}
+    assert len(result) == (panel['上市櫃'] == '上市').sum()
+    assert screener.screen(20180102, ['收盤價 == abc']).empty
+    with pytest.raises(ValueError):
+        Condition.parse('上市櫃 > 上市')
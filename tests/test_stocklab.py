@@ -0,0 +1,83 @@
+#! encoding = utf8
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import stocklab
+import storage
+from stocklab import _values, build_parser
+
+
+def test_values():
+    assert _values('2:30:2', int) == list(range(2, 30, 2))
+    assert _values('5,10,20', int) == [5, 10, 20]
+    buy = _values('-0.05:-0.16:-0.01', float)
+    assert len(buy) == 11 and buy[0] == -0.05 and buy[-1] == -0.15
+
+
+def test_parse_arguments():
+    parser = build_parser()
+    args = parser.parse_args(['crawl', '--market', 'otc', '--start', '20180101',
+                              '--backend', 'parquet', '--db', 'store'])
+    assert (args.func, args.market, args.start, args.backend, args.db) == (
+        stocklab.cmd_crawl, ['otc'], '20180101', 'parquet', 'store')
+    assert (args.workers, args.rate) == (4, 2.0)
+
+    args = parser.parse_args(['--metrics', 'm.prom', 'sync', '--check'])
+    assert args.func is stocklab.cmd_sync and args.check and args.db == 'twse.db'
+    assert args.metrics == 'm.prom'
+
+    args = parser.parse_args(['sweep', '--keep', '5,10'])
+    assert (args.keep, args.buy, args.top_k) == ('5,10', '-0.05:-0.16:-0.01', 10)
+    assert parser.parse_args(['backtest']).keep is None
+
+    for argv in ([], ['crawl', '--backend', 'nosuch'], ['crawl', '--market', 'xyz']):
+        with pytest.raises(SystemExit):
+            parser.parse_args(argv)
+
+
+def test_sync_check(tmp_path, capsys):
+    code = stocklab.main(['sync', '--check', '--db', str(tmp_path / 'twse.db'),
+                          '--market', 'tse'])
+    out = capsys.readouterr().out
+    ## 空資料庫: 從 DEFAULT_START 起都待抓
+    assert code == 0
+    assert 'trading day:' in out and 'tse: last None' in out
+
+
+def test_get_backend(tmp_path):
+    with pytest.raises(ValueError):
+        storage.get_backend('nosuch')
+
+    backend = storage.get_backend('sqlite', str(tmp_path / 'twse.db'))
+    assert isinstance(backend, storage.SqliteBackend)
+    with backend.sink('tse') as sink:
+        sink.write(pd.DataFrame({'證券代號': ['2330', '2330'], 'yyyymmdd': [20180129, 20180130],
+                                 '收盤價': [230.0, 231.0]}))
+    history = backend.history('2330', start='2018-01-30')
+    assert history['yyyymmdd'].tolist() == [20180130]
+    assert history['收盤價'].tolist() == [231.0]
+    backend.close()
+    con = sqlite3.connect(str(tmp_path / 'twse.db'))
+    assert con.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_register_backend(monkeypatch):
+    monkeypatch.setattr(storage, 'BACKENDS', dict(storage.BACKENDS))
+
+    class Memory:
+        def __init__(self, location, **options):
+            self.location, self.options = location, options
+
+    storage.register_backend('memory', Memory)
+    backend = storage.get_backend('memory', 'here', flag=True)
+    assert (backend.location, backend.options) == ('here', {'flag': True})
+    ## 'module:Class' 用到時才 import
+    storage.register_backend('lazy', 'test_stocklab:_Lazy')
+    assert isinstance(storage.get_backend('lazy'), _Lazy)
+
+
+class _Lazy:
+    def __init__(self, location=None):
+        self.location = location
@@ -0,0 +1,90 @@
+#! encoding = utf8
+import datetime
+import time
+
+import pandas as pd
+
+from conftest import tse_csv
+from fetch_engine import FetchEngine, FetchSummary
+from streaming import ParquetSink, RollingDedup, in_order, iter_prices
+from trading_calendar import TradingCalendar, to_date
+
+FRI = datetime.date(2018, 1, 26)
+MON = datetime.date(2018, 1, 29)
+
+
+def _day(yyyymmdd, closes):
+    return pd.DataFrame({'yyyymmdd': yyyymmdd, '證券代號': ['1101', '2330'][:len(closes)],
+                         '收盤價': closes})
+
+
+def test_in_order_waits_for_earlier_keys():
+    summary = FetchSummary()
+
+    def pairs():
+        yield 3, 'c'
+        summary.holidays.append(2)
+        yield 1, 'a'
+        summary.errors[5] = 'timeout'
+        yield 4, 'd'
+
+    assert list(in_order(pairs(), [1, 2, 3, 4, 5], summary)) == [(1, 'a'), (3, 'c'), (4, 'd')]
+
+
+def test_stale_day_compared_with_previous_trading_day():
+    dedup = RollingDedup(window=10)
+    assert len(dedup(_day(20180125, [10.0, 20.0]))) == 2
+    assert len(dedup(_day(20180126, [11.0, 21.0]))) == 2
+    ## 與兩天前相同不算舊資料
+    assert len(dedup(_day(20180129, [10.0, 20.0]))) == 2
+    assert len(dedup(_day(20180130, [10.0, 20.0]))) == 0
+    assert dedup.stale_days == [20180130]
+
+
+def test_iter_prices_keeps_earlier_day_when_later_copy_arrives_first(stub_server):
+    ## MON 回傳 FRI 的內容 (舊資料), FRI 的回應較慢
+    def handler(method, path, params):
+        day = to_date(params['qdate'])
+        if day == FRI:
+            time.sleep(0.3)
+        if day.weekday() >= 5:
+            return 200, tse_csv(day, codes=None)
+        return 200, tse_csv(FRI if day == MON else day)
+
+    server = stub_server(handler)
+    engine = FetchEngine(max_workers=4, rate=1000, retries=0)
+    result = list(iter_prices('tse', start=FRI, end=MON, engine=engine,
+                              calendar=TradingCalendar(), url=server.url))
+
+    assert [day for day, _ in result] == [FRI]
+
+
+class _Store:
+    def __init__(self):
+        self.writes = []
+
+    def write(self, df, market):
+        self.writes.append((market, sorted(set((df['yyyymmdd'] // 10000).tolist()))))
+
+
+def test_parquet_sink_writes_each_year_once():
+    store = _Store()
+    with ParquetSink(store, 'tse', chunk_rows=1000) as sink:
+        for day in (20171228, 20171229, 20180102, 20180103, 20180104):
+            sink.write(_day(day, [10.0, 20.0]))
+    assert store.writes == [('tse', [2017]), ('tse', [2018])]
+    assert sink.rows == 10
+
+
+def test_get_tse_days_data_keeps_its_own_columns(stub_server):
+    ## 整批版本 (get_tse_days_data) 與串流版本共用下載, 回傳格式不變
+    from twse_crawler import TSE_COLUMNS, get_tse_days_data
+
+    server = stub_server(lambda method, path, params: (200, tse_csv(to_date(params['qdate']))))
+    engine = FetchEngine(max_workers=2, rate=1000, retries=0)
+    df = get_tse_days_data([FRI, MON], engine=engine, url=server.url)
+    assert df.columns.tolist() == TSE_COLUMNS
+    assert df['yyyymmdd'].unique().tolist() == ['20180129', '20180126']
+    streamed = dict(iter_prices('tse', start=FRI, end=FRI, engine=engine,
+                                calendar=TradingCalendar(), url=server.url))
+    assert streamed[FRI]['yyyymmdd'].unique().tolist() == [20180126]
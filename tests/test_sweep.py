@@ -0,0 +1,49 @@
+#! encoding = utf8
+import itertools
+
+import numpy as np
+import pytest
+
+from stock import StockTradeDays, TradeStrategy1, calc
+from sweep import sweep
+
+KEEP = [2, 5, 10]
+BUY = [-0.03, -0.05, -0.1]
+
+
+def _trade_days(n, seed):
+    rng = np.random.default_rng(seed)
+    price = 100 * np.exp(np.cumsum(rng.normal(0, 0.05, n)))
+    return StockTradeDays(price.round(2), 20170103)
+
+
+@pytest.fixture(scope='module')
+def trade_days():
+    return {code: _trade_days(300, seed) for seed, code in enumerate(['1101', '2330', '2412'])}
+
+
+def test_single_stock_matches_calc(trade_days):
+    days = trade_days['2330']
+    result = sweep(days, KEEP, BUY, processes=1, top_k=len(KEEP) * len(BUY))
+    expected = sorted((calc(keep, buy, days) for keep, buy in itertools.product(KEEP, BUY)),
+                      key=lambda r: (r[0], -r[1], -r[2]), reverse=True)
+    assert [(keep, buy) for _, keep, buy, _ in result] == [(keep, buy) for _, keep, buy in expected]
+    assert np.allclose([r[0] for r in result], [r[0] for r in expected])
+
+
+def test_profit_is_summed_over_stocks(trade_days):
+    result = sweep(trade_days, [5], [-0.05], processes=1)
+    assert len(result) == 1
+    profit, keep, buy, trades = result[0]
+    assert (keep, buy) == (5, -0.05)
+    assert np.isclose(profit, sum(calc(5, -0.05, days)[0] for days in trade_days.values()))
+    assert trades > 0
+
+
+def test_pool_matches_inline(trade_days):
+    buy = [0.03, 0.05, 0.07]
+    inline = sweep(trade_days, KEEP, buy, TradeStrategy1, processes=1, top_k=4)
+    pooled = sweep(trade_days, KEEP, buy, TradeStrategy1, processes=2, top_k=4, chunksize=1)
+    assert len(inline) == 4
+    assert any(trades for *_, trades in inline)
+    assert inline == pooled
@@ -0,0 +1,75 @@
+#! encoding = utf8
+import datetime
+import sqlite3
+
+import pytest
+
+from conftest import tse_csv
+from fetch_engine import FetchEngine
+from sync import SyncJob
+from trading_calendar import to_date
+
+SAT = datetime.date(2018, 1, 27)
+MON = datetime.date(2018, 1, 29)
+TUE = datetime.date(2018, 1, 30)
+
+
+@pytest.fixture
+def market(stub_server):
+    """上市行情: published 中的日期有資料, 其他日期回傳空資料"""
+    published = set([MON])
+
+    def handler(method, path, params):
+        day = to_date(params['qdate'])
+        return 200, tse_csv(day, codes=None if day not in published else ('1101', '2330'))
+
+    server = stub_server(handler)
+    server.published = published
+    return server
+
+
+def _job(con, server, now):
+    engine = FetchEngine(max_workers=2, rate=1000, retries=0)
+    return SyncJob(con, engine=engine, urls={'tse': server.url}, now=lambda: now)
+
+
+def _days(con, status):
+    return [to_date(row[0]) for row in con.execute(
+        'SELECT yyyymmdd FROM sync_checkpoint WHERE status = ? ORDER BY yyyymmdd', (status,))]
+
+
+def test_unpublished_day_is_fetched_again(market):
+    con = sqlite3.connect(':memory:')
+    morning = datetime.datetime.combine(TUE, datetime.time(10, 0))
+    job = _job(con, market, morning)
+    result = job.run(['tse'], start=SAT, end=TUE)['tse']
+
+    assert result['done'] == 1
+    assert result['unpublished'] == 1
+    ## 週末不試探, 只抓 MON, TUE
+    assert result['holidays'] == 0 and len(market.requests) == 2
+    assert _days(con, 'holiday') == []
+    assert job.calendar.is_trading_day(TUE) is None
+    assert job.pending_days('tse', start=SAT, end=TUE) == [TUE]
+
+    ## 晚上行情公布後重跑, 只抓 TUE
+    market.published.add(TUE)
+    n_requests = len(market.requests)
+    evening = datetime.datetime.combine(TUE, datetime.time(19, 0))
+    job = _job(con, market, evening)
+    result = job.run(['tse'], start=SAT, end=TUE)['tse']
+
+    assert len(market.requests) == n_requests + 1
+    assert result['done'] == 1 and result['unpublished'] == 0
+    assert _days(con, 'done') == [MON, TUE]
+    assert con.execute('SELECT COUNT(*) FROM tse_price WHERE yyyymmdd = 20180130').fetchone() == (2,)
+    assert job.calendar.is_trading_day(TUE) is True
+
+
+def test_empty_after_publish_time_is_holiday(market):
+    con = sqlite3.connect(':memory:')
+    evening = datetime.datetime.combine(TUE, datetime.time(19, 0))
+    result = _job(con, market, evening).run(['tse'], start=TUE, end=TUE)['tse']
+
+    assert result['holidays'] == 1 and result['unpublished'] == 0
+    assert _days(con, 'holiday') == [TUE]
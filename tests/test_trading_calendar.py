@@ -0,0 +1,69 @@
+#! encoding = utf8
+import datetime
+import sqlite3
+
+from fetch_engine import FetchSummary
+from trading_calendar import MAKEUP_DAYS, TradingCalendar
+
+MON = datetime.date(2018, 1, 29)
+SAT = datetime.date(2018, 2, 3)
+MAKEUP = datetime.date(2018, 3, 31)
+
+
+def _summary(trading=(), holidays=()):
+    summary = FetchSummary()
+    summary.trading_days = list(trading)
+    summary.holidays = list(holidays)
+    return summary
+
+
+def test_closed_only_when_every_market_is_empty():
+    calendar = TradingCalendar()
+    calendar.learn_from_summary(_summary(holidays=[MON]), 'tse')
+    assert calendar.is_trading_day(MON) is None
+    assert calendar.is_trading_day(MON, 'tse') is False
+    assert calendar.is_trading_day(MON, 'otc') is None
+    assert MON in list(calendar.candidate_days(MON, MON, 'otc'))
+    assert not list(calendar.candidate_days(MON, MON, 'tse'))
+
+    calendar.learn_from_summary(_summary(holidays=[MON]), 'otc')
+    assert calendar.is_trading_day(MON) is False
+
+
+def test_one_market_trading_wins():
+    calendar = TradingCalendar()
+    calendar.learn_from_summary(_summary(holidays=[MON]), 'tse')
+    calendar.learn_from_summary(_summary(trading=[MON]), 'otc')
+    assert calendar.is_trading_day(MON) is True
+    assert calendar.is_trading_day(MON, 'tse') is True
+
+
+def test_weekends_closed_except_makeup_days():
+    calendar = TradingCalendar()
+    assert calendar.is_trading_day(SAT) is False
+    assert calendar.is_trading_day(SAT + datetime.timedelta(days=1)) is False
+    ## 一週只需試探平日
+    assert len(list(calendar.candidate_days(MON, MON + datetime.timedelta(days=13)))) == 10
+    ## 補行上班日可能開盤, 由資料決定
+    assert MAKEUP in MAKEUP_DAYS and calendar.is_trading_day(MAKEUP) is None
+    assert MAKEUP in list(calendar.candidate_days(MAKEUP, MAKEUP))
+    calendar.learn_from_summary(_summary(trading=[MAKEUP]), 'tse')
+    assert calendar.is_trading_day(MAKEUP) is True
+    ## 資料庫內有股價的週六也是交易日
+    calendar.mark([SAT], True, 'db')
+    assert calendar.is_trading_day(SAT) is True
+    assert TradingCalendar(weekends_closed=False).is_trading_day(SAT + datetime.timedelta(days=7)) is None
+
+
+def test_persisted_per_market():
+    con = sqlite3.connect(':memory:')
+    calendar = TradingCalendar(con)
+    calendar.learn_from_summary(_summary(holidays=[MON, SAT]), 'tse')
+    calendar.learn_from_summary(_summary(holidays=[SAT]), 'otc')
+
+    reloaded = TradingCalendar(con)
+    assert reloaded.is_trading_day(SAT) is False
+    assert reloaded.is_trading_day(MON) is None
+    assert reloaded.is_trading_day(MON, 'tse') is False
+    reloaded.learn_from_summary(_summary(holidays=[MON]), 'otc')
+    assert TradingCalendar(con).is_trading_day(MON) is False
@@ -0,0 +1,91 @@
+#! encoding = utf8
+import itertools
+
+import numpy as np
+import pytest
+
+from stock import (StockTradeDays, TradeLoopBack, TradeStrategy1, TradeStrategy2,
+                   VectorTradeLoopBack, cross_check)
+
+
+def _trade_days(n, seed, scale=0.05):
+    """隨機漫步股價, 漲跌幅夠大才會觸發兩個策略的買入條件"""
+    rng = np.random.default_rng(seed)
+    price = 100 * np.exp(np.cumsum(rng.normal(0, scale, n)))
+    return StockTradeDays(price.round(2), 20170103)
+
+
+def _factory(cls, keep, buy, keep_stock_day=0):
+    def factory():
+        strategy = cls(keep, buy)
+        strategy.keep_stock_day = keep_stock_day
+        return strategy
+
+    return factory
+
+
+STRATEGIES = [
+    (TradeStrategy1, keep, buy)
+    for keep, buy in itertools.product([0, 1, 2, 5, 20], [0.0, 0.03, 0.07])
+] + [
+    (TradeStrategy2, keep, buy)
+    for keep, buy in itertools.product([0, 1, 2, 10], [0.0, -0.05, -0.1])
+]
+
+
+@pytest.mark.parametrize('cls, keep, buy', STRATEGIES)
+@pytest.mark.parametrize('seed', range(5))
+def test_random_prices(cls, keep, buy, seed):
+    trade_days = _trade_days(300, seed)
+    assert cross_check(trade_days, _factory(cls, keep, buy))
+
+
+@pytest.mark.parametrize('cls, keep, buy', STRATEGIES)
+@pytest.mark.parametrize('n', [0, 1, 2, 3])
+def test_short_series(cls, keep, buy, n):
+    assert cross_check(_trade_days(n, n, scale=0.2), _factory(cls, keep, buy))
+
+
+@pytest.mark.parametrize('cls, keep, buy', STRATEGIES)
+@pytest.mark.parametrize('keep_stock_day', [1, 3, 25])
+def test_already_holding(cls, keep, buy, keep_stock_day):
+    ## 回測開始時已持股 (e.g. 分段回測)
+    trade_days = _trade_days(60, keep_stock_day)
+    assert cross_check(trade_days, _factory(cls, keep, buy, keep_stock_day))
+
+
+@pytest.mark.parametrize('changes', [
+    [0.1] * 30,                    # 每天都有買入訊號
+    [-0.06] * 30,
+    [0.0] * 30,                    # 沒有訊號
+    [0.0] * 29 + [0.1],            # 最後一天才買
+    [0.0] * 28 + [-0.06, -0.06],
+    [0.1, -0.06, -0.06] * 10,
+])
+@pytest.mark.parametrize('cls, keep, buy', [
+    (TradeStrategy1, 5, 0.07), (TradeStrategy1, 1, 0.07), (TradeStrategy1, 0, 0.07),
+    (TradeStrategy2, 5, -0.1), (TradeStrategy2, 1, -0.1), (TradeStrategy2, 0, -0.1),
+])
+def test_edge_signals(changes, cls, keep, buy):
+    price = 100 * np.cumprod(1 + np.array([0.0] + changes))
+    trade_days = StockTradeDays(price, 20170103)
+    assert cross_check(trade_days, _factory(cls, keep, buy))
+
+
+def test_vector_profit_matches_loop():
+    trade_days = _trade_days(1000, 42)
+    loop = TradeLoopBack(trade_days, TradeStrategy2(10, -0.05))
+    loop.execute_trade()
+    vector = VectorTradeLoopBack(trade_days, TradeStrategy2(10, -0.05))
+    vector.execute_trade()
+    assert len(vector.buy_indices) > 0
+    assert np.array_equal(np.array(loop.profit_array), vector.profit_array)
+
+
+def test_stock_dict_cached():
+    trade_days = _trade_days(20, 0)
+    stock_dict = trade_days.stock_dict
+    assert trade_days.stock_dict is stock_dict
+    assert list(stock_dict.values()) == list(trade_days)
+    part = trade_days[5:10]
+    assert list(part.stock_dict) == list(trade_days.date_array[5:10])